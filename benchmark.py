@@ -0,0 +1,516 @@
+import os
+import argparse
+import copy
+import time
+import numpy as np
+import torch
+
+from tools.deploy_utils import benchmark_runner, check_parity, format_table, flatten_outputs
+
+def bench_fuse(args):
+    '''
+    CPU latency of ReID backbones before and after Conv-BN folding
+    '''
+    from src.factory.config_factory import cfg
+    from src.factory.backbone_factory import BackboneFactory
+    from tools.fuse_utils import fuse_model
+    rows = []
+    for backbone in ['osnet_deep_reid', 'shufflenetv2+']:
+        cfg.MODEL.BACKBONE = backbone
+        model = BackboneFactory.produce(cfg).eval()
+        fused, num_fused = fuse_model(copy.deepcopy(model), torch.rand(1, 3, 256, 128))
+        for bs in args.batch_sizes:
+            x = torch.rand(bs, 3, 256, 128)
+            base, _ = benchmark_runner(model, x, warmup=args.warmup, iters=args.iters)
+            latency, _ = benchmark_runner(fused, x, warmup=args.warmup, iters=args.iters)
+            diff = check_parity(model, fused, x)
+            rows.append([backbone, num_fused, bs, f"{base:.2f}", f"{latency:.2f}", f"{base / latency:.2f}x", f"{diff:.2e}"])
+    print(format_table(rows, ["backbone", "fused", "batch", "eager (ms)", "fused (ms)", "speedup", "max diff"]))
+
+def _fake_heatmap(batch, num_classes, height, width, num_objects=50):
+    # low background scores with a few sharp peaks, like a sigmoid-ed CenterNet heatmap
+    heat = torch.rand(batch, num_classes, height, width) * 0.05
+    for b in range(batch):
+        c = torch.randint(0, num_classes, (num_objects,))
+        y = torch.randint(0, height, (num_objects,))
+        x = torch.randint(0, width, (num_objects,))
+        heat[b, c, y, x] = torch.rand(num_objects) * 0.7 + 0.3
+    return heat
+
+def _time(fn, warmup, iters):
+    times = []
+    for i in range(warmup + iters):
+        start = time.perf_counter()
+        fn()
+        if i >= warmup:
+            times.append(time.perf_counter() - start)
+    return float(np.median(times)) * 1000
+
+def bench_decode(args):
+    '''
+    Dense (_nms + _topk) vs threshold-gated sparse heatmap decoding, stride 4 outputs
+    '''
+    from tools.centernet_utils import centernet_det_decode
+    from tools.fsaf_utils import fsaf_det_decode
+    from tools.scopehead_utils import scopehead_det_decode
+    decoders = {
+        'centernet': lambda hm, f, **kw: centernet_det_decode(hm, f[:, :2], reg=f[:, :2], K=100, **kw),
+        'fsaf': lambda hm, f, **kw: fsaf_det_decode(hm, f[:, :4], reg=f[:, :2], K=100, **kw),
+        'scopehead': lambda hm, f, **kw: scopehead_det_decode(hm, f, reg=f[:, :4], K=100, **kw),
+    }
+    rows = []
+    for w, h in [(512, 512), (1088, 608)]:
+        for num_classes in [1, 80]:
+            hm = _fake_heatmap(1, num_classes, h // 4, w // 4)
+            feat = torch.rand(1, 20, h // 4, w // 4) + 0.1
+            for name, decode in decoders.items():
+                dense = _time(lambda: decode(hm, feat), args.warmup, args.iters)
+                sparse = _time(lambda: decode(hm, feat, score_thresh=args.score_thresh), args.warmup, args.iters)
+                # the sparse path must return the dense detections above the threshold
+                d = decode(hm, feat).view(-1, 6)
+                s = decode(hm, feat, score_thresh=args.score_thresh).view(-1, 6)
+                d, s = d[d[:, 4] > args.score_thresh], s[s[:, 4] > args.score_thresh]
+                same = d.shape == s.shape and torch.allclose(d[d[:, 4].argsort()], s[s[:, 4].argsort()])
+                rows.append([f"{w}x{h}", num_classes, name, f"{dense:.2f}", f"{sparse:.2f}", f"{dense / sparse:.1f}x", same])
+    print(format_table(rows, ["input", "classes", "decoder", "dense (ms)", "sparse (ms)", "speedup", "same"]))
+
+def _fake_reid_split(scale, seed=0):
+    # MSMT17 test split: 11,659 queries, 82,161 gallery images, 3,060 identities, 15 cameras
+    rng = np.random.RandomState(seed)
+    num_q, num_g, num_pids = int(11659 * scale), int(82161 * scale), max(int(3060 * scale), 1)
+    q_pids, g_pids = rng.randint(0, num_pids, num_q), rng.randint(0, num_pids, num_g)
+    q_camids, g_camids = rng.randint(0, 15, num_q), rng.randint(0, 15, num_g)
+    return num_q, num_g, q_pids, g_pids, q_camids, g_camids
+
+def bench_reid_eval(args):
+    '''
+    CMC / mAP on a synthetic MSMT17-sized distance matrix (scaled by --reid-scale)
+    '''
+    from tools.eval_reid_metrics import evaluate, eval_market1501
+    num_q, num_g, q_pids, g_pids, q_camids, g_camids = _fake_reid_split(args.reid_scale)
+    distmat = np.random.RandomState(1).rand(num_q, num_g).astype(np.float32)
+    rows = []
+    start = time.perf_counter()
+    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
+    rows.append(["evaluate", f"{num_q}x{num_g}", f"{time.perf_counter() - start:.2f}", f"{mAP:.4f}", f"{cmc[0]:.4f}"])
+    start = time.perf_counter()
+    cmc, _ = eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, 50, cmc_only=True)
+    rows.append(["cmc only", f"{num_q}x{num_g}", f"{time.perf_counter() - start:.2f}", "-", f"{cmc[0]:.4f}"])
+    print(format_table(rows, ["metric", "distmat", "time (s)", "mAP", "Rank-1"]))
+
+def bench_reid_stream(args):
+    '''
+    Dense distance matrix + evaluate vs tiled evaluate_streaming on synthetic 512-d features
+    '''
+    import torch.nn.functional as F
+    from tools.eval_reid_metrics import evaluate, evaluate_streaming
+    num_q, num_g, q_pids, g_pids, q_camids, g_camids = _fake_reid_split(args.reid_scale)
+    generator = torch.Generator().manual_seed(1)
+    qf = F.normalize(torch.randn(num_q, 512, generator=generator))
+    gf = F.normalize(torch.randn(num_g, 512, generator=generator))
+    rows = []
+    start = time.perf_counter()
+    distmat = (1 - F.linear(qf, gf)).numpy()
+    cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
+    rows.append(["dense", f"{distmat.nbytes / 2**20:.0f}", f"{time.perf_counter() - start:.2f}", f"{mAP:.4f}", f"{cmc[0]:.4f}"])
+    del distmat
+    for q_tile, g_tile in [(1024, 16384), (256, 4096)]:
+        start = time.perf_counter()
+        cmc, mAP = evaluate_streaming(qf, gf, q_pids, g_pids, q_camids, g_camids, q_tile=q_tile, g_tile=g_tile)
+        rows.append([f"tile {q_tile}x{g_tile}", f"{q_tile * min(g_tile, num_g) * 4 / 2**20:.0f}", 
+                     f"{time.perf_counter() - start:.2f}", f"{mAP:.4f}", f"{cmc[0]:.4f}"])
+    print(format_table(rows, ["evaluator", "distances (MB)", "time (s)", "mAP", "Rank-1"]))
+
+def _fake_reid_features(num_q, q_pids, g_pids, dim=512, noise=3.0, seed=2):
+    # one center per identity with gaussian noise, so that search results are meaningful
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(max(q_pids.max(), g_pids.max()) + 1, dim).astype(np.float32)
+    pids = np.concatenate([q_pids, g_pids])
+    feats = centers[pids] + noise * rng.randn(len(pids), dim).astype(np.float32)
+    return feats[:num_q], feats[num_q:]
+
+def bench_index(args):
+    '''
+    Recall@k and latency of the approximate gallery indexes against exact search, and CMC / mAP
+    with the gallery ranked by the top-k of each index
+    '''
+    from tools.eval_reid_metrics import evaluate
+    from tools.index_utils import FlatIndex, IVFIndex, IVFPQIndex
+    num_q, num_g, q_pids, g_pids, q_camids, g_camids = _fake_reid_split(args.reid_scale)
+    qf, gf = _fake_reid_features(num_q, q_pids, g_pids)
+    k = 100
+    nlist = int(4 * np.sqrt(num_g))
+    train = gf[np.random.RandomState(3).choice(num_g, min(num_g, 64 * nlist), replace=False)]
+    indexes = [('flat', FlatIndex(gf.shape[1]))]
+    for nprobe in [8, 32]:
+        indexes.append((f"ivf nprobe={nprobe}", IVFIndex(gf.shape[1], nlist=nlist, nprobe=nprobe)))
+        indexes.append((f"ivfpq m=32 nprobe={nprobe}", IVFPQIndex(gf.shape[1], nlist=nlist, nprobe=nprobe, m=32)))
+
+    rows = []
+    exact = None
+    for name, index in indexes:
+        start = time.perf_counter()
+        if hasattr(index, 'train'):
+            index.train(train, niter=10)
+        index.add(gf)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        dists, ids = index.search(qf, k)
+        latency = (time.perf_counter() - start) * 1000 / num_q
+        if exact is None:
+            exact = ids
+        recall = np.mean([len(np.intersect1d(a[:10], b[:10])) / 10. for a, b in zip(ids, exact)])
+        # the samples out of the top-k are ranked last
+        distmat = np.full((num_q, num_g), np.inf, dtype=np.float32)
+        found = ids >= 0
+        distmat[np.nonzero(found)[0], ids[found]] = dists[found]
+        distmat[np.isinf(distmat)] = dists[found].max() + 1
+        cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
+        size = sum(getattr(index, name).nbytes for name in index.VECTOR_ARRAYS) / 2**20
+        rows.append([name, f"{size:.1f}", f"{build:.1f}", f"{latency:.3f}", f"{recall:.3f}", f"{mAP:.4f}", f"{cmc[0]:.4f}"])
+    print(format_table(rows, ["index", "size (MB)", "build (s)", "ms / query", "recall@10", f"mAP@{k}", "Rank-1"]))
+
+class _FakeJpegDataset(torch.utils.data.Dataset):
+    # JPEG encoded random crops, decoded and transformed like the ReID test loaders
+    def __init__(self, num_images, size=(128, 256), flip=False):
+        import io
+        from PIL import Image
+        import torchvision.transforms as T
+        rng = np.random.RandomState(0)
+        self.images = []
+        for _ in range(num_images):
+            buffer = io.BytesIO()
+            Image.fromarray(rng.randint(0, 255, (size[1] // 2, size[0] // 2, 3), dtype=np.uint8)).save(buffer, format='JPEG')
+            self.images.append(buffer.getvalue())
+        transforms = [T.Resize((size[1], size[0]))] + ([T.RandomHorizontalFlip(p=1.0)] if flip else [])
+        self.transform = T.Compose(transforms + [T.ToTensor(), T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])])
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        import io
+        from PIL import Image
+        return {'inp': self.transform(Image.open(io.BytesIO(self.images[index])).convert('RGB'))}
+
+def bench_flip_tta(args):
+    '''
+    Flip TTA of the ReID feature extraction, a second pass over a flipping loader vs the
+    flipped copies of the decoded batch in one or two forwards, in original images per second
+    '''
+    from torch.utils.data import DataLoader
+    from src.factory.config_factory import cfg
+    from src.factory.backbone_factory import BackboneFactory
+    cfg.MODEL.BACKBONE = 'osnet_deep_reid'
+    model = BackboneFactory.produce(cfg).eval()
+    num_images = 128
+    rows = []
+    for bs in args.batch_sizes:
+        loaders = [DataLoader(_FakeJpegDataset(num_images, flip=flip), batch_size=bs) for flip in [False, True]]
+        with torch.no_grad():
+            for _ in range(args.warmup):
+                model(torch.rand(2 * bs, 3, 256, 128))
+                model(torch.rand(bs, 3, 256, 128))
+            start = time.perf_counter()
+            feats = [torch.cat([flatten_outputs(model(batch['inp']))[0].flatten(1) for batch in loader]) for loader in loaders]
+            two_pass = (feats[0] + feats[1]) / 2
+            two_pass_time = time.perf_counter() - start
+
+            times = {}
+            results = {}
+            for mode in ['one forward', 'two forwards']:
+                start = time.perf_counter()
+                features = []
+                for batch in loaders[0]:
+                    if mode == 'one forward':
+                        outputs = flatten_outputs(model(torch.cat([batch['inp'], batch['inp'].flip(3)])))[0].flatten(1)
+                        features.append(sum(outputs.chunk(2)) / 2)
+                    else:
+                        outputs = [flatten_outputs(model(x))[0].flatten(1) for x in [batch['inp'], batch['inp'].flip(3)]]
+                        features.append(sum(outputs) / 2)
+                results[mode] = torch.cat(features)
+                times[mode] = time.perf_counter() - start
+        diff = max((results[mode] - two_pass).abs().max().item() for mode in results)
+        rows.append([bs, f"{num_images / two_pass_time:.1f}"] + 
+                    [f"{num_images / times[mode]:.1f} ({two_pass_time / times[mode]:.2f}x)" for mode in times] + [f"{diff:.2e}"])
+    print(format_table(rows, ["batch", "two passes (img/s)", "one forward (img/s)", "two forwards (img/s)", "max diff"]))
+
+def _saved_bytes(fn):
+    # bytes of the tensors saved for the backward, the activation memory of a training step
+    sizes = []
+    def pack(t):
+        sizes.append(t.numel() * t.element_size())
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(sizes)
+
+def bench_amp(args):
+    '''
+    Training step of a ReID model with an AMSoftmax loss in fp32 and under bf16 autocast on CPU,
+    in images per second and MB of activations saved for the backward
+    '''
+    import types
+    import torch.nn as nn
+    from src.factory.config_factory import cfg
+    from src.factory.backbone_factory import BackboneFactory
+    from src.model.module.head_module import AMSoftmaxClassiferHead
+    from src.model.module.loss_module import AMSoftmaxWithLoss
+    from tools.amp_utils import Precision
+    cfg.MODEL.BACKBONE = 'osnet_deep_reid'
+    num_classes = 100
+    torch.manual_seed(0)
+    backbone = BackboneFactory.produce(cfg)
+    head = AMSoftmaxClassiferHead(512, num_classes)
+    rows = []
+    for bs in args.batch_sizes:
+        x = torch.rand(bs, 3, 256, 128)
+        labels = torch.randint(0, num_classes, (bs,))
+        results = {}
+        for precision in ['fp32', 'bf16']:
+            model = nn.ModuleDict({'backbone': copy.deepcopy(backbone), 'head': copy.deepcopy(head)}).train()
+            graph = types.SimpleNamespace(model=model, loss_head=None, sub_models={}, crit={'amsoftmax': AMSoftmaxWithLoss()})
+            amp = Precision(precision, 'cpu')
+            amp.keep_fp32(graph, cfg.SOLVER.FP32_MODULES)
+            opt = torch.optim.SGD(model.parameters(), lr=0.01)
+
+            def step():
+                opt.zero_grad()
+                with amp.autocast():
+                    feat = model['backbone'](x)[-1].mean(dim=(2, 3))
+                    loss = graph.crit['amsoftmax'](model['head'](feat), labels)
+                amp.backward(loss)
+                opt.step()
+                return loss
+            loss, saved = _saved_bytes(step)
+            latency = _time(step, args.warmup, args.iters)
+            results[precision] = (bs / latency * 1000, saved / 2 ** 20, loss.item())
+        fp32 = results['fp32']
+        for precision, (speed, saved, loss) in results.items():
+            rows.append([bs, precision, f"{speed:.1f} ({speed / fp32[0]:.2f}x)", f"{saved:.1f} ({saved / fp32[1]:.2f}x)", f"{loss:.4f}"])
+    print(format_table(rows, ["batch", "precision", "train (img/s)", "activations (MB)", "first loss"]))
+
+def bench_logging(args):
+    '''
+    Per-iteration cost of logging 6 losses, the accuracy and the lr: .item() and a synchronous
+    SummaryWriter every iteration vs device-resident meters synced every 20 iterations and
+    written by a background thread
+    '''
+    import tempfile
+    from tensorboardX import SummaryWriter
+    from tools.metric_utils import MetricLogger, AsyncWriter
+    num_iters = 2000
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    names = ['loss'] + [f'loss/{i}' for i in range(5)] + ['accuracy']
+    values = [torch.rand((), device=device) for _ in names]
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        writer = SummaryWriter(f"{path}/sync")
+        start = time.perf_counter()
+        for step in range(num_iters):
+            for name, value in zip(names, values):
+                writer.add_scalar(f'train/{name}', value.item(), step)
+            writer.add_scalar('train/solver/main/lr', 0.01, step)
+        sync_time = time.perf_counter() - start
+        writer.close()
+
+        writer = AsyncWriter(SummaryWriter(f"{path}/async"))
+        metrics = MetricLogger(writer, sync_period=20)
+        start = time.perf_counter()
+        for step in range(1, num_iters + 1):
+            for name, value in zip(names, values):
+                metrics.update(f'train/{name}', value)
+            if metrics.step(step):
+                writer.add_scalar('train/solver/main/lr', 0.01, step)
+        async_time = time.perf_counter() - start
+        writer.flush()
+        flush_time = time.perf_counter() - start
+        writer.close()
+    rows.append(["item + SummaryWriter", f"{sync_time / num_iters * 1e6:.1f}", "-"])
+    rows.append(["meters + AsyncWriter", f"{async_time / num_iters * 1e6:.1f}", f"{flush_time / num_iters * 1e6:.1f}"])
+    print(format_table(rows, ["logging", "per iteration (us)", "incl. final flush (us)"]))
+
+def bench_checkpoint(args):
+    '''
+    Time the training loop is blocked by saving a checkpoint of a ResNet-50 with its SGD
+    momentum: a synchronous torch.save vs the copy to CPU of the asynchronous checkpointer
+    '''
+    import tempfile
+    import torchvision
+    from src.base_graph import BaseGraph
+    from tools.checkpoint_utils import CheckpointManager
+
+    class _Solver():
+        def __init__(self, opt):
+            self.opt = opt
+
+    model = torchvision.models.resnet50()
+    opt = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    model(torch.rand(2, 3, 64, 64)).sum().backward()
+    opt.step()
+    solvers = {'main': _Solver(opt)}
+    num_saves = 5
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        for epoch in range(num_saves):
+            BaseGraph.save(path, model, {}, solvers, epoch, 0.0)
+        sync_time = (time.perf_counter() - start) / num_saves
+
+        checkpointer = CheckpointManager(path, keep_last=1, keep_best=1)
+        stalls = []
+        start = time.perf_counter()
+        for epoch in range(num_saves):
+            stall = time.perf_counter()
+            checkpointer.save(BaseGraph.checkpoint_state(model, {}, solvers), epoch, 0.0)
+            stalls.append(time.perf_counter() - stall)
+            # the training goes on while the checkpoint is written
+            time.sleep(sync_time)
+        checkpointer.wait()
+        async_time = sum(stalls) / num_saves
+        size = os.path.getsize(os.path.join(path, 'model_004_0.0000.pth'))
+    rows.append(["torch.save", f"{sync_time * 1000:.1f}", f"{size / 2 ** 20:.1f}"])
+    rows.append(["CheckpointManager", f"{async_time * 1000:.1f}", f"{size / 2 ** 20:.1f}"])
+    print(format_table(rows, ["checkpoint", "training stall (ms)", "size (MB)"]))
+
+class _MallocPeak():
+    '''
+    Peak of the bytes allocated by glibc malloc during a block, sampled by a thread. The RSS
+    high-water mark keeps the freed arenas and does not show the activations saved.
+    '''
+    def __init__(self, period=0.0005):
+        import ctypes
+        class _MallInfo2(ctypes.Structure):
+            _fields_ = [(name, ctypes.c_size_t) for name in
+                        ["arena", "ordblks", "smblks", "hblks", "hblkhd", "usmblks", "fsmblks", "uordblks", "fordblks", "keepcost"]]
+        self.mallinfo2 = ctypes.CDLL("libc.so.6").mallinfo2
+        self.mallinfo2.restype = _MallInfo2
+        self.period = period
+
+    def _used(self):
+        info = self.mallinfo2()
+        return info.uordblks + info.hblkhd
+
+    def __enter__(self):
+        import threading
+        self.base = self.peak = self._used()
+        self.running = True
+        def sample():
+            while self.running:
+                self.peak = max(self.peak, self._used())
+                time.sleep(self.period)
+        self.thread = threading.Thread(target=sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self._used()) - self.base
+        return False
+
+def _recompute_step(backbone, selectors, size, batch, iters, threads, queue):
+    # in a fresh process, the allocator state only covers this configuration
+    from src.factory.backbone_factory import BackboneFactory
+    from tools.recompute_utils import checkpoint_modules
+    torch.set_num_threads(threads)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    model = BackboneFactory.products[backbone]().to(device).train()
+    checkpoint_modules(model, selectors)
+    x = torch.rand(batch, 3, size, size, device=device)
+    # the gradient buffers exist before the measured step, the peak is the activations
+    for p in model.parameters():
+        p.grad = torch.zeros_like(p)
+    def step():
+        out = model(x)
+        out = out if isinstance(out, torch.Tensor) else torch.stack([o.mean() for o in out])
+        out.mean().backward()
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        step()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        with _MallocPeak() as malloc_peak:
+            step()
+        peak = malloc_peak.peak
+    grad = torch.cat([p.grad.reshape(-1) for p in model.parameters()])
+    start = time.perf_counter()
+    for _ in range(iters):
+        model.zero_grad(set_to_none=False)
+        step()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    queue.put((peak, (time.perf_counter() - start) / iters, grad.norm().item()))
+
+def bench_recompute(args):
+    '''
+    Peak memory (CUDA or glibc malloc allocations) and time of a training step of
+    the hourglass and HRNet backbones with activation checkpointing at several granularities
+    '''
+    import multiprocessing
+    configs = [
+        # the Res2Net stem holds as much as a stack, it is checkpointed with them
+        ('hourglass', 256, 2, [
+            ("none", []),
+            ("stack", ["pre", "hg_mods.*"]),
+            ("level", ["pre", "hg_mods.*.up1", "hg_mods.*.low1", "hg_mods.*.low2", "hg_mods.*.low3"]),
+            ("fire_module", ["pre", "fire_module"]),
+        ]),
+        ('hrnet', 256, 8, [
+            ("none", []),
+            ("stage", ["stages.*"]),
+            ("HighResolutionModule", ["HighResolutionModule"]),
+            ("ShuffleBlock", ["ShuffleBlock"]),
+        ]),
+    ]
+    ctx = multiprocessing.get_context('spawn')
+    iters = min(args.iters, 3)
+    rows = []
+    for backbone, size, batch, granularities in configs:
+        results = {}
+        for name, selectors in granularities:
+            queue = ctx.Queue()
+            p = ctx.Process(target=_recompute_step, args=(backbone, selectors, size, batch, iters, args.threads, queue))
+            p.start()
+            results[name] = queue.get()
+            p.join()
+        peak0, time0, _ = results["none"]
+        for name, (peak, latency, norm) in results.items():
+            rows.append([backbone, f"{batch}x{size}", name, f"{peak / 2 ** 20:.0f} ({peak / peak0:.2f}x)",
+                         f"{latency * 1000:.0f} ({latency / time0:.2f}x)", f"{norm:.6f}"])
+    print(format_table(rows, ["backbone", "input", "checkpointing", "peak memory (MB)", "step (ms)", "grad norm"]))
+
+BENCHMARKS = {
+    'fuse': bench_fuse,
+    'decode': bench_decode,
+    'reid_eval': bench_reid_eval,
+    'reid_stream': bench_reid_stream,
+    'index': bench_index,
+    'flip_tta': bench_flip_tta,
+    'amp': bench_amp,
+    'logging': bench_logging,
+    'checkpoint': bench_checkpoint,
+    'recompute': bench_recompute,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmarks of the inference and training utilities")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS.keys()),
+                        help=f"benchmarks to run, from {list(BENCHMARKS.keys())}")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--score-thresh", type=float, default=0.1, help="threshold of the sparse decoding")
+    parser.add_argument("--reid-scale", type=float, default=1.0, help="scale of the synthetic MSMT17 split")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    for name in args.benchmarks:
+        print(f"===== {name} =====")
+        BENCHMARKS[name](args)
+
+if __name__ == '__main__':
+    main()
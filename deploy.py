@@ -0,0 +1,145 @@
+import os
+import argparse
+import sys
+import torch
+from copy import deepcopy
+
+from src.factory.config_factory import cfg
+from src.factory.config_factory import build_output, show_products
+from src.factory.graph_factory import GraphFactory
+from tools.utils import deploy_macro
+from tools.logger import setup_logger
+from tools.deploy_utils import (
+    FlattenOutput,
+    export_torchscript,
+    export_onnx,
+    build_onnx_runner,
+    check_parity,
+    benchmark_runner,
+    format_table,
+)
+
+def load_real_inputs(cfg, batch_size):
+    from src.factory.loader_factory import LoaderFactory
+    cfg.DB.USE_TRAIN = False
+    cfg.INPUT.TEST_BS = batch_size
+    loader = LoaderFactory.produce(cfg)
+    data = loader['val'] if 'val' in loader else loader['query']
+    return next(iter(data))['inp']
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a graph to TorchScript / ONNX and benchmark the runtimes")
+    parser.add_argument("--config", default="", help="path to config file", type=str)
+    parser.add_argument('--products', action='store_true',
+                        help='list available products in all factories')
+    parser.add_argument("--formats", nargs="+", default=['trace', 'script', 'onnx'],
+                        help="formats to export, from trace, script and onnx")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-3, help="tolerance of the parity check")
+    parser.add_argument('--real', action='store_true',
+                        help='also check parity on a batch from the test loader')
+    parser.add_argument('--fuse', action='store_true',
+                        help='fold BatchNorm into convolutions before exporting')
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    if args.products:
+        show_products()
+
+    if args.config != "":
+        cfg.merge_from_file(args.config)
+    cfg.merge_from_list(args.opts)
+    cfg.EVALUATE = True
+    build_output(cfg, args.config)
+    logger = setup_logger(cfg.OUTPUT_DIR)
+    deploy_macro(cfg)
+
+    graph = GraphFactory.produce(cfg)
+    if cfg.RESUME:
+        graph.load(cfg.RESUME)
+    graph.model = graph.model.cpu().eval()
+    fuse = args.fuse or cfg.DEPLOY.FUSE
+    # the unfused model is kept as the reference of parity and speed
+    reference = FlattenOutput(deepcopy(graph.model) if fuse else graph.model).eval()
+    runners = {'eager': reference}
+    if fuse:
+        graph.fuse()
+        runners['fused'] = FlattenOutput(graph.model).eval()
+    model = FlattenOutput(graph.model).eval()
+
+    w, h = cfg.INPUT.SIZE
+    example = torch.rand(1, 3, h, w)
+
+    export_paths = {}
+    # formats which failed to export, reported in the tables
+    failed = {}
+    for fmt in args.formats:
+        name = f"{cfg.MODEL.BACKBONE}_{fmt}"
+        try:
+            if fmt in ['trace', 'script']:
+                path = os.path.join(cfg.OUTPUT_DIR, f"{name}.pt")
+                runners[fmt] = export_torchscript(model, example, path, mode=fmt).eval()
+            elif fmt == 'onnx':
+                path = os.path.join(cfg.OUTPUT_DIR, f"{name}.onnx")
+                export_onnx(model, example, path)
+                runners[fmt] = build_onnx_runner(path)
+            else:
+                raise ValueError(f"Unknown format {fmt}")
+            export_paths[fmt] = path
+            logger.info(f"Exported {fmt} model to {path}")
+        except Exception as e:
+            logger.warning(f"Failed to export {fmt} model: {e}")
+            failed[fmt] = e
+
+    parity_inputs = {f"random x{bs}": torch.rand(bs, 3, h, w) for bs in args.batch_sizes}
+    if args.real:
+        parity_inputs['real'] = load_real_inputs(cfg, max(args.batch_sizes))
+
+    rows = []
+    for fmt in runners:
+        if fmt == 'eager':
+            continue
+        for name, inputs in parity_inputs.items():
+            try:
+                diff = check_parity(reference, runners[fmt], inputs)
+            except Exception as e:
+                logger.info(f"{fmt} fails on {name} inputs: {e}")
+                diff = float('inf')
+            rows.append([fmt, name, f"{diff:.2e}", "OK" if diff <= args.atol else "FAIL"])
+    for fmt in failed:
+        rows.append([fmt, "-", "-", "EXPORT FAILED"])
+    logger.info("Parity against eager\n" + format_table(rows, ["format", "inputs", "max diff", "status"]))
+
+    rows = []
+    for num_threads in args.threads:
+        torch.set_num_threads(num_threads)
+        if 'onnx' in export_paths:
+            runners['onnx'] = build_onnx_runner(export_paths['onnx'], num_threads)
+        for bs in args.batch_sizes:
+            inputs = torch.rand(bs, 3, h, w)
+            eager_latency = None
+            for fmt in runners:
+                try:
+                    latency, throughput = benchmark_runner(runners[fmt], inputs, warmup=args.warmup, iters=args.iters)
+                except Exception as e:
+                    logger.info(f"{fmt} fails with batch size {bs}: {e}")
+                    continue
+                if fmt == 'eager':
+                    eager_latency = latency
+                speedup = f"{eager_latency / latency:.2f}x" if eager_latency else "-"
+                rows.append([fmt, num_threads, bs, f"{latency:.2f}", f"{throughput:.1f}", speedup])
+            for fmt in failed:
+                rows.append([fmt, num_threads, bs, "-", "-", "export failed"])
+
+    table = format_table(rows, ["format", "threads", "batch", "latency (ms)", "img/s", "vs eager"])
+    logger.info("CPU runtime benchmark\n" + table)
+    with open(os.path.join(cfg.OUTPUT_DIR, "deploy_benchmark.txt"), 'w') as f:
+        f.write(table + "\n")
+
+if __name__ == '__main__':
+    main()
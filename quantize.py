@@ -0,0 +1,192 @@
+import os
+import argparse
+import copy
+from collections import defaultdict
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from src.factory.config_factory import cfg
+from src.factory.config_factory import build_output, show_products
+from src.factory.loader_factory import LoaderFactory
+from src.factory.graph_factory import GraphFactory
+from src.engine.centernet_object_detection import coco_eval
+from tools.utils import deploy_macro
+from tools.logger import setup_logger
+from tools.eval_reid_metrics import evaluate
+from tools.deploy_utils import flatten_outputs, benchmark_runner, format_table
+from tools.quant_utils import prepare_ptq, calibrate, convert, model_size
+from tools.centernet_utils import centernet_det_decode, centernet_det_post_process
+from tools.fsaf_utils import fsaf_det_decode
+from tools.scopehead_utils import scopehead_det_decode
+from torchvision.ops import nms
+
+def select_feature(outputs, key=""):
+    '''
+    Pick the embedding from the output of a ReID graph, e.g. 'neck' of trick_reid or
+    'embb' of harmattn_reid, the first output is used if key is not given.
+    '''
+    if isinstance(outputs, torch.Tensor):
+        return outputs
+    if key:
+        return outputs[key]
+    return flatten_outputs(outputs)[0]
+
+def extract_features(model, loader, key=""):
+    feats, pids, camids = [], [], []
+    with torch.no_grad():
+        for batch in tqdm(loader, desc="EXTRACT"):
+            feats.append(select_feature(model(batch['inp']), key).flatten(1).float())
+            pids.extend(batch['pid'])
+            camids.extend(batch['camid'])
+    return torch.cat(feats, 0), np.asarray(pids), np.asarray(camids)
+
+def eval_reid(model, loader, key=""):
+    '''
+    Returns:
+        mAP (float)
+        rank1 (float)
+    '''
+    qf, q_pids, q_camids = extract_features(model, loader['query'], key)
+    gf, g_pids, g_camids = extract_features(model, loader['gallery'], key)
+    distmat = 1 - F.linear(F.normalize(qf), F.normalize(gf))
+    cmc, mAP = evaluate(distmat.numpy(), q_pids, g_pids, q_camids, g_camids)
+    return mAP, cmc[0]
+
+def detection_heads(outputs, engine, out_sizes):
+    '''
+    Head outputs (dicts of hm, wh, reg) that the detection engine decodes, see their _evaluate
+    '''
+    if engine == 'centernet_object_detection':
+        return [outputs]
+    if engine in ['hourglass_object_detection', 'hourglass_jde']:
+        return [outputs[-1][out_sizes[-1]]]
+    if engine == 'shufflenetv2_scopehead_object_detection':
+        return [outputs[out_size] for out_size in out_sizes]
+    return [outputs[out_sizes[0]]]
+
+def eval_detection(model, loader, engine):
+    '''
+    COCO evaluation of a detection model on CPU, with the decoding and the post processing of
+    the engine, the engines themselves move the batches to the GPU
+
+    Returns:
+        AP (float): AP @[ IoU=0.50:0.95 ]
+    '''
+    w, h = cfg.INPUT.SIZE
+    strides = cfg.MODEL.STRIDES if isinstance(cfg.MODEL.STRIDES, (list, tuple)) else [cfg.MODEL.STRIDES]
+    out_sizes = [(w // s, h // s) for s in strides]
+    decode = {
+        'shufflenetv2_fsaf': fsaf_det_decode,
+        'shufflenetv2_scopehead_object_detection': scopehead_det_decode,
+    }.get(engine, centernet_det_decode)
+    use_nms = engine in ['shufflenetv2_object_detection', 'shufflenetv2_fsaf']
+    results = {}
+    with torch.no_grad():
+        for batch in tqdm(loader['val'], desc="EVALUATE"):
+            dets_outs = defaultdict(list)
+            for feat in detection_heads(model(batch['inp']), engine, out_sizes):
+                feat['hm'].sigmoid_()
+                if cfg.DB.TARGET_FORMAT == 'centerface_bbox':
+                    feat['wh'].exp_()
+                dets = decode(feat['hm'], feat['wh'], reg=feat['reg'], K=100)
+                dets = dets.detach().numpy().reshape(1, -1, dets.shape[-1])
+                dets_out = centernet_det_post_process(
+                    dets.copy(),
+                    batch['c'].numpy(),
+                    batch['s'].numpy(),
+                    feat['hm'].shape[2],
+                    feat['hm'].shape[3],
+                    feat['hm'].shape[1]
+                )[0]
+                for cat in dets_out:
+                    dets_outs[cat].extend(dets_out[cat])
+            if use_nms and len(dets_outs[1]) > 0:
+                _dets = torch.Tensor(dets_outs[1])
+                keep_ids = nms(_dets[:,:4], _dets[:,4], 0.5)
+                dets_outs[1] = _dets[keep_ids].numpy().tolist()
+            results[batch['img_id'][0]] = dets_outs
+    coco = loader['val'].dataset.coco
+    coco = coco[0] if isinstance(coco, (list, tuple)) else coco
+    return coco_eval(coco, results, cfg.OUTPUT_DIR).stats[0]
+
+def main():
+    parser = argparse.ArgumentParser(description="Post-training int8 quantization of a graph and report against fp32")
+    parser.add_argument("--config", default="", help="path to config file", type=str)
+    parser.add_argument('--products', action='store_true',
+                        help='list available products in all factories')
+    parser.add_argument("--feature", default="", type=str,
+                        help="key of the ReID embedding in the outputs, e.g. neck or embb")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument('--skip-eval', action='store_true',
+                        help='only report latency and model size')
+    parser.add_argument("opts", help="Modify config options using the command-line", default=None,
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+
+    if args.products:
+        show_products()
+
+    if args.config != "":
+        cfg.merge_from_file(args.config)
+    cfg.merge_from_list(args.opts)
+    cfg.EVALUATE = True
+    cfg.DB.USE_TRAIN = False
+    build_output(cfg, args.config)
+    logger = setup_logger(cfg.OUTPUT_DIR)
+    deploy_macro(cfg)
+    torch.set_num_threads(args.threads)
+
+    loader = LoaderFactory.produce(cfg)
+    graph = GraphFactory.produce(cfg)
+    if cfg.RESUME:
+        graph.load(cfg.RESUME)
+    graph.model = graph.model.cpu().eval()
+    is_reid = 'query' in loader and 'gallery' in loader
+    calib_loaders = [loader['query'], loader['gallery']] if is_reid else [loader['val']]
+
+    # the backbone is quantized, the light heads (BNNeck, normalization, decoders) stay in fp32
+    w, h = cfg.INPUT.SIZE
+    example = torch.rand(1, 3, h, w)
+    fp32_model = graph.model
+    int8_model = copy.deepcopy(fp32_model)
+    target = int8_model.backbone if hasattr(int8_model, 'backbone') else int8_model
+    prepared = prepare_ptq(target, example, backend=cfg.DEPLOY.QUANT_BACKEND, float_modules=cfg.DEPLOY.QUANT_FLOAT_MODULES)
+    calibrate(prepared, calib_loaders, num_batches=cfg.DEPLOY.QUANT_CALIB_BATCHES)
+    quantized = convert(prepared)
+    if hasattr(int8_model, 'backbone'):
+        int8_model.backbone = quantized
+    else:
+        int8_model = quantized
+    int8_model.eval()
+    torch.save(quantized.state_dict(), os.path.join(cfg.OUTPUT_DIR, f"{cfg.MODEL.BACKBONE}_int8.pth"))
+
+    rows = []
+    for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+        row = [name, f"{model_size(model):.2f}"]
+        for bs in args.batch_sizes:
+            latency, _ = benchmark_runner(model, torch.rand(bs, 3, h, w), warmup=args.warmup, iters=args.iters)
+            row.append(f"{latency:.2f}")
+        if not args.skip_eval:
+            if is_reid:
+                mAP, rank1 = eval_reid(model, loader, args.feature)
+                row.extend([f"{mAP:.1%}", f"{rank1:.1%}"])
+            else:
+                row.append(f"{eval_detection(model, loader, cfg.ENGINE):.3f}")
+        rows.append(row)
+
+    headers = ["model", "size (MB)"] + [f"latency x{bs} (ms)" for bs in args.batch_sizes]
+    if not args.skip_eval:
+        headers += ["mAP", "Rank-1"] if is_reid else ["AP"]
+    table = format_table(rows, headers)
+    logger.info(f"Quantization report, {args.threads} threads\n" + table)
+    with open(os.path.join(cfg.OUTPUT_DIR, "quantization_report.txt"), 'w') as f:
+        f.write(table + "\n")
+
+if __name__ == '__main__':
+    main()
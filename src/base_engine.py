@@ -1,8 +1,19 @@
 import os
 import sys
 import torch
+import torch.nn.functional as F
 import torch.distributed as dist
 import numpy as np
+from tqdm import tqdm
+from tools.feature_store import FeatureStore, model_digest, cache_key
+import json
+from tools.rerank_utils import sparse_re_ranking
+from tools.dist_utils import is_main_process, get_rank, all_gather_object, gather_by_index
+from tools.amp_utils import Precision
+from tools.metric_utils import MetricLogger, PipelineMeter
+from tools.checkpoint_utils import rng_state, set_rng_state
+from tools.profile_utils import EngineProfiler
+from torch.utils.data import distributed
 import logging
 logger = logging.getLogger("logger")
 try:
@@ -13,6 +24,9 @@ except:
     APEX_IMPORTED = False
 
 class BaseEngine():
+    # L2 normalize the retrieval features after the flip fusion
+    NORMALIZE_FEATURES = False
+
     def __init__(self, cfg, graph, loader, solvers, visualizer):
         self.cfg = cfg
         self.graph = graph       
@@ -35,20 +49,127 @@ class BaseEngine():
         self.test_loss = 0.0
         self.accu = 0.0
         self.save_criterion = cfg.MODEL.SAVE_CRITERION
-        if self.cfg.DISTRIBUTED:
+        if self.cfg.DISTRIBUTED and torch.cuda.is_available():
             self.device = torch.cuda.current_device()
         else:
             self.device = -1
+        if self.cfg.APEX and APEX_IMPORTED and cfg.SOLVER.PRECISION != 'fp32':
+            logger.info(f"Mixed precision is handled by apex, SOLVER.PRECISION {cfg.SOLVER.PRECISION} is ignored")
+            self.precision = Precision('fp32')
+        else:
+            self.precision = Precision(cfg.SOLVER.PRECISION, 'cuda' if self.use_gpu else 'cpu')
+        self.precision.keep_fp32(graph, cfg.SOLVER.FP32_MODULES)
+        self._autocast = None
+        self._no_sync = None
+        self._accum_first, self._accum_last, self._accum_size = True, True, 1
+        self.metrics = MetricLogger(visualizer if cfg.IO else None, cfg.LOG_PERIOD)
+        self._resume_state = None
+        self._resume_rng = None
+        self._saved_iter = -1
+        self.pipeline = None
+        if cfg.TIMING.ENABLED:
+            num_workers = getattr(self.tdata, 'num_workers', cfg.NUM_WORKERS)
+            hint = (f"The train loader has {num_workers} workers on {os.cpu_count()} CPUs, raise NUM_WORKERS while the CPUs "
+                    f"are not saturated, otherwise lighten the transforms '{cfg.DB.TRAIN_TRANSFORM}' or the decoding of the images")
+            self.pipeline = PipelineMeter(visualizer if cfg.IO else None, cfg.TIMING.PERIOD, cfg.TIMING.DATA_WAIT_WARN, hint, cfg.TIMING.SYNC)
+            self.pipeline.wrap(self, '_train_once', 'tdata')
+        if cfg.PROFILE.ENABLED:
+            # every engine loops over its loaders in these two methods
+            self.profiler = EngineProfiler(cfg, get_rank())
+            self.profiler.wrap(self, '_train_once', 'train', ['tdata'])
+            self.profiler.wrap(self, '_evaluate', 'eval', ['vdata', 'qdata', 'gdata'])
 
     def _start(self):
         logger.info("Training start")
         self.iter = (self.cfg.SOLVER.START_EPOCH - 1) * len(self.tdata)
         self.epoch = self.cfg.SOLVER.START_EPOCH - 1
+        if self._resume_state is not None:
+            self._resume(self._resume_state)
+            self._resume_state = None
+
+    def state_dict(self):
+        '''
+        Training state saved with the checkpoints, the position in the epoch, the history of the
+        lr schedulers, the loss scaler, the order of the training samples and the RNG states.
+        The RNG states are taken before the next batch is fetched by the main process, they
+        cover the model side randomness and the augmentations of the loader workers follow them.
+        '''
+        state = {
+            'epoch': self.epoch,
+            'iter': self.iter,
+            'loss': float(self.loss),
+            'best_accu': self.best_accu,
+            'min_loss': self.min_loss,
+            'schedulers': {},
+            'precision': self.precision.state_dict(),
+            'rng': rng_state(),
+        }
+        for name, solver in self.solvers.items():
+            if getattr(solver, 'scheduler', None) is not None:
+                state['schedulers'][name] = solver.scheduler.state_dict()
+        if self.tdata is not None and hasattr(self.tdata.sampler, 'state_dict'):
+            consumed = self.iter - (self.epoch - 1) * len(self.tdata)
+            state['sampler'] = self.tdata.sampler.state_dict(consumed * self.tdata.batch_size)
+        return state
+
+    def load_state_dict(self, state):
+        '''
+        The state is applied when the training starts, it takes over SOLVER.START_EPOCH
+        '''
+        self._resume_state = state
+
+    def _resume(self, state):
+        num_iters = len(self.tdata)
+        consumed = state['iter'] - (state['epoch'] - 1) * num_iters
+        self.iter = state['iter']
+        self.loss = state['loss']
+        self.best_accu = state['best_accu']
+        self.min_loss = state['min_loss']
+        for name, scheduler_state in state['schedulers'].items():
+            if name in self.solvers:
+                self.solvers[name].scheduler.load_state_dict(scheduler_state)
+        self.precision.load_state_dict(state['precision'])
+        if 0 < consumed < num_iters:
+            # _train_epoch_start enters the interrupted epoch again, the sampler skips the
+            # samples already consumed
+            self.epoch = state['epoch'] - 1
+            if 'sampler' in state and hasattr(self.tdata.sampler, 'load_state_dict'):
+                self.tdata.sampler.load_state_dict(state['sampler'])
+            logger.info(f"Resume epoch {state['epoch']} at iteration {consumed}/{num_iters}")
+            # restored by the first iteration, after the loader iterator drew its seeds as it
+            # had before the checkpoint
+            self._resume_rng = state['rng']
+        else:
+            self.epoch = state['epoch']
+            logger.info(f"Resume after epoch {state['epoch']}")
+            self._resume_rng = state['rng']
+            self._restore_rng()
+        self._saved_iter = self.iter
+
+    def _restore_rng(self):
+        if self._resume_rng is not None and is_main_process():
+            # the other ranks keep their own streams
+            set_rng_state(self._resume_rng)
+        self._resume_rng = None
+
+    def _save_progress(self):
+        '''
+        Checkpoint with the training state every CHECKPOINT.PERIOD iterations, between two
+        accumulation windows so that no gradient is pending
+        '''
+        period = self.cfg.CHECKPOINT.PERIOD
+        if period <= 0 or not (self.cfg.IO and self.cfg.SAVE):
+            return
+        if self.iter % period != 0 or self.iter == self._saved_iter or not self._accum_last:
+            return
+        self.graph.save_checkpoint(self.solvers, self.epoch, iteration=self.iter, train_state=self.state_dict())
+        self._saved_iter = self.iter
 
     def _train_epoch_start(self):
         self.epoch += 1
         logger.info(f"Epoch {self.epoch} start")
         self.graph.model.train() 
+        self.metrics.reset_epoch()
         if self.cfg.DISTRIBUTED:
             self.tdata.sampler.set_epoch(self.epoch)
         if len(self.graph.sub_models) > 0:
@@ -56,38 +177,91 @@ class BaseEngine():
                 self.graph.sub_models[sub_model].train()
   
     def _train_iter_start(self):
+        self._restore_rng()
+        self._save_progress()
         self.iter += 1
-        for solver in self.solvers:
-            self.solvers[solver].lr_adjust(self.loss, self.iter)
-            self.solvers[solver].zero_grad()
+        self._accum_first, self._accum_last, self._accum_size = self._accum_window()
+        if self._accum_first:
+            # the lr and the gradients change once per accumulation window
+            for solver in self.solvers:
+                self.solvers[solver].lr_adjust(self.loss, self.iter)
+                self.solvers[solver].zero_grad()
+            if self.cfg.SOLVER.ACCUM_STEPS > 1:
+                for crit in getattr(self.graph, 'crit', {}).values():
+                    if hasattr(crit, 'reset_memory'):
+                        crit.reset_memory()
+        no_sync = getattr(self.graph.parallel_model, 'no_sync', None)
+        if not self._accum_last and no_sync is not None:
+            # DDP all-reduces the gradients in the backward of the last micro-batch only
+            self._no_sync = no_sync()
+            self._no_sync.__enter__()
+        # the forward and the loss of the iteration run under autocast until _train_iter_end
+        self._autocast = self.precision.autocast()
+        self._autocast.__enter__()
 
-    def _train_iter_end(self): 
+    def _accum_window(self):
+        '''
+        Position of the current iteration in its gradient accumulation window, the last window
+        of an epoch is shorter if the number of iterations is not a multiple of ACCUM_STEPS
+
+        Returns:
+            first (bool): first micro-batch of the window
+            last (bool): last micro-batch of the window, the solvers step after it
+            size (int): number of micro-batches of the window
+        '''
+        accum_steps = self.cfg.SOLVER.ACCUM_STEPS
+        if accum_steps <= 1:
+            return True, True, 1
+        num_iters = len(self.tdata)
+        pos = (self.iter - 1) % num_iters
+        start = pos - pos % accum_steps
+        size = min(accum_steps, num_iters - start)
+        return pos == start, pos == start + size - 1, size
+
+    def _exit_autocast(self):
+        if self._autocast is not None:
+            self._autocast.__exit__(None, None, None)
+            self._autocast = None
+
+    def _backward(self):
+        if self.pipeline is not None:
+            self.pipeline.phase('forward')
+        self._exit_autocast()
+        # the gradients of the window sum up to the gradient of the mean loss
+        loss = self.loss / self._accum_size if self._accum_size > 1 else self.loss
         if self.cfg.APEX and APEX_IMPORTED:
-            with amp.scale_loss(self.loss, self.solvers['main'].opt) as scaled_loss:
+            with amp.scale_loss(loss, self.solvers['main'].opt) as scaled_loss:
                 scaled_loss.backward()  
         else:       
-            self.loss.backward() 
-        for solver in self.solvers:
-            self.solvers[solver].step()
+            self.precision.backward(loss)
+        if self._no_sync is not None:
+            self._no_sync.__exit__(None, None, None)
+            self._no_sync = None
+        if self.pipeline is not None:
+            self.pipeline.phase('backward')
 
-        if self.cfg.DISTRIBUTED:
-            dist.all_reduce(self.loss)
-            self.loss.detach_()
-            self.loss.div_(dist.get_world_size())
-            for loss in self.losses:
-                self.losses[loss].detach_()
-                dist.all_reduce(self.losses[loss])
-                self.losses[loss].div_(dist.get_world_size())
-
-        self.loss = self.tensor_to_scalar(self.loss)
-        self.losses = self.tensor_to_scalar(self.losses)     
-        if self.cfg.IO:
-            self.visualizer.add_scalar('train/loss', self.loss, self.iter)              
-            for loss in self.losses:
-                self.visualizer.add_scalar(f'train/loss/{loss}', self.losses[loss], self.iter)
-            self.visualizer.add_scalar('train/accuracy', self.train_accu, self.iter)   
+    def _train_iter_end(self): 
+        self._backward()
+        if self._accum_last:
+            for solver in self.solvers:
+                self.precision.step(self.solvers[solver])
+            self.precision.update()
+        self._log_iter()
+
+    def _log_iter(self):
+        '''
+        Accumulate the losses on the device, they are synced to the host, averaged over the
+        ranks and written every cfg.LOG_PERIOD iterations
+        '''
+        self.metrics.update('train/loss', self.loss)
+        for loss in self.losses:
+            self.metrics.update(f'train/loss/{loss}', self.losses[loss])
+        if self.metrics.step(self.iter) and self.cfg.IO:
             for solver in self.solvers:
                 self.visualizer.add_scalar(f'train/solver/{solver}/lr', self.solvers[solver].monitor_lr, self.iter)
+        # the last synced values, e.g. for the plateau lr policy
+        self.loss = self.metrics.values.get('train/loss', 1e5)
+        self.losses = {loss: self.metrics.values.get(f'train/loss/{loss}', 0.0) for loss in self.losses}
 
     def _train_epoch_end(self):        
         logger.info(f"Epoch {self.epoch} training ends, accuracy {self.train_accu:.4f}")
@@ -106,19 +280,21 @@ class BaseEngine():
             if self.save_criterion == 'loss':
                 logger.info(f"Epoch {self.epoch} evaluation ends, loss {self.test_loss:.4f}")
                 if self.min_loss > self.test_loss:
-                    if self.cfg.SAVE:
-                        logger.info(f"Save checkpoint, with {self.min_loss - self.test_loss:.4f} improvement")
-                        self.graph.save(self.graph.save_path, self.graph.model, self.graph.sub_models, self.solvers, self.epoch, self.min_loss)
+                    logger.info(f"Best checkpoint, with {self.min_loss - self.test_loss:.4f} improvement")
                     self.min_loss = self.test_loss
+                metric = self.test_loss
                 self.visualizer.add_scalar('val/loss', self.test_loss, self.epoch)
             else:
                 logger.info(f"Epoch {self.epoch} evaluation ends, accuracy {self.accu:.4f}")
                 if self.accu > self.best_accu:
-                    if self.cfg.SAVE:
-                        logger.info(f"Save checkpoint, with {self.accu - self.best_accu:.4f} improvement")
-                        self.graph.save(self.graph.save_path, self.graph.model, self.graph.sub_models, self.solvers, self.epoch, self.accu)                    
+                    logger.info(f"Best checkpoint, with {self.accu - self.best_accu:.4f} improvement")
                     self.best_accu = self.accu
+                metric = self.accu
                 self.visualizer.add_scalar('val/accuracy', self.accu, self.epoch)
+            if self.cfg.SAVE:
+                # the checkpointer keeps the last and the best ones by the metric
+                self.graph.save_checkpoint(self.solvers, self.epoch, metric, train_state=self.state_dict())
+                self._saved_iter = self.iter
 
     def _train_once(self):
         raise NotImplementedError
@@ -128,19 +304,21 @@ class BaseEngine():
         while self.epoch < self.max_epoch:
             self._train_epoch_start()
             self._train_once()
+            # the last partial window of the epoch
+            self.metrics.step(self.iter, force=True)
             self._train_epoch_end()
             
             if self.epoch % self.cfg.EVALUATE_FREQ == 0:
-                if self.cfg.DISTRIBUTED:
-                    if dist.get_rank() == 0:
-                        self._evaluate()
-                else:
-                    self._evaluate()
+                # every rank evaluates its shard of the test loaders, rank 0 computes the metrics
+                self._evaluate()
 
             if self.cfg.SOLVER.LR_POLICY == 'plateau' and self.cfg.SOLVER.MIN_LR >= self.solvers['model'].monitor_lr:
                 logger.info(f"LR {self.solvers['model'].monitor_lr} is less than {self.cfg.SOLVER.MIN_LR}")
                 break
         logger.info(f"Best accuracy {self.best_accu:.2f}")
+        if self.cfg.IO:
+            self.visualizer.flush()
+            self.graph.checkpointer.wait()
 
     def Inference(self):
         raise NotImplementedError
@@ -148,6 +326,142 @@ class BaseEngine():
     def _evaluate(self):
         raise NotImplementedError        
 
+    def _forward_features(self, imgs):
+        '''
+        Embeddings of a batch of images used for retrieval, e.g. the 'neck' of trick_reid,
+        normalized afterwards if NORMALIZE_FEATURES
+        '''
+        raise NotImplementedError
+
+    def _extract_features(self, loader, title, name):
+        '''
+        Run _forward_features over a query / gallery loader and write the results into a
+        FeatureStore of cfg.REID.FEATURE_DTYPE, memory-mapped under cfg.REID.FEATURE_DIR if set.
+
+        Args:
+            name (str): 'query' or 'gallery', the sub-directory of the memory-mapped files
+        '''
+        cache_path = self._feature_cache_path(loader, name) if self.cfg.REID.CACHE and self.cfg.EVALUATE else ""
+        # all the ranks have to agree, a miss on one of them means extracting on every rank
+        if cache_path and all(all_gather_object(os.path.exists(cache_path))):
+            logger.info(f"Feature cache hit, load {name} features from {cache_path}")
+            return FeatureStore.load(cache_path)
+
+        sharded = self._is_sharded(loader)
+        path = os.path.join(self.cfg.REID.FEATURE_DIR, name) if self.cfg.REID.FEATURE_DIR else ""
+        # dataset indices of the samples in the order of the loader
+        indices = list(loader.sampler) if sharded else range(len(loader.dataset))
+        indice = loader.dataset.data['indice'] if hasattr(loader.dataset, 'data') else None
+        store = None
+        for batch in tqdm(loader, desc=title):
+            imgs = batch['inp']
+            if self.cfg.DISTRIBUTED:
+                imgs = imgs.to(self.device, non_blocking=True) if self.use_gpu else imgs
+            elif self.use_gpu:
+                imgs = imgs.cuda()
+            if self.cfg.REID.FLIP_TTA:
+                # the flipped copies of the decoded batch, the loader cost is not doubled
+                if self.cfg.REID.FLIP_TTA_ONE_FORWARD:
+                    features = self._fuse_flip(*self._forward_features(torch.cat([imgs, imgs.flip(3)])).chunk(2))
+                else:
+                    features = self._fuse_flip(self._forward_features(imgs), self._forward_features(imgs.flip(3)))
+            else:
+                features = self._forward_features(imgs)
+            if self.NORMALIZE_FEATURES:
+                features = F.normalize(features)
+            if store is None:
+                if sharded:
+                    # the shard of this rank is kept in memory until the gathering
+                    store = FeatureStore(len(indices), features.size(1), self.cfg.REID.FEATURE_DTYPE)
+                else:
+                    store = FeatureStore(len(loader.dataset), features.size(1), self.cfg.REID.FEATURE_DTYPE, path)
+            paths = [indice[i][0] for i in indices[len(store):len(store) + features.size(0)]] if indice is not None else None
+            store.append(features, batch['pid'], batch['camid'], paths)
+        if sharded:
+            store = self._gather_store(store, loader, indices, path)
+        if cache_path and is_main_process():
+            store.save_atomic(cache_path)
+            logger.info(f"Feature cache miss, save {name} features to {cache_path}")
+        return store
+
+    def _is_sharded(self, loader):
+        return isinstance(loader.sampler, distributed.DistributedSampler)
+
+    def _gather_store(self, store, loader, indices, path):
+        '''
+        Gather the shards of a FeatureStore from all the ranks into a store in the order of the
+        dataset, on every rank. The codes are gathered as stored, float16 and int8 shards are
+        not decoded to float32.
+        '''
+        num_samples = len(loader.dataset)
+        indice = loader.dataset.data['indice'] if hasattr(loader.dataset, 'data') else None
+        data, scales = store.encoded()
+        data = gather_by_index(torch.from_numpy(np.ascontiguousarray(data)), indices, num_samples)
+        if store.dtype == 'int8':
+            scales = gather_by_index(torch.from_numpy(np.ascontiguousarray(scales)), indices, num_samples).numpy()
+        pids = gather_by_index(torch.from_numpy(store.pids.copy()), indices, num_samples)
+        camids = gather_by_index(torch.from_numpy(store.camids.copy()), indices, num_samples)
+        full_store = FeatureStore(num_samples, store.dim, store.dtype, path if is_main_process() else "")
+        paths = [sample[0] for sample in indice] if indice is not None else None
+        full_store.append_encoded(data.numpy(), scales, pids, camids, paths)
+        return full_store
+
+    def _gather_results(self, results):
+        '''
+        Merge the per-image results (dict) of all the ranks in rank order, the images repeated
+        by the padding of DistributedSampler are kept once. The results must be keyed by int
+        image ids, tensors hash by identity and the repeated images would be kept twice.
+        '''
+        if not self._is_sharded(self.vdata):
+            return results
+        merged = {}
+        for rank_results in all_gather_object(results):
+            merged.update(rank_results)
+        return merged
+
+    def _fuse_flip(self, features, flipped_features):
+        if self.cfg.REID.FLIP_TTA == 'mean':
+            return (features + flipped_features) / 2
+        elif self.cfg.REID.FLIP_TTA == 'concat':
+            return torch.cat([features, flipped_features], 1)
+        raise ValueError(f"Unknown flip fusion {self.cfg.REID.FLIP_TTA}")
+
+    def _feature_cache_fields(self, loader):
+        '''
+        Everything the extracted features depend on: the checkpoint content, the dataset and 
+        the test transform, and the engine which defines _forward_features
+        '''
+        indice = loader.dataset.data['indice'] if hasattr(loader.dataset, 'data') else []
+        samples = json.dumps([[str(i) for i in sample] for sample in indice])
+        return {
+            'engine': type(self).__name__,
+            'checkpoint': model_digest(self.graph.model),
+            'data': self.cfg.DB.DATA,
+            'samples': cache_key({'samples': samples, 'num_samples': len(loader.dataset)}),
+            'transform': self.cfg.DB.TEST_TRANSFORM,
+            'size': list(self.cfg.INPUT.SIZE),
+            'mean': list(self.cfg.INPUT.MEAN),
+            'std': list(self.cfg.INPUT.STD),
+            'dtype': self.cfg.REID.FEATURE_DTYPE,
+            'flip': self.cfg.REID.FLIP_TTA,
+        }
+
+    def _feature_cache_path(self, loader, name):
+        root = self.cfg.REID.CACHE_DIR if self.cfg.REID.CACHE_DIR else os.path.join(self.cfg.OUTPUT_DIR, "feature_cache")
+        return os.path.join(root, cache_key(self._feature_cache_fields(loader)), name)
+
+    def _re_ranking(self, qf, gf):
+        '''
+        Returns:
+            distmat (numpy.ndarray): num_q x num_g k-reciprocal re-ranked distances
+        '''
+        logger.info("Re-ranking with k-reciprocal encoding")
+        return sparse_re_ranking(qf, gf, 
+            k1=self.cfg.REID.RERANK_K1, 
+            k2=self.cfg.REID.RERANK_K2, 
+            lambda_value=self.cfg.REID.RERANK_LAMBDA, 
+            num_workers=self.cfg.REID.RERANK_WORKERS)
+
     @staticmethod
     def tensor_to_scalar(tensor):
         if isinstance(tensor, list):
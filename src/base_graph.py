@@ -9,6 +9,10 @@ logger = logging.getLogger("logger")
 from tools import bcolors
 from copy import deepcopy
 from src.factory.transform_factory import TransformFactory
+from tools.fuse_utils import fuse_model, verify_fusion
+from tools.checkpoint_utils import CheckpointManager, atomic_save, checkpoint_name
+from tools.recompute_utils import checkpoint_modules
+from tools.centernet_utils import centernet_tiled_det_inference
 
 try:
     from apex.parallel import DistributedDataParallel as DDP
@@ -36,12 +40,15 @@ class BaseGraph:
         self.use_half = False
         self.use_gpu = False
         self.sub_models = {}
+        self.checkpointer = None
         self.inference_trans = None
         self.torchscript_model = None
         
         if self.cfg.IO:
             self.set_save_path()
         self.build()
+        if self.cfg.MODEL.ACTIVATION_CHECKPOINT:
+            checkpoint_modules(self.model, self.cfg.MODEL.ACTIVATION_CHECKPOINT)
         if self.cfg.DISTRIBUTED:
             self.syncbn()
 
@@ -78,9 +85,42 @@ class BaseGraph:
             else:
                 return self.model(x, *args, **kwargs)
         
-        
+
+    def tiled_inference(self, img, K=100, thresh=0.05, nms_thresh=0.5):
+        '''
+        Tiled inference of CenterNet-style detection graphs for frames much larger than 
+        cfg.INPUT.SIZE, see DEPLOY.TILE_* in config
+
+        Args:
+            img (numpy.ndarray): HxWx3 RGB frame
+
+        Returns:
+            dets (numpy.ndarray): Nx6, [x1, y1, x2, y2, score, class] in frame coordinates
+        '''
+        mean, std = self.cfg.INPUT.MEAN, self.cfg.INPUT.STD
+        def preprocess(tile):
+            x = torch.from_numpy(tile).permute(2, 0, 1).float() / 255.0
+            if len(mean) > 0:
+                x = (x - torch.tensor(mean).view(-1, 1, 1)) / torch.tensor(std).view(-1, 1, 1)
+            return x
+        tile_size = tuple(self.cfg.DEPLOY.TILE_SIZE) if min(self.cfg.DEPLOY.TILE_SIZE) > 0 else None
+
+        self.model.eval()
+        return centernet_tiled_det_inference(
+            self.model,
+            img,
+            self.cfg.INPUT.SIZE,
+            tile_size=tile_size,
+            overlap=self.cfg.DEPLOY.TILE_OVERLAP,
+            tile_bs=self.cfg.DEPLOY.TILE_BS,
+            preprocess=preprocess,
+            K=K,
+            thresh=thresh,
+            nms_thresh=nms_thresh
+        )
+
     @staticmethod
-    def save(path, model, sub_models=None, solvers=None, epoch=-1,  metric=-1):
+    def checkpoint_state(model, sub_models=None, solvers=None):
         state = {}
         if solvers is not None:
             assert isinstance(solvers, dict)
@@ -96,8 +136,26 @@ class BaseGraph:
             for sub_model in sub_models:
                 sub_model_state = sub_models[sub_model].state_dict()
                 state[f"{sub_model}"] = sub_model_state
+        return state
 
-        torch.save(state, os.path.join(path,'model_{:03}_{:.4f}.pth'.format(epoch, metric)))
+    @staticmethod
+    def save(path, model, sub_models=None, solvers=None, epoch=-1,  metric=-1):
+        state = BaseGraph.checkpoint_state(model, sub_models, solvers)
+        atomic_save(state, os.path.join(path, checkpoint_name(epoch, metric)))
+
+    def save_checkpoint(self, solvers=None, epoch=-1, metric=None, iteration=None, train_state=None):
+        '''
+        Save through the checkpointer of the run, the state is copied to CPU and written in the
+        background, then the checkpoints out of the retention policy are removed
+
+        Args:
+            metric (float): None in the middle of an epoch, the checkpoint is named by iteration
+            train_state (dict): BaseEngine.state_dict, to resume the run where it stopped
+        '''
+        state = self.checkpoint_state(self.model, self.sub_models, solvers)
+        if train_state is not None:
+            state['train_state'] = train_state
+        return self.checkpointer.save(state, epoch, metric, iteration)
 
     def load(self, path, model=None, sub_models=None, solvers=None): 
         if not model:
@@ -132,6 +190,7 @@ class BaseGraph:
                 for solver in solvers:
                     if f"{solver}" in state:
                         solvers[solver].opt.load_state_dict(state[f"{solver}"])
+        return state
 
     def _initialize_weights(self):
         for m in self.model.modules():
@@ -202,6 +261,13 @@ class BaseGraph:
         self.save_path = os.path.join(self.cfg.OUTPUT_DIR, 'weights')
         if not os.path.exists(self.save_path):
             os.mkdir(self.save_path)
+        self.checkpointer = CheckpointManager(
+            self.save_path,
+            keep_last=self.cfg.CHECKPOINT.KEEP_LAST,
+            keep_best=self.cfg.CHECKPOINT.KEEP_BEST,
+            mode='min' if self.cfg.MODEL.SAVE_CRITERION == 'loss' else 'max',
+            async_save=self.cfg.CHECKPOINT.ASYNC
+        )
 
     def check_size(self, insize):
         def check_size_hooker(m, inp, out):
@@ -280,6 +346,37 @@ class BaseGraph:
             else:
                 logger.info("Model Loaded Successfully")
         
+    def fuse(self, insize=None, verify=True, atol=1e-3):
+        '''
+        Fold BatchNorm into convolutions (and merge conv-bn-relu) for inference, must be
+        called after the weights are loaded. The fused model can not be trained anymore.
+
+        Args:
+            insize (tuple): size of the dummy input, default is (1, 3, h, w) of cfg.INPUT.SIZE
+            verify (bool): compare the outputs with the model before fusion, the model before
+                           fusion is restored if they differ
+            atol (float): tolerance of the verification
+        '''
+        if insize is None:
+            w, h = self.cfg.INPUT.SIZE
+            insize = (1, 3, h, w)
+        weight = next(iter(self.model.parameters()))
+        dummy_input = torch.rand(insize, device=weight.device, dtype=weight.dtype)
+        if verify:
+            reference = deepcopy(self.model).eval()
+        self.model, num_fused = fuse_model(self.model, dummy_input, fuse_relu=self.cfg.DEPLOY.FUSE_RELU)
+        logger.info(f"Fused {num_fused} Conv-BN pairs")
+        if verify:
+            is_equal, max_diff = verify_fusion(reference, self.model, dummy_input, atol=atol)
+            if is_equal:
+                logger.info(f"Fused model verified, max difference {max_diff:.2e}")
+            else:
+                # the original model is kept, a wrong fused model must not be evaluated or exported
+                logger.info(f"{bcolors.WARNING}Fused model differs from the original one, max difference {max_diff:.2e}, "
+                            f"keep the model unfused{bcolors.RESET}")
+                self.model = reference
+            del reference
+
     def to_torchscript(self, shape, load_path="", model=None, save_path=""):
         if model is None:
             assert self.torchscript_model is not None, "Trochscript Model does not exist!"
@@ -10,6 +10,7 @@ from src.solver.solver import Solver
 from src.factory.engine_factory import EngineFactory
 from tools.tensorboard import Tensorboard
 from tools.utils import print_config
+from tools.checkpoint_utils import latest_checkpoint
 try:
     from apex import amp
     APEX_IMPORTED = True
@@ -27,11 +28,14 @@ class BaseTrainer():
         self.acc = 0.0
         self.solvers = {}          
         self.visualizer = None
+        self.train_state = None
         if cfg.IO:
             self.visualizer = Tensorboard(cfg)        
         
     def activate(self):
         self.resume()
+        if self.cfg.EVALUATE and self.cfg.DEPLOY.FUSE:
+            self.graph.fuse()
         if self.cfg.APEX and APEX_IMPORTED:
             self.graph.model, self.solvers['main'].opt = amp.initialize(
                 self.graph.model, 
@@ -44,6 +48,8 @@ class BaseTrainer():
         self.engine = EngineFactory.produce(
             self.cfg, self.graph, self.loader, self.solvers, self.visualizer
         )
+        if self.train_state is not None:
+            self.engine.load_state_dict(self.train_state)
         if self.cfg.IO:
             print_config(self.cfg)        
     
@@ -56,9 +62,17 @@ class BaseTrainer():
         self.acc = self.engine.accu
 
     def resume(self):
-        if self.cfg.RESUME:
-            logger.info("Resuming from {}".format(self.cfg.RESUME))
-            self.graph.load(self.cfg.RESUME, solvers=self.solvers)
+        path = self.cfg.RESUME
+        if path and os.path.isdir(path):
+            # the latest checkpoint of a weights directory
+            path = latest_checkpoint(path)
+            if not path:
+                logger.info("No checkpoint in {}".format(self.cfg.RESUME))
+        if path:
+            logger.info("Resuming from {}".format(path))
+            state = self.graph.load(path, solvers=self.solvers)
+            if not self.cfg.PRETRAIN and 'train_state' in state:
+                self.train_state = state['train_state']
         else:
             logger.info("Training model from scratch")
     
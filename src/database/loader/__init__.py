@@ -9,4 +9,5 @@ import torch.nn.functional as F
 from src.factory.data_factory import DataFactory
 from src.factory.data_format_factory import DataFormatFactory
 from src.factory.transform_factory import TransformFactory
-from torch.utils.data import DataLoader, distributed
+from torch.utils.data import DataLoader, RandomSampler, distributed
+from src.database.sampler.sampler import ResumableSampler
@@ -1,4 +1,5 @@
 from src.database.loader import *
+from tools.dist_utils import test_sampler
 import os.path as osp
 
 def build_classification_loader(
@@ -19,15 +20,15 @@ def build_classification_loader(
         if cfg.DISTRIBUTED:
             sampler = distributed.DistributedSampler(train_dataset)
         else:
-            sampler = None
+            sampler = RandomSampler(train_dataset)
         loader['train'] = DataLoader(
             train_dataset, 
             batch_size=train_batch_size, 
-            shuffle=True if sampler is None else False, 
+            shuffle=False, 
             num_workers=num_workers, 
             pin_memory=False,
             drop_last=True, 
-            sampler=sampler,
+            sampler=ResumableSampler(sampler),
         )
     if use_test:
         val_trans = TransformFactory.produce(cfg, test_transformation)
@@ -38,7 +39,8 @@ def build_classification_loader(
             shuffle=False, 
             num_workers=num_workers, 
             pin_memory=False,
-            drop_last=False
+            drop_last=False,
+            sampler=test_sampler(cfg, val_dataset),
         )
 
     return loader
\ No newline at end of file
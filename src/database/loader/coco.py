@@ -1,5 +1,6 @@
 from functools import partial
 from src.database.loader import *
+from tools.dist_utils import test_sampler
 from src.base_data import BaseData
 from tools.centerface_utils import centerface_facial_target, centerface_bbox_target
 from tools.centernet_utils import centernet_keypoints_target, centernet_bbox_target
@@ -87,16 +88,16 @@ def build_coco_loader(
         if cfg.DISTRIBUTED:
             sampler = distributed.DistributedSampler(train_dataset)
         else:
-            sampler = None
+            sampler = RandomSampler(train_dataset)
         loader['train'] = DataLoader(
             train_dataset, 
             batch_size=train_batch_size, 
-            shuffle=True if sampler is None else False, 
+            shuffle=False, 
             num_workers=num_workers, 
             pin_memory=False,
             drop_last=True,
             collate_fn=default_collate,
-            sampler=sampler,
+            sampler=ResumableSampler(sampler),
         )
     if use_test:
         data = DataFactory.produce(cfg, branch=test_data_name, use_train=False) 
@@ -115,6 +116,7 @@ def build_coco_loader(
             pin_memory=False, 
             drop_last=False,
             collate_fn=default_collate,
+            sampler=test_sampler(cfg, val_dataset),
         ) 
     return loader
 
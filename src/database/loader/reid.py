@@ -1,6 +1,7 @@
 from src.database.loader import *
 from src.base_data import BaseData
 from src.database.sampler.sampler import IdBasedSampler, IdBasedDistributedSampler
+from tools.dist_utils import test_sampler
 
 def build_reid_loader(
     cfg, 
@@ -57,7 +58,7 @@ def build_reid_loader(
             loader['train'] = DataLoader(
                 train_dataset, 
                 batch_size=train_batch_size, 
-                sampler=sampler, 
+                sampler=ResumableSampler(sampler), 
                 num_workers=num_workers, 
                 pin_memory=False, 
                 drop_last=True
@@ -66,7 +67,7 @@ def build_reid_loader(
             loader['train'] = DataLoader(
                 train_dataset, 
                 batch_size=train_batch_size, 
-                shuffle=True, 
+                sampler=ResumableSampler(RandomSampler(train_dataset)), 
                 num_workers=num_workers, 
                 pin_memory=False, 
                 drop_last=True
@@ -82,12 +83,14 @@ def build_reid_loader(
                                     shuffle=False, 
                                     num_workers=num_workers, 
                                     pin_memory=False, 
-                                    drop_last=False)
+                                    drop_last=False, 
+                                    sampler=test_sampler(cfg, query_dataset))
         loader['gallery'] = DataLoader(gallery_dataset, 
                                     batch_size=test_batch_size, 
                                     shuffle=False, 
                                     num_workers=num_workers, 
                                     pin_memory=False, 
-                                    drop_last=False)
+                                    drop_last=False, 
+                                    sampler=test_sampler(cfg, gallery_dataset))
 
     return loader
\ No newline at end of file
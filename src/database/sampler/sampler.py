@@ -1,4 +1,5 @@
 import random
+import torch
 
 from torch.utils.data import dataset, sampler
 import torch.distributed as dist
@@ -89,7 +90,7 @@ class IdBasedDistributedSampler(sampler.Sampler):
         _ = self._build()
 
     def __iter__(self):
-        final_idxs = np.array(self._build()).reshape(-1,4)
+        final_idxs = np.array(self._build()).reshape(-1,self.num_instances)
         rank = dist.get_rank()
         num_replica = dist.get_world_size()
         num_sample = len(final_idxs) // num_replica
@@ -98,7 +99,8 @@ class IdBasedDistributedSampler(sampler.Sampler):
         return iter(final_idxs)
 
     def __len__(self):
-        return self.length // dist.get_world_size
+        num_groups = self.length // self.num_instances // dist.get_world_size()
+        return num_groups * self.num_instances
     
     def set_epoch(self, epoch):
         self.epoch = epoch
@@ -133,6 +135,48 @@ class IdBasedDistributedSampler(sampler.Sampler):
         self.length = len(final_idxs)
         return final_idxs
 
+class ResumableSampler(sampler.Sampler):
+    """
+    Wrap a sampler to resume an epoch where it was interrupted. The indices of the current
+    epoch are kept, and once a state is loaded the next epoch yields only the indices that
+    were not consumed yet, so the dataset never decodes the skipped samples.
+
+    The samplers with set_epoch (e.g. IdBasedDistributedSampler, DistributedSampler) are seeded
+    by the epoch, so their order is rebuilt instead of saved, it also differs between ranks.
+    Args:
+    - sampler (Sampler): sampler of the training loader.
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.deterministic = hasattr(sampler, 'set_epoch')
+        self.indices = []
+        self.start = 0
+
+    def __iter__(self):
+        resumed = self.start > 0 and not self.deterministic and self.indices
+        if not resumed:
+            self.indices = [int(i) for i in self.sampler]
+        start, self.start = self.start, 0
+        return iter(self.indices[start:])
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def set_epoch(self, epoch):
+        if self.deterministic:
+            self.sampler.set_epoch(epoch)
+
+    def state_dict(self, num_consumed):
+        state = {'start': num_consumed}
+        if not self.deterministic:
+            state['indices'] = torch.tensor(self.indices, dtype=torch.long)
+        return state
+
+    def load_state_dict(self, state):
+        self.start = state['start']
+        self.indices = state['indices'].tolist() if 'indices' in state else []
+
 class BlancedPARSampler(sampler.Sampler):
     def __init__(self, data_source):
         self.data_source = data_source
@@ -8,6 +8,7 @@ import torch.nn.functional as F
 
 import os
 from src.base_engine import BaseEngine
+from tools.dist_utils import is_main_process, gather_by_index
 import numpy as np
 import logging
 logger = logging.getLogger("logger")
\ No newline at end of file
@@ -6,7 +6,6 @@ class ClassificationEngine(BaseEngine):
         super(ClassificationEngine, self).__init__(cfg, graph, loader, solvers, visualizer)
     
     def _train_once(self):
-        accus = []   
         for batch in tqdm(self.tdata, desc=f"TRAIN[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"):
             self._train_iter_start()
             if self.use_gpu:
@@ -17,17 +16,15 @@ class ClassificationEngine(BaseEngine):
                         batch[key] = batch[key].cuda()
             output = self.graph.run(batch['inp']) 
             self.loss, self.losses = self.graph.loss_head(output, batch)
-            accu = (output.max(1)[1] == batch['target']).float().mean()
-            accus.append(accu)        
-            self.train_accu = self.tensor_to_scalar(accu)
+            self.metrics.update('train/accuracy', (output.max(1)[1] == batch['target']).float().mean())
             self._train_iter_end()    
 
-        self.train_accu = self.tensor_to_scalar(torch.stack(accus).mean())
+        self.train_accu = self.metrics.epoch_mean('train/accuracy')
         
     def _evaluate(self, eval=False):
         logger.info("Epoch {} evaluation start".format(self.epoch))
         title = "EVALUATE" if eval else f"TEST[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"
-        accus = []        
+        corrects = []        
         with torch.no_grad():
             self._eval_epoch_start()
             for batch in tqdm(self.vdata, desc=title): 
@@ -38,9 +35,14 @@ class ClassificationEngine(BaseEngine):
                         else:
                             batch[key] = batch[key].cuda()
                 output = self.graph.run(batch['inp']) 
-                accus.append((output.max(1)[1] == batch['target']).float().mean())
-          
-        self.accu = self.tensor_to_scalar(torch.stack(accus).mean())    
+                corrects.append((output.max(1)[1] == batch['target']).float())
+
+        corrects = torch.cat(corrects)
+        if self._is_sharded(self.vdata):
+            corrects = gather_by_index(corrects, list(self.vdata.sampler), len(self.vdata.dataset))
+        if not is_main_process():
+            return
+        self.accu = self.tensor_to_scalar(corrects.mean())    
 
         if not eval:
             self._eval_epoch_end()        
@@ -78,7 +78,7 @@ class CenterKPEngine(BaseEngine):
                 dets = dets.detach().cpu().numpy().reshape(1, -1, dets.shape[2])                    
                 dets_out = centernet_pose_post_process(dets.copy(), batch['c'].cpu().numpy(), batch['s'].cpu().numpy(),
                                                    feat['hm'].shape[2], feat['hm'].shape[3], feat['hm'].shape[1])
-                results[batch['img_id'][0]] = dets_out[0]
+                results[int(batch['img_id'][0])] = dets_out[0]
 
         if self.cfg.DB.NUM_KEYPOINTS == 17:
             cce, cce_kp = coco_eval(Personeval, self.vdata.dataset.coco, results, self.cfg.OUTPUT_DIR)  
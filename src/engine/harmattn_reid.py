@@ -9,6 +9,8 @@ class HarmAttnReIDEngine(BaseEngine):
     def __init__(self, cfg, graph, loader, solvers, visualizer):
         super(HarmAttnReIDEngine, self).__init__(cfg, graph, loader, solvers, visualizer)
         self.swag_model = SWAG(deepcopy(self.graph.model), K=cfg.SOLVER.SWAG_RANK)
+        # _forward_features runs the SWAG model during _swag_evaluate
+        self.swag_features = False
     
     def _train_epoch_end(self):        
         logger.info(f"Epoch {self.epoch} training ends, accuracy {self.train_accu:.4f}")
@@ -22,7 +24,6 @@ class HarmAttnReIDEngine(BaseEngine):
             self._swag_evaluate()
 
     def _train_once(self):
-        accus = []   
         for batch in tqdm(self.tdata, desc=f"TRAIN[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"):
             self._train_iter_start()
             if self.use_gpu:
@@ -30,44 +31,37 @@ class HarmAttnReIDEngine(BaseEngine):
                     batch[key] = batch[key].cuda()
             outputs = self.graph.run(batch['inp']) 
             self.loss, self.losses = self.graph.loss_head(outputs, batch)
-            accus.append((outputs['g_id'].max(1)[1] == batch['pid']).float().mean())        
+            self.metrics.update('train/accuracy', (outputs['g_id'].max(1)[1] == batch['pid']).float().mean())
             self._train_iter_end()
 
-        self.train_accu = self.tensor_to_scalar(torch.stack(accus).mean())
+        self.train_accu = self.metrics.epoch_mean('train/accuracy')
+
+    def _forward_features(self, imgs):
+        if self.swag_features:
+            return self.swag_model(imgs)['embb']
+        return self.graph.run(imgs)['embb']
 
     def _evaluate(self, eval=False):
         logger.info("Epoch {} evaluation start".format(self.epoch))
         title = "EVALUATE" if eval else f"TEST[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"
         with torch.no_grad():
             self._eval_epoch_start()
-            qf, q_pids, q_camids = [], [], []
-            for batch in tqdm(self.qdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                features = self.graph.run(imgs.cuda() if self.use_gpu else imgs)['embb']
-                qf.append(features.cpu())
-                q_pids.extend(pids)
-                q_camids.extend(camids)
-
-            qf = torch.cat(qf, 0)
-            q_pids = np.asarray(q_pids)
-            q_camids = np.asarray(q_camids)
+            qstore = self._extract_features(self.qdata, title, "query")
+            qf, q_pids, q_camids = qstore.features(), qstore.pids, qstore.camids
             logger.info("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
 
-            gf, g_pids, g_camids = [], [], []
-            for batch in tqdm(self.gdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                features = self.graph.run(imgs.cuda() if self.use_gpu else imgs)['embb']
-                gf.append(features.cpu())
-                g_pids.extend(pids)
-                g_camids.extend(camids)
+            gstore = self._extract_features(self.gdata, title, "gallery")
+            g_pids, g_camids = gstore.pids, gstore.camids
+            logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(len(gstore), gstore.dim))
 
-            gf = torch.cat(gf, 0)
-            g_pids = np.asarray(g_pids)
-            g_camids = np.asarray(g_camids)
-            logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
+        if not is_main_process():
+            return
 
-        distmat =  self._euclidean_dist(qf, gf)
-        distmat = distmat.numpy()
+        if self.cfg.REID.RERANK:
+            distmat = self._re_ranking(qf, gstore)
+        else:
+            # tile by tile on the stored values, the gallery store is not decoded
+            distmat = gstore.distance_matrix(qf, 'euclidean', tile=self.cfg.REID.EVAL_TILE[1])
 
         logger.info("Computing CMC and mAP")
         cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
@@ -97,41 +91,29 @@ class HarmAttnReIDEngine(BaseEngine):
             self.accu = mAP
             self._eval_epoch_end()
 
-        del qf, gf, distmat
+        del qf, qstore, gstore, distmat
         
     def _swag_evaluate(self, eval=False):
         logger.info("Epoch {} SWAG evaluation start".format(self.epoch))
         title = "EVALUATE" if eval else f"TEST[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"
         with torch.no_grad():
             self._eval_epoch_start()
-            qf, q_pids, q_camids = [], [], []
-            for batch in tqdm(self.qdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                features = self.swag_model(imgs.cuda() if self.use_gpu else imgs)['embb']
-                qf.append(features.cpu())
-                q_pids.extend(pids)
-                q_camids.extend(camids)
-
-            qf = torch.cat(qf, 0)
-            q_pids = np.asarray(q_pids)
-            q_camids = np.asarray(q_camids)
-            logger.info("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
+            self.swag_features = True
+            try:
+                qstore = self._extract_features(self.qdata, title, "query")
+                qf, q_pids, q_camids = qstore.features(), qstore.pids, qstore.camids
+                logger.info("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
 
-            gf, g_pids, g_camids = [], [], []
-            for batch in tqdm(self.gdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                features = self.swag_model(imgs.cuda() if self.use_gpu else imgs)['embb']
-                gf.append(features.cpu())
-                g_pids.extend(pids)
-                g_camids.extend(camids)
+                gstore = self._extract_features(self.gdata, title, "gallery")
+                g_pids, g_camids = gstore.pids, gstore.camids
+                logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(len(gstore), gstore.dim))
+            finally:
+                self.swag_features = False
 
-            gf = torch.cat(gf, 0)
-            g_pids = np.asarray(g_pids)
-            g_camids = np.asarray(g_camids)
-            logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
+        if not is_main_process():
+            return
 
-        distmat =  self._euclidean_dist(qf, gf)
-        distmat = distmat.numpy()
+        distmat = gstore.distance_matrix(qf, 'euclidean', tile=self.cfg.REID.EVAL_TILE[1])
 
         logger.info("Computing CMC and mAP")
         cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
@@ -152,17 +134,8 @@ class HarmAttnReIDEngine(BaseEngine):
         logger.info("    Number of target: {:.2f} / {} / {}".format(np.quantile(gts, q = 0.5), np.quantile(gts, q = 0.75), np.quantile(gts, q = 0.95)))  
         logger.info("------------------")
         
-        del qf, gf, distmat
+        del qf, qstore, gstore, distmat
 
     def Evaluate(self):
         self._evaluate(eval=True)
         logger.info(self.accu)
-
-    def _euclidean_dist(self, x, y):
-        m, n = x.size(0), y.size(0)
-        xx = torch.pow(x, 2).sum(1, keepdim=True).expand(m, n)
-        yy = torch.pow(y, 2).sum(1, keepdim=True).expand(n, m).t()
-        dist = xx + yy
-        dist.addmm_(1, -2, x, y.t())
-        dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
-        return dist
@@ -86,7 +86,10 @@ class HourglassJDE(BaseEngine):
                     feat['hm'].shape[3], 
                     feat['hm'].shape[1]
                 )
-                results[batch['img_id'][0]] = dets_out[0]
+                results[int(batch['img_id'][0])] = dets_out[0]
+        results = self._gather_results(results)
+        if not is_main_process():
+            return
         cce = coco_eval(self.vdata.dataset.coco[0], results, self.cfg.OUTPUT_DIR)  
 
         logger.info('Average Precision  (AP) @[ IoU=0.50:0.95 | area=   all | maxDets={:>3d} ] = {:.3f}'.format(cce.params.maxDets[2], cce.stats[0]))
@@ -1,6 +1,6 @@
 from src.engine import *
 from tqdm import tqdm
-from tools.eval_reid_metrics import evaluate, eval_recall
+from tools.eval_reid_metrics import evaluate, evaluate_streaming, eval_recall
 
 # recover = T.Compose([T.Normalize(mean = [-0.485/0.229, -0.456/0.224, -0.406/0.225], std = [1/0.229,1/0.224,1/0.225])])
 
@@ -9,13 +9,7 @@ class IAPReIDEngine(BaseEngine):
         super(IAPReIDEngine, self).__init__(cfg, graph, loader, solvers, visualizer)
 
     def _train_epoch_start(self):
-        self.epoch += 1
-        logger.info(f"Epoch {self.epoch} start")
-        self.graph.model.train() 
-        if len(self.graph.sub_models) > 0:
-            for sub_model in self.graph.sub_models:
-                self.graph.sub_models[sub_model].train()
-        
+        super(IAPReIDEngine, self)._train_epoch_start()
         if self.cfg.SOLVER.MODEL_FREEZE_PEROID > 0:
             if self.epoch - 1 < self.cfg.SOLVER.MODEL_FREEZE_PEROID:
                 for n, m in self.graph.model.named_modules():
@@ -34,7 +28,6 @@ class IAPReIDEngine(BaseEngine):
                     p.requires_grad = True
                 
     def _train_once(self):
-        accus = [] 
         for batch in tqdm(self.tdata, desc=f"TRAIN[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"):
             self._train_iter_start()
             if self.use_gpu:
@@ -47,54 +40,46 @@ class IAPReIDEngine(BaseEngine):
             loss, losses = self.graph.loss_head(output, batch)
             self.loss, self.losses = loss, losses
 
-            accu = (output.max(1)[1] == batch['pid']).float().mean()
-            accus.append(accu)        
-            self.train_accu = self.tensor_to_scalar(accu)
+            self.metrics.update('train/accuracy', (output.max(1)[1] == batch['pid']).float().mean())
             self._train_iter_end()
 
+        self.train_accu = self.metrics.epoch_mean('train/accuracy')
+
+    def _forward_features(self, imgs):
+        return self.graph.run(imgs)
+
     def _evaluate(self, eval=False):
         logger.info("Epoch {} evaluation start".format(self.epoch))
         title = "EVALUATE" if eval else f"TEST[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"
         accus = []        
         with torch.no_grad():
             self._eval_epoch_start()
-            qf, q_pids, q_camids = [], [], []
-            for batch in tqdm(self.qdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                if self.cfg.DISTRIBUTED:
-                    features = self.graph.run(imgs.to(self.device, non_blocking=True) if self.use_gpu else imgs)
-                else:
-                    features = self.graph.run(imgs.cuda() if self.use_gpu else imgs)
-                qf.append(features.cpu())
-                q_pids.extend(pids)
-                q_camids.extend(camids)
-
-            qf = torch.cat(qf, 0)
-            q_pids = np.asarray(q_pids)
-            q_camids = np.asarray(q_camids)
+            qstore = self._extract_features(self.qdata, title, "query")
+            qf, q_pids, q_camids = qstore.features(), qstore.pids, qstore.camids
             logger.info("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
 
-            gf, g_pids, g_camids = [], [], []
-            for batch in tqdm(self.gdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                if self.cfg.DISTRIBUTED:
-                    features = self.graph.run(imgs.to(self.device, non_blocking=True) if self.use_gpu else imgs)
-                else:
-                    features = self.graph.run(imgs.cuda() if self.use_gpu else imgs)
-                gf.append(features.cpu())
-                g_pids.extend(pids)
-                g_camids.extend(camids)
-
-            gf = torch.cat(gf, 0)
-            g_pids = np.asarray(g_pids)
-            g_camids = np.asarray(g_camids)
-            logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
+            gstore = self._extract_features(self.gdata, title, "gallery")
+            g_pids, g_camids = gstore.pids, gstore.camids
+            logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(len(gstore), gstore.dim))
 
-        distmat =  1 - F.linear(qf, gf)
-        distmat = distmat.numpy()
+        if not is_main_process():
+            return
 
         logger.info("Computing CMC and mAP")
-        cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
+        if self.cfg.REID.STREAMING_EVAL:
+            # the num_q x num_g distance matrix is never materialized
+            if self.cfg.REID.RERANK:
+                logger.warning("REID.RERANK needs the full distance matrix and is ignored in streaming evaluation, "
+                               "the metrics are computed without re-ranking")
+            q_tile, g_tile = self.cfg.REID.EVAL_TILE
+            cmc, mAP = evaluate_streaming(qf, gstore, q_pids, g_pids, q_camids, g_camids, q_tile=q_tile, g_tile=g_tile)
+        else:
+            if self.cfg.REID.RERANK:
+                distmat = self._re_ranking(qf, gstore)
+            else:
+                # tile by tile on the stored values, the gallery store is not decoded
+                distmat = gstore.distance_matrix(qf, 'cosine', tile=self.cfg.REID.EVAL_TILE[1])
+            cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
 
         logger.info("Results ----------")
         logger.info("mAP: {:.1%}".format(mAP))
@@ -103,25 +88,30 @@ class IAPReIDEngine(BaseEngine):
             logger.info("Rank-{:<3}: {:.1%}".format(r, cmc[r - 1]))
         logger.info("------------------")
 
-        logger.info("Computing Recall")
-        rs, confs, gts, fg = eval_recall(distmat, q_pids, g_pids, q_camids, g_camids)
+        if self.cfg.REID.STREAMING_EVAL:
+            logger.info("Recall is skipped in streaming evaluation")
+        else:
+            logger.info("Computing Recall")
+            rs, confs, gts, fg = eval_recall(distmat, q_pids, g_pids, q_camids, g_camids)
 
-        logger.info("Results ------------: {:>4} / {:>4} / {:>4}".format("Q0.5", "Q0.75", "Q0.95"))
-        logger.info("Number of candidates: {:.2f} / {} / {}".format(np.quantile(rs, q = 0.5), np.quantile(rs, q = 0.75), np.quantile(rs, q = 0.95)))
-        logger.info("          Confidence: {:.2f} / {:.2f} / {:.2f}".format(np.quantile(confs, q = 0.5), np.quantile(confs, q = 0.75), np.quantile(confs, q = 0.95)))
-        logger.info("    Number of target: {:.2f} / {} / {}".format(np.quantile(gts, q = 0.5), np.quantile(gts, q = 0.75), np.quantile(gts, q = 0.95)))  
-        logger.info("------------------")
+            logger.info("Results ------------: {:>4} / {:>4} / {:>4}".format("Q0.5", "Q0.75", "Q0.95"))
+            logger.info("Number of candidates: {:.2f} / {} / {}".format(np.quantile(rs, q = 0.5), np.quantile(rs, q = 0.75), np.quantile(rs, q = 0.95)))
+            logger.info("          Confidence: {:.2f} / {:.2f} / {:.2f}".format(np.quantile(confs, q = 0.5), np.quantile(confs, q = 0.75), np.quantile(confs, q = 0.95)))
+            logger.info("    Number of target: {:.2f} / {} / {}".format(np.quantile(gts, q = 0.5), np.quantile(gts, q = 0.75), np.quantile(gts, q = 0.95)))  
+            logger.info("------------------")
         
-        if eval:
-            np.save(self.cfg.OUTPUT_DIR+"/rs.npy", rs)
-            np.save(self.cfg.OUTPUT_DIR+"/confs.npy", confs)
-            np.save(self.cfg.OUTPUT_DIR+"/gts.npy", gts)
-            np.save(self.cfg.OUTPUT_DIR+"/filtered_gallery.npy", fg)
-        else:
+            if eval:
+                np.save(self.cfg.OUTPUT_DIR+"/rs.npy", rs)
+                np.save(self.cfg.OUTPUT_DIR+"/confs.npy", confs)
+                np.save(self.cfg.OUTPUT_DIR+"/gts.npy", gts)
+                np.save(self.cfg.OUTPUT_DIR+"/filtered_gallery.npy", fg)
+            del distmat
+
+        if not eval:
             self.accu = cmc[0]
             self._eval_epoch_end()
 
-        del qf, gf, distmat
+        del qf, qstore, gstore
         
     def Evaluate(self):
         self._evaluate(eval=True)
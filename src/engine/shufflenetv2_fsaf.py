@@ -82,8 +82,11 @@ class Shufflenetv2FSAF(BaseEngine):
                     _dets = torch.Tensor(dets_out[0][1])
                     keep_ids = nms(_dets[:,:4], _dets[:,4], 0.5)
                     dets_out[0][1] = _dets[keep_ids].numpy().tolist()
-                results[batch['img_id'][0]] = dets_out[0]
+                results[int(batch['img_id'][0])] = dets_out[0]
 
+        results = self._gather_results(results)
+        if not is_main_process():
+            return
         cce = coco_eval(self.vdata.dataset.coco[0], results, self.cfg.OUTPUT_DIR)  
 
         logger.info('Average Precision  (AP) @[ IoU=0.50:0.95 | area=   all | maxDets={:>3d} ] = {:.3f}'.format(cce.params.maxDets[2], cce.stats[0]))
@@ -101,8 +101,11 @@ class Shufflenetv2ScopeHeadOD(BaseEngine):
                     )[0]
                     for cat in dets_out:
                         dets_outs[cat].extend(dets_out[cat])
-                results[batch['img_id'][0]] = dets_outs
+                results[int(batch['img_id'][0])] = dets_outs
 
+        results = self._gather_results(results)
+        if not is_main_process():
+            return
         cce = coco_eval(self.vdata.dataset.coco[0], results, self.cfg.OUTPUT_DIR)  
 
         logger.info('Average Precision  (AP) @[ IoU=0.50:0.95 | area=   all | maxDets={:>3d} ] = {:.3f}'.format(cce.params.maxDets[2], cce.stats[0]))
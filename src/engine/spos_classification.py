@@ -19,7 +19,6 @@ class SPOSClassificationEngine(BaseEngine):
         self.evolution = Evolution(cfg, graph, logger=logger)
         
     def _train_once(self):
-        accus = []   
         for batch in tqdm(self.tdata, desc=f"TRAIN[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"):
             self._train_iter_start()
             for key in batch:
@@ -39,9 +38,9 @@ class SPOSClassificationEngine(BaseEngine):
             self.visualizer.add_scalar('train/evolution/params', cand['param'], self.iter)                      
             outputs = self.graph.run(batch['inp'], block_choices, channel_choices)
             self.loss, self.losses = self.graph.loss_head(outputs, batch)
-            accus.append((outputs.max(1)[1] == batch['target']).float().mean())        
+            self.metrics.update('train/accuracy', (outputs.max(1)[1] == batch['target']).float().mean())
             self._train_iter_end()    
-        self.train_accu = self.tensor_to_scalar(torch.stack(accus).mean())
+        self.train_accu = self.metrics.epoch_mean('train/accuracy')
         self.finished.value = True
 
     def Train(self):
@@ -58,18 +57,22 @@ class SPOSClassificationEngine(BaseEngine):
             self._train_once()
             pool_process.join()
             self._train_epoch_end()
-            self.graph.save(self.graph.save_path, self.graph.model, self.graph.sub_models, self.solvers, self.epoch, 0.0)                    
             if self.epoch % self.cfg.EVALUATE_FREQ == 0:
+                # saves the checkpoint with its accuracy
                 self._evaluate()
+            elif self.cfg.IO and self.cfg.SAVE:
+                self.graph.save_checkpoint(self.solvers, self.epoch, 0.0, train_state=self.state_dict())
             if self.cfg.SOLVER.LR_POLICY == 'plateau' and self.cfg.SOLVER.MIN_LR >= self.solvers['model'].monitor_lr:
                 logger.info(f"LR {self.solvers['model'].monitor_lr} is less than {self.cfg.SOLVER.MIN_LR}")
                 break
         logger.info(f"Best accuracy {self.best_accu:.2f}")
+        if self.cfg.IO:
+            self.graph.checkpointer.wait()
             
     def _evaluate(self, eval=False):
         logger.info("Epoch {} evaluation start".format(self.epoch))
         title = "EVALUATE" if eval else f"TEST[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"
-        accus = []        
+        corrects = []        
         block_choices = self.graph.random_block_choices(self.epoch - self.cfg.SPOS.EPOCH_TO_SEARCH)
         channel_choices = self.graph.random_channel_choices(self.epoch - self.cfg.SPOS.EPOCH_TO_SEARCH)
         self.visualizer.add_histogram('val/evolution/block_choices', self._choice2hist(block_choices), self.iter, np.arange(len(block_choices)))
@@ -83,9 +86,16 @@ class SPOSClassificationEngine(BaseEngine):
                 for key in batch:
                     batch[key] = batch[key].cuda()
                 outputs = self.graph.run(batch['inp'], block_choices, channel_choices)
-                accus.append((outputs.max(1)[1] == batch['target']).float().mean())
-          
-        self.accu = self.tensor_to_scalar(torch.stack(accus).mean())   
+                corrects.append((outputs.max(1)[1] == batch['target']).float())
+
+        corrects = torch.cat(corrects)
+        if self._is_sharded(self.vdata):
+            corrects = gather_by_index(corrects, list(self.vdata.sampler), len(self.vdata.dataset))
+        if not is_main_process():
+            if not eval:
+                self.graph.model.load_state_dict(raw_model_state)
+            return
+        self.accu = self.tensor_to_scalar(corrects.mean())   
         if not eval:
             self._eval_epoch_end()       
             self.graph.model.load_state_dict(raw_model_state) 
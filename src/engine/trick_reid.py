@@ -1,29 +1,22 @@
 from src.engine import *
 from tqdm import tqdm
-from tools.eval_reid_metrics import evaluate, eval_recall
+from tools.eval_reid_metrics import evaluate, evaluate_streaming, eval_recall
 
 # recover = T.Compose([T.Normalize(mean = [-0.485/0.229, -0.456/0.224, -0.406/0.225], std = [1/0.229,1/0.224,1/0.225])])
 
 class TrickReIDEngine(BaseEngine):
+    NORMALIZE_FEATURES = True
+
     def __init__(self, cfg, graph, loader, solvers, visualizer):
         super(TrickReIDEngine, self).__init__(cfg, graph, loader, solvers, visualizer)
 
     def _train_iter_end(self): 
-        self.loss.backward() 
-        self.solvers['main'].step()
-
-        self.loss = self.tensor_to_scalar(self.loss)
-        self.losses = self.tensor_to_scalar(self.losses)     
-        if self.cfg.IO:
-            self.visualizer.add_scalar('train/loss', self.loss, self.iter)              
-            for loss in self.losses:
-                self.visualizer.add_scalar(f'train/loss/{loss}', self.losses[loss], self.iter)
-            self.visualizer.add_scalar('train/accuracy', self.train_accu, self.iter)   
-            for solver in self.solvers:
-                self.visualizer.add_scalar(f'train/solver/{solver}/lr', self.solvers[solver].monitor_lr, self.iter)
+        self._backward()
+        if self._accum_last:
+            self.precision.step(self.solvers['main'])
+        self._log_iter()
 
     def _train_once(self):
-        accus = []   
         for batch in tqdm(self.tdata, desc=f"TRAIN[{self.epoch}/{self.cfg.SOLVER.MAX_EPOCHS}]"):
             self._train_iter_start()
             if self.use_gpu:
@@ -31,15 +24,21 @@ class TrickReIDEngine(BaseEngine):
                     batch[key] = batch[key].cuda()
             outputs = self.graph.run(batch['inp']) 
             self.loss, self.losses = self.graph.loss_head(outputs, batch)
-            accus.append((outputs['global'].max(1)[1] == batch['pid']).float().mean())        
+            self.metrics.update('train/accuracy', (outputs['global'].max(1)[1] == batch['pid']).float().mean())
             self._train_iter_end()
+            if not self._accum_last:
+                continue
 
             for sub_model in self.graph.sub_models:
                 for param in self.graph.sub_models[sub_model].parameters():
                     param.grad.data *= (1. / self.cfg.REID.CENTER_LOSS_WEIGHT)
-            self.solvers['center'].step()
+            self.precision.step(self.solvers['center'])
+            self.precision.update()
+
+        self.train_accu = self.metrics.epoch_mean('train/accuracy')
 
-        self.train_accu = self.tensor_to_scalar(torch.stack(accus).mean())
+    def _forward_features(self, imgs):
+        return self.graph.run(imgs)['neck']
 
     def _evaluate(self, eval=False):
         logger.info("Epoch {} evaluation start".format(self.epoch))
@@ -47,39 +46,32 @@ class TrickReIDEngine(BaseEngine):
         accus = []        
         with torch.no_grad():
             self._eval_epoch_start()
-            qf, q_pids, q_camids = [], [], []
-            for batch in tqdm(self.qdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                features = self.graph.run(imgs.cuda() if self.use_gpu else imgs)['neck']
-                features = F.normalize(features)
-                qf.append(features.cpu())
-                q_pids.extend(pids)
-                q_camids.extend(camids)
-
-            qf = torch.cat(qf, 0)
-            q_pids = np.asarray(q_pids)
-            q_camids = np.asarray(q_camids)
+            qstore = self._extract_features(self.qdata, title, "query")
+            qf, q_pids, q_camids = qstore.features(), qstore.pids, qstore.camids
             logger.info("Extracted features for query set, obtained {}-by-{} matrix".format(qf.size(0), qf.size(1)))
 
-            gf, g_pids, g_camids = [], [], []
-            for batch in tqdm(self.gdata, desc=title): 
-                imgs, pids, camids = batch['inp'], batch['pid'], batch['camid']
-                features = self.graph.run(imgs.cuda() if self.use_gpu else imgs)['neck']
-                features = F.normalize(features)
-                gf.append(features.cpu())
-                g_pids.extend(pids)
-                g_camids.extend(camids)
+            gstore = self._extract_features(self.gdata, title, "gallery")
+            g_pids, g_camids = gstore.pids, gstore.camids
+            logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(len(gstore), gstore.dim))
 
-            gf = torch.cat(gf, 0)
-            g_pids = np.asarray(g_pids)
-            g_camids = np.asarray(g_camids)
-            logger.info("Extracted features for gallery set, obtained {}-by-{} matrix".format(gf.size(0), gf.size(1)))
-
-        distmat =  1 - F.linear(qf, gf)
-        distmat = distmat.numpy()
+        if not is_main_process():
+            return
 
         logger.info("Computing CMC and mAP")
-        cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
+        if self.cfg.REID.STREAMING_EVAL:
+            # the num_q x num_g distance matrix is never materialized
+            if self.cfg.REID.RERANK:
+                logger.warning("REID.RERANK needs the full distance matrix and is ignored in streaming evaluation, "
+                               "the metrics are computed without re-ranking")
+            q_tile, g_tile = self.cfg.REID.EVAL_TILE
+            cmc, mAP = evaluate_streaming(qf, gstore, q_pids, g_pids, q_camids, g_camids, q_tile=q_tile, g_tile=g_tile)
+        else:
+            if self.cfg.REID.RERANK:
+                distmat = self._re_ranking(qf, gstore)
+            else:
+                # tile by tile on the stored values, the gallery store is not decoded
+                distmat = gstore.distance_matrix(qf, 'cosine', tile=self.cfg.REID.EVAL_TILE[1])
+            cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids)
 
         logger.info("Results ----------")
         logger.info("mAP: {:.1%}".format(mAP))
@@ -88,25 +80,30 @@ class TrickReIDEngine(BaseEngine):
             logger.info("Rank-{:<3}: {:.1%}".format(r, cmc[r - 1]))
         logger.info("------------------")
 
-        logger.info("Computing Recall")
-        rs, confs, gts, fg = eval_recall(distmat, q_pids, g_pids, q_camids, g_camids)
-
-        logger.info("Results ------------: {:>4} / {:>4} / {:>4}".format("Q0.5", "Q0.75", "Q0.95"))
-        logger.info("Number of candidates: {:.2f} / {} / {}".format(np.quantile(rs, q = 0.5), np.quantile(rs, q = 0.75), np.quantile(rs, q = 0.95)))
-        logger.info("          Confidence: {:.2f} / {:.2f} / {:.2f}".format(np.quantile(confs, q = 0.5), np.quantile(confs, q = 0.75), np.quantile(confs, q = 0.95)))
-        logger.info("    Number of target: {:.2f} / {} / {}".format(np.quantile(gts, q = 0.5), np.quantile(gts, q = 0.75), np.quantile(gts, q = 0.95)))  
-        logger.info("------------------")
-        
-        if eval:
-            np.save(self.cfg.OUTPUT_DIR+"/rs.npy", rs)
-            np.save(self.cfg.OUTPUT_DIR+"/confs.npy", confs)
-            np.save(self.cfg.OUTPUT_DIR+"/gts.npy", gts)
-            np.save(self.cfg.OUTPUT_DIR+"/filtered_gallery.npy", fg)
+        if self.cfg.REID.STREAMING_EVAL:
+            logger.info("Recall is skipped in streaming evaluation")
         else:
+            logger.info("Computing Recall")
+            rs, confs, gts, fg = eval_recall(distmat, q_pids, g_pids, q_camids, g_camids)
+
+            logger.info("Results ------------: {:>4} / {:>4} / {:>4}".format("Q0.5", "Q0.75", "Q0.95"))
+            logger.info("Number of candidates: {:.2f} / {} / {}".format(np.quantile(rs, q = 0.5), np.quantile(rs, q = 0.75), np.quantile(rs, q = 0.95)))
+            logger.info("          Confidence: {:.2f} / {:.2f} / {:.2f}".format(np.quantile(confs, q = 0.5), np.quantile(confs, q = 0.75), np.quantile(confs, q = 0.95)))
+            logger.info("    Number of target: {:.2f} / {} / {}".format(np.quantile(gts, q = 0.5), np.quantile(gts, q = 0.75), np.quantile(gts, q = 0.95)))  
+            logger.info("------------------")
+        
+            if eval:
+                np.save(self.cfg.OUTPUT_DIR+"/rs.npy", rs)
+                np.save(self.cfg.OUTPUT_DIR+"/confs.npy", confs)
+                np.save(self.cfg.OUTPUT_DIR+"/gts.npy", gts)
+                np.save(self.cfg.OUTPUT_DIR+"/filtered_gallery.npy", fg)
+            del distmat
+
+        if not eval:
             self.accu = cmc[0]
             self._eval_epoch_end()
 
-        del qf, gf, distmat
+        del qf, qstore, gstore
         
     def Evaluate(self):
         self._evaluate(eval=True)
@@ -40,6 +40,8 @@ cfg.TRAINER = ""
 cfg.NUM_WORKERS = 16
 cfg.ORACLE = False
 cfg.EVALUATE_FREQ = 1
+# iterations between two host syncs of the training metrics
+cfg.LOG_PERIOD = 20
 cfg.DISTRIBUTED = False
 # -----------------------------------------------------------------------------
 # Model in Graph
@@ -51,6 +53,54 @@ cfg.MODEL.SAVE_CRITERION = "acc"
 cfg.MODEL.STRIDES = [1]
 cfg.MODEL.FEATSIZE = 0
 cfg.MODEL.MAX_STRIDE = 32
+# modules whose activations are recomputed in the backward instead of kept, by class name or
+# qualified name pattern, e.g. ["pre", "hg_mods.*"] for the stem and each hourglass stack,
+# ["HighResolutionModule"] for HRNet, see benchmark.py recompute
+cfg.MODEL.ACTIVATION_CHECKPOINT = []
+
+# -----------------------------------------------------------------------------
+# Checkpoints, saved at every evaluation under OUTPUT_DIR/weights
+# -----------------------------------------------------------------------------
+cfg.CHECKPOINT = CN()
+# the most recent checkpoints kept
+cfg.CHECKPOINT.KEEP_LAST = 1
+# the best checkpoints kept, by MODEL.SAVE_CRITERION
+cfg.CHECKPOINT.KEEP_BEST = 3
+# serialize in a background thread, training only waits for the copy to CPU
+cfg.CHECKPOINT.ASYNC = True
+# iterations between two checkpoints in the middle of an epoch, 0 to save only at evaluations
+cfg.CHECKPOINT.PERIOD = 0
+
+# -----------------------------------------------------------------------------
+# Profiling of the engine loops with torch.profiler, traces under OUTPUT_DIR/profile
+# -----------------------------------------------------------------------------
+cfg.PROFILE = CN()
+cfg.PROFILE.ENABLED = False
+# "train" profiles _train_once, "eval" profiles _evaluate
+cfg.PROFILE.PHASES = ["train", "eval"]
+# each phase is profiled once, the first time it runs at this epoch or later
+cfg.PROFILE.EPOCH = 0
+# iterations skipped, then traced but discarded, then recorded
+cfg.PROFILE.WAIT = 5
+cfg.PROFILE.WARMUP = 2
+cfg.PROFILE.ACTIVE = 5
+cfg.PROFILE.RECORD_SHAPES = True
+cfg.PROFILE.PROFILE_MEMORY = True
+cfg.PROFILE.WITH_STACK = False
+# number of operators in the summary
+cfg.PROFILE.TOP_N = 20
+
+# -----------------------------------------------------------------------------
+# Timing of the data wait and of the phases of the training iterations
+# -----------------------------------------------------------------------------
+cfg.TIMING = CN()
+cfg.TIMING.ENABLED = True
+# iterations per report of the throughput and the p50 / p95 of the phases
+cfg.TIMING.PERIOD = 100
+# warn that the run is input bound above this fraction of time waiting for batches
+cfg.TIMING.DATA_WAIT_WARN = 0.2
+# synchronize CUDA at the phase boundaries to attribute the device time to its phase
+cfg.TIMING.SYNC = False
 
 # -----------------------------------------------------------------------------
 # INPUT
@@ -96,6 +146,12 @@ cfg.SOLVER.WEIGHT_DECAY = 0.0005
 cfg.SOLVER.WEIGHT_DECAY_BIAS_FACTOR = 1.0
 cfg.SOLVER.NESTEROV = False
 cfg.SOLVER.AMSGRAD = False
+# fp32, fp16 (with loss scaling) or bf16, mixed precision with torch.autocast
+cfg.SOLVER.PRECISION = "fp32"
+# class names of the modules kept in fp32 under autocast
+cfg.SOLVER.FP32_MODULES = ["FocalLoss", "AMSoftmaxWithLoss"]
+# number of micro-batches whose gradients are accumulated before each optimizer step
+cfg.SOLVER.ACCUM_STEPS = 1
 cfg.SOLVER.ITERATIONS_PER_EPOCH = 0
 cfg.SOLVER.LR_POLICY = ""
 
@@ -131,6 +187,28 @@ cfg.REID.SIZE_PERSON = 4
 cfg.REID.MSMT_ALL = False
 cfg.REID.CENTER_LOSS_LR = 0.5
 cfg.REID.CENTER_LOSS_WEIGHT = 0.0005
+# evaluate CMC / mAP tile by tile (query, gallery) without the full distance matrix, recall is skipped
+cfg.REID.STREAMING_EVAL = False
+cfg.REID.EVAL_TILE = (1024, 16384)
+# storage of the extracted features, 'float32', 'float16' or 'int8' (per-vector scale)
+cfg.REID.FEATURE_DTYPE = "float32"
+# memory-map the extracted features under this directory if set
+cfg.REID.FEATURE_DIR = ""
+# horizontal flip test-time augmentation in the same forward, fused by 'mean' or 'concat', disabled if empty
+cfg.REID.FLIP_TTA = ""
+# run the original and flipped images in one forward of twice the batch size, or in two forwards,
+# two forwards are faster on CPU beyond batch 1 (1.25x the naive two-pass extraction vs 0.71x at batch 8)
+cfg.REID.FLIP_TTA_ONE_FORWARD = False
+# reuse the features extracted from the same checkpoint, dataset and test transform in evaluation runs,
+# cached under CACHE_DIR, e.g. a directory shared by experiments, or OUTPUT_DIR/feature_cache if empty
+cfg.REID.CACHE = False
+cfg.REID.CACHE_DIR = ""
+# k-reciprocal re-ranking of the distances (not applied in streaming evaluation)
+cfg.REID.RERANK = False
+cfg.REID.RERANK_K1 = 20
+cfg.REID.RERANK_K2 = 6
+cfg.REID.RERANK_LAMBDA = 0.3
+cfg.REID.RERANK_WORKERS = 4
 
 # -----------------------------------------------------------------------------
 # Pedestrian Attribute Recognition
@@ -145,6 +223,23 @@ cfg.PAR.IGNORE_CAT = []
 cfg.COCO = CN()
 cfg.COCO.TARGET = 'original'
 
+# ---------------------------------------------------------------------------- #
+# DEPLOY
+# ---------------------------------------------------------------------------- #
+cfg.DEPLOY = CN()
+# fold BatchNorm into convolutions after loading the weights, evaluation only
+cfg.DEPLOY.FUSE = False
+cfg.DEPLOY.FUSE_RELU = True
+# post-training static quantization, see quantize.py
+cfg.DEPLOY.QUANT_BACKEND = "fbgemm"
+cfg.DEPLOY.QUANT_CALIB_BATCHES = 32
+cfg.DEPLOY.QUANT_FLOAT_MODULES = ['ChannelGate']
+# tiled inference of large frames, BaseGraph.tiled_inference
+# (0, 0) uses tiles of INPUT.SIZE, i.e. the frame is not resized
+cfg.DEPLOY.TILE_SIZE = (0, 0)
+cfg.DEPLOY.TILE_OVERLAP = 0.2
+cfg.DEPLOY.TILE_BS = 4
+
 # ---------------------------------------------------------------------------- #
 # SPOS
 # ---------------------------------------------------------------------------- #
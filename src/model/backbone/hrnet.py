@@ -255,7 +255,7 @@ class PoseHighResolutionNet(nn.Module):
             self.incre_modules, self.downsamp_modules, \
             self.final_layer = self._make_head(stage_num_channels[-1], pre_stage_channels)
         else:
-            last_inp_channels = np.int(np.sum(pre_stage_channels))
+            last_inp_channels = int(np.sum(pre_stage_channels))
             self.last_layer = ConvModule(last_inp_channels, 64, 1, activation='hs')
 
         self.init_weights()
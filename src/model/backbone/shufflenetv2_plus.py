@@ -55,8 +55,9 @@ class ShuffleBlock(nn.Module):
             return torch.cat((self.branch_proj(x_proj), self.branch_main(x)), 1)
 
 def channel_shuffle(x):
-    batchsize, num_channels, height, width = x.data.size()
-    assert (num_channels % 4 == 0)
+    # x.size() and torch._assert keep the function traceable by torch.fx (quantization)
+    batchsize, num_channels, height, width = x.size()
+    torch._assert(num_channels % 4 == 0, "number of channels must be divisible by 4")
     x = x.reshape(batchsize * num_channels // 2, 2, height * width)
     x = x.permute(1, 0, 2)
     x = x.reshape(2, -1, num_channels // 2, height, width)
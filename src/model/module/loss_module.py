@@ -97,7 +97,32 @@ class CrossEntropyLossLS(nn.Module):
         loss = (- targets * log_probs).mean(0).sum()
         return loss
 
-class TripletLoss(object):
+class CrossBatchMemory():
+    """Features and labels of the previous micro-batches of a gradient accumulation window,
+    so that the triplet losses mine positives and negatives across the accumulated batch.
+    The stored features are detached, only the anchors of the current micro-batch get
+    gradients. The engine calls reset_memory at the first micro-batch of each window.
+    """
+    def reset_memory(self, enabled=True):
+        self.use_memory = enabled
+        self.memory_feats = []
+        self.memory_labels = []
+
+    def _with_memory(self, feats, labels):
+        """
+        Returns:
+        all_feats: the features of the window so far, the current ones first, [N + M, d]
+        all_labels: [N + M]
+        """
+        if not getattr(self, 'use_memory', False):
+            return feats, labels
+        all_feats = torch.cat([feats] + self.memory_feats)
+        all_labels = torch.cat([labels] + self.memory_labels)
+        self.memory_feats.append(feats.detach())
+        self.memory_labels.append(labels.detach())
+        return all_feats, all_labels
+
+class TripletLoss(CrossBatchMemory):
     """Modified from Tong Xiao's open-reid (https://github.com/Cysu/open-reid).
     Related Triplet Loss theory can be found in paper 'In Defense of the Triplet
     Loss for Person Re-Identification'."""
@@ -112,9 +137,14 @@ class TripletLoss(object):
     def __call__(self, global_feat, labels, normalize_feature=True):
         if normalize_feature:
             global_feat = self._normalize(global_feat, axis=-1)
-        dist_mat = self._euclidean_dist(global_feat, global_feat)
-        dist_ap, dist_an = self._hard_example_mining(
-            dist_mat, labels)
+        all_feat, all_labels = self._with_memory(global_feat, labels)
+        dist_mat = self._euclidean_dist(global_feat, all_feat)
+        if dist_mat.size(0) == dist_mat.size(1):
+            dist_ap, dist_an = self._hard_example_mining(
+                dist_mat, labels)
+        else:
+            dist_ap, dist_an = self._masked_hard_example_mining(
+                dist_mat, labels, all_labels)
         y = dist_an.new().resize_as_(dist_an).fill_(1)
         if self.margin is not None:
             loss = self.ranking_loss(dist_an, dist_ap, y)
@@ -148,6 +178,22 @@ class TripletLoss(object):
         dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
         return dist
 
+    def _masked_hard_example_mining(self, dist_mat, labels, all_labels):
+        """Hardest positive and negative of each anchor among all_labels, the numbers of
+        samples per label may differ
+        Args:
+        dist_mat: pytorch Variable, distance between the anchors and all samples, shape [N, M]
+        labels: pytorch LongTensor, with shape [N]
+        all_labels: pytorch LongTensor, with shape [M]
+        Returns:
+        dist_ap: pytorch Variable, distance(anchor, positive); shape [N]
+        dist_an: pytorch Variable, distance(anchor, negative); shape [N]
+        """
+        is_pos = labels.unsqueeze(1).eq(all_labels.unsqueeze(0))
+        dist_ap = dist_mat.masked_fill(~is_pos, float('-inf')).max(1)[0]
+        dist_an = dist_mat.masked_fill(is_pos, float('inf')).min(1)[0]
+        return dist_ap, dist_an
+
     def _hard_example_mining(self, dist_mat, labels, return_inds=False):
         """For each anchor, find the hardest positive and negative sample.
         Args:
@@ -236,7 +282,7 @@ class CenterLoss(nn.Module):
         
         return center_loss
 
-class SoftTripletLoss(nn.Module):
+class SoftTripletLoss(nn.Module, CrossBatchMemory):
     """
     Implement Attention Network Robustification for Person ReID (https://arxiv.org/abs/1910.07038)
     Eq(5).
@@ -245,10 +291,10 @@ class SoftTripletLoss(nn.Module):
         super(SoftTripletLoss, self).__init__()
 
     def forward(self, norm_feats, labels):
-        dist_mat = self._euclidean_dist(norm_feats, norm_feats)
-        N = dist_mat.size(0)
-        pos_mask = labels.expand(N, N).eq(labels.expand(N, N).t())
-        neg_mask = labels.expand(N, N).ne(labels.expand(N, N).t())
+        all_feats, all_labels = self._with_memory(norm_feats, labels)
+        dist_mat = self._euclidean_dist(norm_feats, all_feats)
+        pos_mask = labels.unsqueeze(1).eq(all_labels.unsqueeze(0))
+        neg_mask = ~pos_mask
         d_ap = dist_mat[pos_mask]
         d_np = dist_mat[neg_mask]
         pos_w = F.softmax(d_ap, dim=0)
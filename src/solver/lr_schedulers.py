@@ -82,6 +82,24 @@ class LRScheduler():
         
         self._adjust_lr(factor)
 
+    def state_dict(self):
+        '''
+        The factors that depend on the history, the others are recomputed from the iteration
+        '''
+        return {
+            'permanent_factor': self.permanent_factor,
+            'plateau': {
+                'n_drop': self.plateaulr.n_drop,
+                'best': self.plateaulr.best,
+                'num_bad_iters': self.plateaulr.num_bad_iters,
+            },
+        }
+
+    def load_state_dict(self, state):
+        self.permanent_factor = state['permanent_factor']
+        for key, value in state['plateau'].items():
+            setattr(self.plateaulr, key, value)
+
     def _adjust_lr(self, factor):
         self.monitor_lrs = []
         for base_lr, param_group in zip(self.base_lrs, self.optimizer.param_groups):
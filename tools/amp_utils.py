@@ -0,0 +1,124 @@
+import types
+import functools
+import torch
+import torch.nn as nn
+import logging
+logger = logging.getLogger("logger")
+try:
+    from torch import autocast
+    from torch.amp import GradScaler
+    AUTOCAST_IMPORTED = True
+except:
+    logger.info("Native mixed precision needs torch.autocast and torch.amp.GradScaler")
+    AUTOCAST_IMPORTED = False
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def _to_float(x):
+    '''
+    Cast the half precision tensors in nested lists, tuples and dicts back to float32
+    '''
+    if isinstance(x, torch.Tensor):
+        return x.float() if x.dtype in (torch.float16, torch.bfloat16) else x
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_float(v) for v in x)
+    if isinstance(x, dict):
+        return {k: _to_float(v) for k, v in x.items()}
+    return x
+
+class Precision():
+    '''
+    Mixed precision training with torch.autocast, fp16 with a GradScaler against the underflow
+    of the gradients, bf16 without scaling as it has the range of fp32, e.g. on CPU.
+
+    The forward and the losses run under autocast(), the backward and the optimizer steps go
+    through backward / step / update which are plain calls in fp32.
+
+    Args:
+        precision (str): 'fp32', 'fp16' or 'bf16'
+        device_type (str): 'cuda' or 'cpu'
+    '''
+    def __init__(self, precision='fp32', device_type='cpu'):
+        assert precision in DTYPES, f"Unknown precision {precision}, use one of {list(DTYPES.keys())}"
+        if precision != 'fp32' and not AUTOCAST_IMPORTED:
+            logger.info(f"Fall back to fp32 from {precision}")
+            precision = 'fp32'
+        self.precision = precision
+        self.device_type = device_type
+        self.dtype = DTYPES[precision]
+        self.enabled = precision != 'fp32'
+        self.scaler = GradScaler(device_type, enabled=precision == 'fp16') if AUTOCAST_IMPORTED else None
+
+    def autocast(self):
+        if not self.enabled:
+            return _NullContext()
+        return autocast(self.device_type, dtype=self.dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None and self.scaler.is_enabled():
+            loss = self.scaler.scale(loss)
+        loss.backward()
+
+    def step(self, solver):
+        if self.scaler is not None and self.scaler.is_enabled():
+            # skipped if the unscaled gradients have inf or nan
+            self.scaler.step(solver.opt)
+        else:
+            solver.step()
+
+    def update(self):
+        # once per iteration, after the steps of all the solvers
+        if self.scaler is not None and self.scaler.is_enabled():
+            self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict() if self.scaler is not None else {}
+
+    def load_state_dict(self, state):
+        if self.scaler is not None and state:
+            self.scaler.load_state_dict(state)
+
+    def keep_fp32(self, graph, names):
+        '''
+        Run the forward of the modules of a graph whose class name is in names in fp32, for
+        the numerically sensitive losses, e.g. the log and pow of FocalLoss or the scaled
+        logits of AMSoftmaxWithLoss. Their half precision inputs are cast to float32.
+
+        Args:
+            graph (BaseGraph): modules are searched in the model, the sub models, the loss head
+                               and the crit dicts of the graph and of its loss head
+        Returns:
+            num_modules (int): number of modules kept in fp32
+        '''
+        if not self.enabled or not names:
+            return 0
+        roots = [graph.model, graph.loss_head] + list(graph.sub_models.values())
+        roots += list(getattr(graph, 'crit', {}).values()) + list(getattr(graph.loss_head, 'crit', {}).values())
+        num_modules = 0
+        visited = set()
+        for root in roots:
+            if not isinstance(root, nn.Module):
+                continue
+            for m in root.modules():
+                if id(m) in visited or type(m).__name__ not in names:
+                    continue
+                visited.add(id(m))
+                # bound to the instance, deepcopy rebinds it to the copy
+                m.forward = types.MethodType(_fp32_forward(type(m).forward, self.device_type), m)
+                num_modules += 1
+        logger.info(f"Keep {num_modules} modules of {list(names)} in fp32 under {self.precision} autocast")
+        return num_modules
+
+def _fp32_forward(forward, device_type):
+    @functools.wraps(forward)
+    def wrapper(self, *args, **kwargs):
+        with autocast(device_type, enabled=False):
+            return forward(self, *_to_float(args), **_to_float(kwargs))
+    return wrapper
+
+class _NullContext():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
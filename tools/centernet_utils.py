@@ -1,5 +1,7 @@
 import numpy as np
 import torch
+import cv2
+from torchvision.ops import batched_nms
 from tools.image import (
     get_affine_transform, 
     affine_transform, 
@@ -11,8 +13,10 @@ from tools.image import (
 
 from tools.utils import (
     _tranpose_and_gather_feat,
+    _gather_feat_at,
     _nms,
     _topk,
+    _sparse_topk,
     _topk_channel,
     transform_preds,
 )
@@ -125,6 +129,28 @@ def centernet_keypoints_target(cls_ids, bboxes, ptss, max_objs, num_classes, num
 
     return rets
 
+def _nearest_keypoints(reg_kps, hm_kps, chunk_size=16):
+    '''
+    Match every regressed keypoint to the nearest heatmap peak of the same joint.
+    The regressed keypoints are processed chunk_size at a time, so the distance tensor
+    is b x J x chunk_size x K instead of b x J x K x K, i.e. linear in K.
+
+    Args:
+        reg_kps (torch.Tensor): b x J x K x 2, keypoints regressed from the centers
+        hm_kps (torch.Tensor): b x J x K x 2, peaks of the keypoint heatmaps
+
+    Returns:
+        min_dist (torch.Tensor): b x J x K
+        min_ind (torch.Tensor): b x J x K, index of the nearest peak
+    '''
+    min_dists, min_inds = [], []
+    for i in range(0, reg_kps.size(2), chunk_size):
+        dist = (((reg_kps[:, :, i:i+chunk_size].unsqueeze(3) - hm_kps.unsqueeze(2)) ** 2).sum(dim=4) ** 0.5)
+        min_dist, min_ind = dist.min(dim=3)
+        min_dists.append(min_dist)
+        min_inds.append(min_ind)
+    return torch.cat(min_dists, dim=2), torch.cat(min_inds, dim=2)
+
 def centernet_pose_decode(heat, wh, kps, reg=None, hm_kp=None, kp_reg=None, K=100):
     batch, cat, height, width = heat.size()
     num_joints = kps.shape[1] // 2
@@ -133,19 +159,19 @@ def centernet_pose_decode(heat, wh, kps, reg=None, hm_kp=None, kp_reg=None, K=10
     heat = _nms(heat)
     scores, inds, clses, ys, xs = _topk(heat, K=K)
   
-    kps = _tranpose_and_gather_feat(kps, inds)
+    kps = _gather_feat_at(kps, inds)
     kps = kps.view(batch, K, num_joints * 2)
     kps[..., ::2] += xs.view(batch, K, 1).expand(batch, K, num_joints)
     kps[..., 1::2] += ys.view(batch, K, 1).expand(batch, K, num_joints)
     if reg is not None:
-        reg = _tranpose_and_gather_feat(reg, inds)
+        reg = _gather_feat_at(reg, inds)
         reg = reg.view(batch, K, 2)
         xs = xs.view(batch, K, 1) + reg[:, :, 0:1]
         ys = ys.view(batch, K, 1) + reg[:, :, 1:2]
     else:
         xs = xs.view(batch, K, 1) + 0.5
         ys = ys.view(batch, K, 1) + 0.5
-    wh = _tranpose_and_gather_feat(wh, inds)
+    wh = _gather_feat_at(wh, inds)
     wh = wh.view(batch, K, 2)
     clses  = clses.view(batch, K, 1).float()
     scores = scores.view(batch, K, 1)
@@ -159,10 +185,9 @@ def centernet_pose_decode(heat, wh, kps, reg=None, hm_kp=None, kp_reg=None, K=10
         thresh = 0.1
         kps = kps.view(batch, K, num_joints, 2).permute(
             0, 2, 1, 3).contiguous() # b x J x K x 2
-        reg_kps = kps.unsqueeze(3).expand(batch, num_joints, K, K, 2)
         hm_score, hm_inds, hm_ys, hm_xs = _topk_channel(hm_kp, K=K) # b x J x K
         if kp_reg is not None:
-            kp_reg = _tranpose_and_gather_feat(
+            kp_reg = _gather_feat_at(
                 kp_reg, hm_inds.view(batch, -1))
             kp_reg = kp_reg.view(batch, num_joints, K, 2)
             hm_xs = hm_xs + kp_reg[:, :, :, 0]
@@ -175,16 +200,11 @@ def centernet_pose_decode(heat, wh, kps, reg=None, hm_kp=None, kp_reg=None, K=10
         hm_score = (1 - mask) * -1 + mask * hm_score
         hm_ys = (1 - mask) * (-10000) + mask * hm_ys
         hm_xs = (1 - mask) * (-10000) + mask * hm_xs
-        hm_kps = torch.stack([hm_xs, hm_ys], dim=-1).unsqueeze(
-            2).expand(batch, num_joints, K, K, 2)
-        dist = (((reg_kps - hm_kps) ** 2).sum(dim=4) ** 0.5)
-        min_dist, min_ind = dist.min(dim=3) # b x J x K
+        hm_kps = torch.stack([hm_xs, hm_ys], dim=-1) # b x J x K x 2
+        min_dist, min_ind = _nearest_keypoints(kps, hm_kps) # b x J x K
         hm_score = hm_score.gather(2, min_ind).unsqueeze(-1) # b x J x K x 1
         min_dist = min_dist.unsqueeze(-1)
-        min_ind = min_ind.view(batch, num_joints, K, 1, 1).expand(
-            batch, num_joints, K, 1, 2)
-        hm_kps = hm_kps.gather(3, min_ind)
-        hm_kps = hm_kps.view(batch, num_joints, K, 2)
+        hm_kps = hm_kps.gather(2, min_ind.unsqueeze(-1).expand(batch, num_joints, K, 2))
         l = bboxes[:, :, 0].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
         t = bboxes[:, :, 1].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
         r = bboxes[:, :, 2].view(batch, 1, K, 1).expand(batch, num_joints, K, 1)
@@ -284,23 +304,30 @@ def centernet_bbox_target(cls_ids, bboxes, ids, max_objs, num_classes, out_sizes
 
     return rets
 
-def centernet_det_decode(heat, wh, reg=None, cat_spec_wh=False, K=100):
+def centernet_det_decode(heat, wh, reg=None, cat_spec_wh=False, K=100, score_thresh=None):
+    '''
+    score_thresh (float): if given, only peaks above it are extracted (sparse path) 
+                          and returned, otherwise the whole heatmap is searched
+    '''
     batch, cat, height, width = heat.size()
     
     # heat = torch.sigmoid(heat)
-    # perform nms on heatmaps
-    heat = _nms(heat)
-      
-    scores, inds, clses, ys, xs = _topk(heat, K=K)
+    if score_thresh is None:
+      # perform nms on heatmaps
+      heat = _nms(heat)
+      scores, inds, clses, ys, xs = _topk(heat, K=K)
+    else:
+      scores, inds, clses, ys, xs = _sparse_topk(heat, K=K, thresh=score_thresh)
+
     if reg is not None:
-      reg = _tranpose_and_gather_feat(reg, inds)
+      reg = _gather_feat_at(reg, inds)
       reg = reg.view(batch, K, 2)
       xs = xs.view(batch, K, 1) + reg[:, :, 0:1]
       ys = ys.view(batch, K, 1) + reg[:, :, 1:2]
     else:
       xs = xs.view(batch, K, 1) + 0.5
       ys = ys.view(batch, K, 1) + 0.5
-    wh = _tranpose_and_gather_feat(wh, inds)
+    wh = _gather_feat_at(wh, inds)
     if cat_spec_wh:
       wh = wh.view(batch, K, cat, 2)
       clses_ind = clses.view(batch, K, 1, 1).expand(batch, K, 1, 2).long()
@@ -309,6 +336,9 @@ def centernet_det_decode(heat, wh, reg=None, cat_spec_wh=False, K=100):
       wh = wh.view(batch, K, 2)
     
     valid_object = wh[:,:,0].gt(0) * wh[:,:,1].gt(0)
+    if score_thresh is not None:
+      # drop the padding of images with less than K peaks
+      valid_object = valid_object * scores.gt(score_thresh)
     
     clses  = clses.view(batch, K, 1).float()
     scores = scores.view(batch, K, 1)
@@ -339,5 +369,96 @@ def centernet_det_post_process(dets, c, s, h, w, num_classes):
     ret.append(top_preds)
   return ret
 
+def generate_tiles(width, height, tile_w, tile_h, overlap=0.2):
+  '''
+  Returns:
+    tiles (list): top-left corners (x, y) of the tiles covering the frame, the last
+                  tile of each row and column is aligned to the border of the frame
+  '''
+  def starts(length, tile):
+    if length <= tile:
+      return [0]
+    stride = max(int(tile * (1 - overlap)), 1)
+    return list(range(0, length - tile, stride)) + [length - tile]
+  return [(x, y) for y in starts(height, tile_h) for x in starts(width, tile_w)]
+
+def _select_det_heads(outputs):
+  # graphs return {'hm', 'wh', 'reg'}, {out_size: {...}} or [{out_size: {...}}, ...] (stacked hourglass)
+  while not (isinstance(outputs, dict) and 'hm' in outputs):
+    if isinstance(outputs, (list, tuple)):
+      outputs = outputs[-1]
+    else:
+      outputs = outputs[list(outputs.keys())[0]]
+  return outputs
+
+def centernet_tiled_det_inference(model, img, input_size, tile_size=None, overlap=0.2, tile_bs=4, preprocess=None, K=100, thresh=0.05, nms_thresh=0.5):
+  '''
+  Detect on a large frame by cutting overlapping tiles, running them through the model
+  tile_bs at a time, mapping the detections back to the frame with the affine helpers
+  and merging them by class-wise NMS. The peak memory depends on tile_bs and input_size
+  only, not on the size of the frame.
+
+  Args:
+    model (nn.Module): CenterNet-style model in eval mode
+    img (numpy.ndarray): HxWx3 frame
+    input_size (tuple): (w, h) of the model input
+    tile_size (tuple): (w, h) of the tiles in frame pixels, default is input_size,
+                       tiles are resized to input_size keeping the aspect ratio
+    overlap (float): overlap ratio of adjacent tiles, should cover the largest object
+    tile_bs (int): number of tiles per forward
+    preprocess (callable): HxWx3 numpy.ndarray => 3xHxW torch.Tensor, default scales to [0, 1]
+    K (int): number of candidates decoded on each tile
+    thresh (float): score threshold
+    nms_thresh (float): IoU threshold of the cross-tile NMS
+
+  Returns:
+    dets (numpy.ndarray): Nx6, [x1, y1, x2, y2, score, class] in frame coordinates
+  '''
+  if preprocess is None:
+    preprocess = lambda x: torch.from_numpy(x).permute(2, 0, 1).float() / 255.0
+  h, w = img.shape[:2]
+  in_w, in_h = input_size
+  tile_w, tile_h = tile_size if tile_size is not None else input_size
+  tiles = generate_tiles(w, h, tile_w, tile_h, overlap)
+  border = tuple(int(v) for v in img.reshape(-1, img.shape[2]).mean(axis=0))
+  weight = next(iter(model.parameters()))
 
+  all_dets = []
+  for i in range(0, len(tiles), tile_bs):
+    inps, cs, ss = [], [], []
+    for x, y in tiles[i:i+tile_bs]:
+      c = np.array([x + tile_w / 2., y + tile_h / 2.], dtype=np.float32)
+      s = max(tile_w, tile_h * in_w / in_h) * 1.0
+      trans = get_affine_transform(c, s, 0, [in_w, in_h])
+      tile = cv2.warpAffine(img, trans, (in_w, in_h), flags=cv2.INTER_LINEAR, borderValue=border)
+      inps.append(preprocess(tile))
+      cs.append(c)
+      ss.append(s)
+    inps = torch.stack(inps).to(device=weight.device, dtype=weight.dtype)
+    with torch.no_grad():
+      feat = _select_det_heads(model(inps))
+      hm = feat['hm'].float().sigmoid()
+      out_h, out_w = hm.shape[2:]
+      for j in range(hm.size(0)):
+        # decode tile by tile since the decoded detections are not grouped by batch
+        dets = centernet_det_decode(
+          hm[j:j+1], 
+          feat['wh'][j:j+1].float(), 
+          reg=feat['reg'][j:j+1].float() if 'reg' in feat else None, 
+          K=K,
+          score_thresh=thresh
+        ).cpu().numpy()
+        if len(dets) == 0:
+          continue
+        dets[:, :2] = transform_preds(dets[:, 0:2], cs[j], ss[j], (out_w, out_h))
+        dets[:, 2:4] = transform_preds(dets[:, 2:4], cs[j], ss[j], (out_w, out_h))
+        all_dets.append(dets)
+    del inps, feat, hm
 
+  if len(all_dets) == 0:
+    return np.zeros((0, 6), dtype=np.float32)
+  dets = torch.from_numpy(np.concatenate(all_dets, axis=0)).float()
+  dets[:, [0, 2]] = dets[:, [0, 2]].clamp(0, w - 1)
+  dets[:, [1, 3]] = dets[:, [1, 3]].clamp(0, h - 1)
+  keep = batched_nms(dets[:, :4], dets[:, 4], dets[:, 5].long(), nms_thresh)
+  return dets[keep].numpy()
@@ -0,0 +1,178 @@
+import os
+import atexit
+import random
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import logging
+logger = logging.getLogger("logger")
+
+LATEST = "latest"
+
+def checkpoint_name(epoch, metric=None, iteration=None):
+    if metric is None:
+        # in the middle of an epoch, without a metric
+        return 'model_{:03}_iter{:07}.pth'.format(epoch, iteration)
+    return 'model_{:03}_{:.4f}.pth'.format(epoch, metric)
+
+def rng_state():
+    '''
+    States of the python, numpy and torch random generators, for the exact resume of a run.
+    The numpy keys are kept as a tensor so that the checkpoint loads with weights_only.
+    '''
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def snapshot(state):
+    '''
+    Copy of a (nested) state dict whose tensors are detached CPU copies, so that training can
+    go on updating the parameters and the optimizer states while the copy is serialized
+    '''
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, snapshot(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+def atomic_save(state, path):
+    '''
+    torch.save to a temporary file renamed to path, an interrupted save never leaves a
+    partial checkpoint at path
+    '''
+    tmp = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def atomic_write_text(path, text):
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def latest_checkpoint(path):
+    '''
+    Returns:
+        checkpoint (str): path of the checkpoint of the latest pointer of a directory, "" if none
+    '''
+    pointer = os.path.join(path, LATEST)
+    if not os.path.exists(pointer):
+        return ""
+    with open(pointer) as f:
+        name = f.read().strip()
+    return os.path.join(path, name) if name and os.path.exists(os.path.join(path, name)) else ""
+
+class CheckpointManager():
+    '''
+    Checkpoints of a training run written by a background thread. save() only copies the
+    state to CPU, the serialization, the atomic rename, the update of the latest pointer and
+    the pruning happen in the thread, one checkpoint at a time in the order of the calls.
+
+    Among the checkpoints written by the manager, the keep_last most recent ones and the
+    keep_best ones with the best metric are kept, the others are removed. The other files of
+    the directory, e.g. the checkpoints of previous runs, are never removed. The checkpoints
+    saved in the middle of an epoch have no metric and only count as recent ones.
+
+    Args:
+        path (str): directory of the checkpoints
+        keep_last (int): number of most recent checkpoints to keep
+        keep_best (int): number of best checkpoints to keep
+        mode (str): 'max' if a higher metric is better, e.g. accuracy, 'min' for a loss
+        async_save (bool): serialize in the background thread, in the caller otherwise
+    '''
+    def __init__(self, path, keep_last=1, keep_best=1, mode='max', async_save=True):
+        assert mode in ['max', 'min'], f"Unknown mode {mode}"
+        self.path = path
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_save else None
+        self.pending = []
+        # (epoch, iteration), metric and name of the checkpoints written by the manager
+        self.written = []
+        atexit.register(self.wait, raise_errors=False)
+
+    def save(self, state, epoch, metric=None, iteration=None):
+        '''
+        Args:
+            state (dict): e.g. BaseGraph.checkpoint_state, it is copied before returning
+            metric (float): None for a checkpoint in the middle of an epoch, named by iteration
+        Returns:
+            path (str): path of the checkpoint once written
+        '''
+        name = checkpoint_name(epoch, metric, iteration)
+        # the checkpoint of an evaluation comes after those in the middle of the same epoch
+        entry = ((epoch, float('inf') if metric is not None else iteration), metric, name)
+        state = snapshot(state)
+        if self.executor is None:
+            self._write(state, entry)
+        else:
+            # raise the errors of the finished writes
+            for future in [f for f in self.pending if f.done()]:
+                self.pending.remove(future)
+                future.result()
+            self.pending.append(self.executor.submit(self._write, state, entry))
+        return os.path.join(self.path, name)
+
+    def wait(self, raise_errors=True):
+        '''
+        Block until the pending checkpoints are written
+
+        Args:
+            raise_errors (bool): raise the error of a failed write, log it otherwise
+        '''
+        pending, self.pending = self.pending, []
+        for future in pending:
+            try:
+                future.result()
+            except Exception:
+                if raise_errors:
+                    raise
+                logger.exception("Failed to write a checkpoint")
+
+    def _write(self, state, entry):
+        name = entry[2]
+        atomic_save(state, os.path.join(self.path, name))
+        atomic_write_text(os.path.join(self.path, LATEST), name)
+        # a checkpoint saved again under the same name replaces the previous entry
+        self.written = [c for c in self.written if c[2] != name] + [entry]
+        self._prune(name)
+        logger.info(f"Checkpoint {name} saved")
+
+    def _prune(self, latest):
+        recent = sorted(self.written, key=lambda c: (c[0], c[2] == latest), reverse=True)[:self.keep_last]
+        sign = -1 if self.mode == 'max' else 1
+        scored = [c for c in self.written if c[1] is not None]
+        best = sorted(scored, key=lambda c: (sign * c[1], -c[0][0]))[:self.keep_best]
+        keep = {c[2] for c in recent + best} | {latest}
+        for _, _, name in self.written:
+            path = os.path.join(self.path, name)
+            if name not in keep and os.path.exists(path):
+                os.remove(path)
+        self.written = [c for c in self.written if c[2] in keep]
@@ -0,0 +1,156 @@
+import time
+import inspect
+import numpy as np
+import torch
+import torch.nn as nn
+import logging
+logger = logging.getLogger("logger")
+
+try:
+    import onnxruntime as ort
+    ORT_IMPORTED = True
+except:
+    logger.info("Install onnxruntime first")
+    ORT_IMPORTED = False
+
+def flatten_outputs(outputs):
+    '''
+    Flatten the (nested) output of a graph model into a list of tensors.
+
+    Graph models return tensors, tuples / lists of tensors or (nested) dicts, e.g.
+    {'neck': x, 'local': y, 'global': z} or {(w, h): {'hm': x, 'wh': y, 'reg': z}},
+    entries which are None (e.g. 'embb' in training mode) are dropped.
+    The order follows the order of the model output, so it is stable across runs.
+    '''
+    if outputs is None:
+        return []
+    if isinstance(outputs, torch.Tensor):
+        return [outputs]
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    flat = []
+    for output in outputs:
+        flat.extend(flatten_outputs(output))
+    return flat
+
+class FlattenOutput(nn.Module):
+    '''
+    Wrap a graph model so that it returns a flat tuple of tensors, which is the
+    only output format both torch.jit.trace and torch.onnx.export accept for every graph.
+    '''
+    def __init__(self, model):
+        super(FlattenOutput, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return tuple(flatten_outputs(self.model(x)))
+
+def export_torchscript(model, inputs, path, mode='trace'):
+    '''
+    torch.jit.script can not compile flatten_outputs, in script mode the graph model inside
+    FlattenOutput is scripted and saved, its outputs are flattened outside of the scripted module.
+
+    Args:
+        model (nn.Module): model in eval mode, returns a flat tuple of tensors
+        inputs (torch.Tensor): example input for tracing
+        path (str): path of the saved .pt file
+        mode (str): 'trace' or 'script'
+    Returns:
+        runner (nn.Module): the saved model loaded back, returns a flat tuple of tensors
+    '''
+    with torch.no_grad():
+        if mode == 'trace':
+            ts_model = torch.jit.trace(model, (inputs,), check_trace=False)
+        elif mode == 'script':
+            ts_model = torch.jit.script(model.model if isinstance(model, FlattenOutput) else model)
+        else:
+            raise ValueError(f"Unknown torchscript mode {mode}")
+    ts_model.save(path)
+    ts_model = torch.jit.load(path)
+    return FlattenOutput(ts_model) if mode == 'script' else ts_model
+
+def export_onnx(model, inputs, path, opset_version=11):
+    '''
+    Export the model with dynamic batch size. The outputs are named output_0, output_1, ...
+    following the order of flatten_outputs.
+    '''
+    with torch.no_grad():
+        num_outputs = len(model(inputs))
+    output_names = [f"output_{i}" for i in range(num_outputs)]
+    dynamic_axes = {name: {0: 'batch'} for name in ['input'] + output_names}
+    kwargs = {}
+    # newer pytorch uses the dynamo based exporter by default
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    torch.onnx.export(
+        model,
+        (inputs,),
+        path,
+        input_names=['input'],
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+        **kwargs
+    )
+
+def build_onnx_runner(path, num_threads=1):
+    '''
+    Return a callable which takes a torch.Tensor and returns the outputs of onnxruntime
+    as a list of torch.Tensor, same as the format of FlattenOutput.
+    '''
+    assert ORT_IMPORTED, "onnxruntime is not installed"
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+    def run(x):
+        outputs = session.run(None, {'input': x.numpy()})
+        return [torch.from_numpy(output) for output in outputs]
+    return run
+
+def check_parity(reference, candidate, inputs):
+    '''
+    Compare the flattened outputs of two runners on the same inputs.
+
+    Returns:
+        max_diff (float): the maximum absolute difference among all outputs,
+                          inf if the number or the shapes of outputs are different
+    '''
+    with torch.no_grad():
+        ref_outputs = flatten_outputs(reference(inputs))
+        outputs = flatten_outputs(candidate(inputs))
+    if len(ref_outputs) != len(outputs):
+        return float('inf')
+    max_diff = 0.0
+    for ref, out in zip(ref_outputs, outputs):
+        if ref.shape != out.shape:
+            return float('inf')
+        if ref.numel() > 0:
+            max_diff = max(max_diff, (ref.float() - out.float()).abs().max().item())
+    return max_diff
+
+def benchmark_runner(runner, inputs, warmup=5, iters=20):
+    '''
+    Returns:
+        latency (float): median latency of one forward in ms
+        throughput (float): images per second based on the median latency
+    '''
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + iters):
+            start = time.perf_counter()
+            runner(inputs)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    latency = float(np.median(times))
+    return latency * 1000, inputs.size(0) / latency
+
+def format_table(rows, headers):
+    widths = [max(len(str(h)), *[len(str(row[i])) for row in rows]) if rows else len(str(h)) for i, h in enumerate(headers)]
+    lines = []
+    lines.append(" | ".join(f"{str(h):>{w}}" for h, w in zip(headers, widths)))
+    lines.append("-+-".join("-" * w for w in widths))
+    for row in rows:
+        lines.append(" | ".join(f"{str(v):>{w}}" for v, w in zip(row, widths)))
+    return "\n".join(lines)
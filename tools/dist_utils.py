@@ -0,0 +1,84 @@
+import torch
+import torch.distributed as dist
+from torch.utils.data import distributed
+import logging
+logger = logging.getLogger("logger")
+
+def is_dist():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_dist() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_dist() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def test_sampler(cfg, dataset):
+    '''
+    Sampler of a test loader, each rank gets a fixed interleaved shard of the dataset when
+    cfg.DISTRIBUTED, DistributedSampler pads the shards to the same length by repeating the
+    first samples.
+
+    Returns:
+        sampler (DistributedSampler or None): None for the sequential order of the dataset
+    '''
+    if cfg.DISTRIBUTED:
+        return distributed.DistributedSampler(dataset, shuffle=False)
+    return None
+
+def all_gather_object(obj):
+    '''
+    Returns:
+        objs (list): the objects of all the ranks, in rank order
+    '''
+    if get_world_size() == 1:
+        return [obj]
+    objs = [None] * get_world_size()
+    dist.all_gather_object(objs, obj)
+    return objs
+
+def all_gather_tensor(tensor):
+    '''
+    all_gather of tensors whose first dimension differs across the ranks, the tensors are
+    padded to the longest one and moved to the device of the backend, cpu for gloo
+
+    Returns:
+        tensors (list): the tensors of all the ranks, in rank order, on the device of tensor
+    '''
+    if get_world_size() == 1:
+        return [tensor]
+    device = tensor.device
+    backend_device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+    tensor = tensor.to(backend_device)
+    size = torch.tensor([tensor.size(0)], device=backend_device)
+    sizes = [torch.zeros_like(size) for _ in range(get_world_size())]
+    dist.all_gather(sizes, size)
+    sizes = [int(s.item()) for s in sizes]
+
+    padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]))
+    padded[:tensor.size(0)] = tensor
+    tensors = [torch.zeros_like(padded) for _ in sizes]
+    dist.all_gather(tensors, padded)
+    return [t[:s].to(device) for t, s in zip(tensors, sizes)]
+
+def gather_by_index(tensor, indices, num_samples):
+    '''
+    Gather the per-sample results of all the ranks and put each row at its dataset index, the
+    rows of the samples repeated by the padding of DistributedSampler are written once.
+
+    Args:
+        tensor (torch.Tensor): N x ... results of the samples of this rank
+        indices (torch.Tensor): N dataset indices of the rows, e.g. list(loader.sampler)
+        num_samples (int): size of the dataset
+    Returns:
+        tensor (torch.Tensor): num_samples x ... results in the order of the dataset
+    '''
+    tensors = all_gather_tensor(tensor)
+    indices = all_gather_tensor(torch.as_tensor(indices, dtype=torch.long))
+    out = tensor.new_zeros((num_samples,) + tuple(tensor.shape[1:]))
+    for t, i in zip(tensors, indices):
+        out[i] = t
+    return out
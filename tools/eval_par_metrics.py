@@ -3,31 +3,49 @@ import numpy as np
 import copy
 from collections import defaultdict
 import sys
-from sklearn.metrics import f1_score, recall_score, precision_score
-from tqdm import tqdm
 
-def eval_par_accuracy(predict_proba, gt):
-    known_gt = gt > -1 
+def eval_par_accuracy(predict_proba, gt, thresholds=None):
+    '''
+    Precision and recall of each attribute at the thresholds 0.00, 0.01, ..., 0.99, the samples
+    with an unknown label (-1) are ignored per attribute.
 
-    attr_precs = []
-    attr_recalls = []  
-    
-    for thresh in tqdm(range(0, 100), desc="PAR Accuracy"):
-        thresh *= 0.01
-        predict = np.zeros_like(predict_proba)
-        predict[predict_proba >= thresh] = 1
-        attr_prec = []
-        attr_recall = [] 
-        for i in range(known_gt.shape[1]):
-            p = precision_score(gt[:,i][known_gt[:,i]], predict[:,i][known_gt[:,i]], average='binary')
-            r = recall_score(gt[:,i][known_gt[:,i]], predict[:,i][known_gt[:,i]], average='binary')    
-            attr_prec.append(p)
-            attr_recall.append(r)
+    The scores are sorted once per attribute and the number of predicted and true positives at
+    every threshold are read from cumulative sums, precision and recall are 0 when undefined
+    as in sklearn.
 
-        attr_precs.append(attr_prec)
-        attr_recalls.append(attr_recall)
+    Args:
+        predict_proba (numpy.ndarray): N x num_attrs scores
+        gt (numpy.ndarray): N x num_attrs labels, 1, 0 or -1 if unknown
+        thresholds (numpy.ndarray): thresholds of the curves, a sample is predicted positive
+                                    if its score >= threshold
+    Returns:
+        attr_precs (numpy.ndarray): num_thresholds x num_attrs
+        attr_recalls (numpy.ndarray): num_thresholds x num_attrs
+    '''
+    if thresholds is None:
+        thresholds = np.arange(100) * 0.01
+    # compare in the precision of the scores, as the scalar thresholds of the original loop
+    dtype = predict_proba.dtype if np.issubdtype(predict_proba.dtype, np.floating) else np.float64
+    thresholds = np.asarray(thresholds).astype(dtype)
 
-    attr_precs = np.array(attr_precs)
-    attr_recalls = np.array(attr_recalls)
+    known_gt = gt > -1
+    positive = known_gt & (gt == 1)
+    # unknown samples are never counted as predicted positives
+    scores = np.where(known_gt, predict_proba, -np.inf).astype(dtype)
+    order = np.argsort(-scores, axis=0, kind='stable')
+    sorted_scores = np.take_along_axis(scores, order, 0)
+    # true positives among the n highest scores, n = 0 ... N
+    tps = np.concatenate([np.zeros((1, gt.shape[1]), dtype=np.int64),
+                          np.cumsum(np.take_along_axis(positive, order, 0), axis=0)])
+
+    # number of scores >= each threshold, from the ascending scores of each attribute
+    num_pred = np.empty((len(thresholds), gt.shape[1]), dtype=np.int64)
+    for i in range(gt.shape[1]):
+        num_pred[:, i] = len(scores) - np.searchsorted(sorted_scores[::-1, i], thresholds, side='left')
+    tp = np.take_along_axis(tps, num_pred, 0)
+    num_pos = positive.sum(axis=0)
+
+    attr_precs = np.divide(tp, num_pred, out=np.zeros(tp.shape), where=num_pred > 0)
+    attr_recalls = np.divide(tp, num_pos, out=np.zeros(tp.shape), where=num_pos > 0)
 
     return attr_precs, attr_recalls
@@ -1,169 +1,324 @@
 from __future__ import print_function, absolute_import
 import numpy as np
+import torch
+import torch.nn.functional as F
 import copy
-from collections import defaultdict
 import sys
 from tqdm import tqdm
 import seaborn as sns
 import matplotlib.pyplot as plt
 import pandas as pd
 
-def eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, N=100):
+def eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, N=100, seed=None, chunk_size=0):
     """Evaluation with cuhk03 metric
     Key: one image for each gallery identity is randomly sampled for each query identity.
     Random sampling is performed N times (default: N=100).
+
+    The sampling is vectorized over queries and repeats. As every identity keeps one image, 
+    each repeat has exactly one correct match whose rank is the number of sampled images 
+    ranked before it, so CMC and AP of a repeat follow from that rank.
+
+    Args:
+        seed (int): seed of the sampling, the global numpy random state is used if None
+        chunk_size (int): number of queries processed at once, 0 for auto
     """
     num_q, num_g = distmat.shape
-    if num_g < max_rank:
-        max_rank = num_g
-        print("Note: number of gallery samples is quite small, got {}".format(num_g))
-    indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
-
-    # compute cmc curve for each query
-    all_cmc = []
-    all_AP = []
-    num_valid_q = 0. # number of valid query
-    for q_idx in range(num_q):
-        # get query pid and camid
-        q_pid = q_pids[q_idx]
-        q_camid = q_camids[q_idx]
-
-        # remove gallery samples that have the same pid and camid with query
-        order = indices[q_idx]
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-        keep = np.invert(remove)
-
-        # compute cmc curve
-        orig_cmc = matches[q_idx][keep] # binary vector, positions with value 1 are correct matches
-        if not np.any(orig_cmc):
-            # this condition is true when query identity does not appear in gallery
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    g_order = np.argsort(g_pids, kind='stable')
+    pids, starts, counts = np.unique(g_pids[g_order], return_index=True, return_counts=True)
+    num_pids = len(pids)
+    if num_pids < max_rank:
+        max_rank = num_pids
+        print("Note: number of gallery identities is quite small, got {}".format(num_pids))
+    # the identity of the query only keeps its correct matches, it is sampled separately
+    q_groups = np.minimum(np.searchsorted(pids, q_pids), num_pids - 1)
+    goods, _ = _group_by_pid(q_pids, q_camids, g_pids, g_camids)
+    num_goods = np.array([len(good) for good in goods])
+
+    if chunk_size <= 0:
+        chunk_size = _chunk_size(max(num_g, N * num_pids))
+    all_cmc, all_AP = [], []
+    for start, end in tqdm(list(_iter_chunks(num_q, chunk_size)), desc="CMC"):
+        valid = num_goods[start:end] > 0
+        if not valid.any():
             continue
-
-        kept_g_pids = g_pids[order][keep] 
-        g_pids_dict = defaultdict(list)
-        for idx, pid in enumerate(kept_g_pids):
-            g_pids_dict[pid].append(idx)
-
-        cmc, AP = 0., 0.
-        for repeat_idx in range(N):
-            mask = np.zeros(len(orig_cmc), dtype=np.bool)
-            for _, idxs in g_pids_dict.items():
-                # randomly sample one image for each gallery person
-                rnd_idx = np.random.choice(idxs)
-                mask[rnd_idx] = True
-            masked_orig_cmc = orig_cmc[mask]
-            _cmc = masked_orig_cmc.cumsum()
-            _cmc[_cmc > 1] = 1
-            cmc += _cmc[:max_rank].astype(np.float32)
-            # compute AP
-            num_rel = masked_orig_cmc.sum()
-            tmp_cmc = masked_orig_cmc.cumsum()
-            tmp_cmc = [x / (i+1.) for i, x in enumerate(tmp_cmc)]
-            tmp_cmc = np.asarray(tmp_cmc) * masked_orig_cmc
-            AP += tmp_cmc.sum() / num_rel
-        cmc /= N
-        AP /= N
-        all_cmc.append(cmc)
-        all_AP.append(AP)
-        num_valid_q += 1.
-
+        idxs = np.arange(start, end)[valid]
+        num_c = len(idxs)
+        rows = np.arange(num_c)[:, np.newaxis]
+        # position of each gallery sample in the ranking of each query
+        order = np.argsort(distmat[idxs], axis=1)
+        position = np.empty_like(order)
+        position[rows, order] = np.arange(num_g)
+
+        # one random image for each identity and repeat
+        offsets = (rng.random_sample((num_c, N, num_pids)) * counts).astype(np.int64)
+        sampled = g_order[starts + offsets].reshape(num_c, -1)
+        sampled = position[rows, sampled].reshape(num_c, N, num_pids)
+        sampled[np.arange(num_c), :, q_groups[idxs]] = num_g
+        good = _pad([goods[i] for i in idxs]).numpy()
+        picks = (rng.random_sample((num_c, N)) * num_goods[idxs][:, np.newaxis]).astype(np.int64)
+        matched = position[rows, good[rows, picks]]
+
+        rank = (sampled < matched[:, :, np.newaxis]).sum(axis=2)
+        all_cmc.append((np.arange(max_rank) >= rank[:, :, np.newaxis]).sum(axis=1) / N)
+        all_AP.append((1. / (rank + 1.)).sum(axis=1) / N)
+
+    num_valid_q = float((num_goods > 0).sum())
     assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
 
-    all_cmc = np.asarray(all_cmc).astype(np.float32)
+    all_cmc = np.concatenate(all_cmc).astype(np.float32)
     all_cmc = all_cmc.sum(0) / num_valid_q
-    mAP = np.mean(all_AP)
+    mAP = np.mean(np.concatenate(all_AP))
 
     return all_cmc, mAP
 
-def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
+def _chunk_size(num_g, budget=2**24):
+    # number of queries per chunk so that a chunk of the ranking has about budget entries
+    return max(1, budget // max(num_g, 1))
+
+def _iter_chunks(num, chunk_size):
+    for start in range(0, num, chunk_size):
+        yield start, min(start + chunk_size, num)
+
+def _market1501_chunk(order, q_pids, g_pids, q_camids, g_camids, with_ap=True):
+    """Ranking statistics of a chunk of queries, junk (same pid and camid) removed
+    Args:
+        order (numpy.ndarray, Qc x R): gallery indices sorted by distance, R can be less than num_g
+    Return:
+        first (numpy.ndarray, Qc): rank of the first correct match, -1 if there is none in order
+        AP (numpy.ndarray, Qc): average precision, nan if there is no correct match
+    """
+    num_q = order.shape[0]
+    matches = g_pids[order] == q_pids[:, np.newaxis]
+    keep = ~(matches & (g_camids[order] == q_camids[:, np.newaxis]))
+    good = matches & keep
+    # rank of each gallery sample after removing the junk ones
+    rank = np.cumsum(keep, axis=1, dtype=np.int32) - 1
+
+    has_good = good.any(axis=1)
+    first = np.where(has_good, rank[np.arange(num_q), good.argmax(axis=1)], -1)
+    if not with_ap:
+        return first, None
+
+    rows, cols = np.nonzero(good)
+    # the k-th correct match at rank r contributes k / (r + 1)
+    num_good = np.cumsum(good, axis=1, dtype=np.int32)[rows, cols]
+    precision = num_good / (rank[rows, cols] + 1.)
+    num_rel = good.sum(axis=1)
+    AP = np.full(num_q, np.nan)
+    AP[has_good] = np.bincount(rows, weights=precision, minlength=num_q)[has_good] / num_rel[has_good]
+    return first, AP
+
+def _cmc_from_first(first, max_rank):
+    valid = first >= 0
+    num_valid_q = valid.sum()
+    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
+    counts = np.bincount(np.minimum(first[valid], max_rank), minlength=max_rank + 1)[:max_rank]
+    return np.cumsum(counts).astype(np.float32) / float(num_valid_q)
+
+def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, chunk_size=0, cmc_only=False):
     """Evaluation with market1501 metric
     Key: for each query identity, its gallery images from the same camera view are discarded.
+
+    Queries are processed in vectorized chunks of chunk_size (0 for auto), the results are 
+    the same as the per-query loop. If cmc_only, only the first max_rank (plus junk) 
+    candidates are ranked with argpartition and mAP is None, exact ties at the boundary 
+    may be ordered differently from the full argsort in this case.
     """
     num_q, num_g = distmat.shape
     if num_g < max_rank:
         max_rank = num_g
         print("Note: number of gallery samples is quite small, got {}".format(num_g))
-    indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
-
-    # compute cmc curve for each query
-    all_cmc = []
-    all_AP = []
-    num_valid_q = 0. # number of valid query
-
-    for q_idx in tqdm(range(num_q), desc="CMC"):
-        # get query pid and camid
-        q_pid = q_pids[q_idx]
-        q_camid = q_camids[q_idx]
-
-        # remove gallery samples that have the same pid and camid with query
-        order = indices[q_idx]
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-        keep = np.invert(remove)
+    if chunk_size <= 0:
+        chunk_size = _chunk_size(num_g)
+
+    firsts, APs = [], []
+    for start, end in tqdm(list(_iter_chunks(num_q, chunk_size)), desc="CMC"):
+        dist = distmat[start:end]
+        if cmc_only:
+            # enough candidates to keep max_rank ones after removing the junk
+            same_pid = g_pids[np.newaxis, :] == q_pids[start:end, np.newaxis]
+            junk = same_pid & (g_camids[np.newaxis, :] == q_camids[start:end, np.newaxis])
+            has_good = (same_pid & ~junk).any(axis=1)
+            num_cand = min(num_g, max_rank + int(junk.sum(axis=1).max()))
+            if num_cand < num_g:
+                cand = np.argpartition(dist, num_cand - 1, axis=1)[:, :num_cand]
+                order = np.take_along_axis(cand, np.argsort(np.take_along_axis(dist, cand, axis=1), axis=1), axis=1)
+            else:
+                order = np.argsort(dist, axis=1)
+        else:
+            order = np.argsort(dist, axis=1)
+        first, AP = _market1501_chunk(order, q_pids[start:end], g_pids, q_camids[start:end], g_camids, with_ap=not cmc_only)
+        if cmc_only:
+            # the first correct match is out of the candidates
+            first[(first < 0) & has_good] = max_rank
+        firsts.append(first)
+        APs.append(AP)
+
+    first = np.concatenate(firsts)
+    all_cmc = _cmc_from_first(first, max_rank)
+    if cmc_only:
+        return all_cmc, None
+    AP = np.concatenate(APs)
+    mAP = np.mean(AP[first >= 0])
 
-        # compute cmc curve
-        orig_cmc = matches[q_idx][keep] # binary vector, positions with value 1 are correct matches
-
-        if not np.any(orig_cmc):
-            # this condition is true when query identity does not appear in gallery
-            continue
-
-        cmc = orig_cmc.cumsum()
-        cmc[cmc > 1] = 1
-
-        all_cmc.append(cmc[:max_rank])
-        num_valid_q += 1.
-
-        # compute average precision
-        # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-        num_rel = orig_cmc.sum()
-        tmp_cmc = orig_cmc.cumsum()
-        tmp_cmc = [x / (i+1.) for i, x in enumerate(tmp_cmc)]
-        tmp_cmc = np.asarray(tmp_cmc) * orig_cmc
-        AP = tmp_cmc.sum() / num_rel
-        all_AP.append(AP)
+    return all_cmc, mAP
 
-    assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
-
-    all_cmc = np.asarray(all_cmc).astype(np.float32)
-    all_cmc = all_cmc.sum(0) / num_valid_q
-    mAP = np.mean(all_AP)
+def _cosine_dist(qf, gf):
+    return 1 - F.linear(qf, gf)
 
+def _group_by_pid(q_pids, q_camids, g_pids, g_camids):
+    """For each query, the gallery indices of correct matches and of junk (same pid and camid)
+    Return:
+        good (list): numpy arrays of gallery indices in ascending order
+        junk (list): same as good
+    """
+    order = np.argsort(g_pids, kind='stable')
+    pids, starts, counts = np.unique(g_pids[order], return_index=True, return_counts=True)
+    members = {pid: order[start:start+count] for pid, start, count in zip(pids, starts, counts)}
+    empty = np.zeros(0, dtype=np.int64)
+    good, junk = [], []
+    for q_pid, q_camid in zip(q_pids, q_camids):
+        idxs = members.get(q_pid, empty)
+        same_cam = g_camids[idxs] == q_camid
+        good.append(idxs[~same_cam])
+        junk.append(idxs[same_cam])
+    return good, junk
+
+def _pad(arrays, value=-1):
+    # list of 1-D index arrays => padded LongTensor, at least 1 column
+    width = max(1, max(len(a) for a in arrays))
+    padded = np.full((len(arrays), width), value, dtype=np.int64)
+    for i, a in enumerate(arrays):
+        padded[i, :len(a)] = a
+    return torch.from_numpy(padded)
+
+def evaluate_streaming(qf, gf, q_pids, g_pids, q_camids, g_camids, max_rank=50, dist_fn=_cosine_dist, q_tile=1024, g_tile=16384, topk=0):
+    """Evaluation with market1501 metric without materializing the num_q x num_g distance matrix
+
+    The distances are computed tile by tile (q_tile x g_tile) twice. The first pass collects 
+    the distances of the correct matches (and the top-k candidates), the second pass counts, 
+    for each correct match, the gallery samples ranked before it, which is all CMC and mAP need. 
+    Junk samples are ignored and exactly tied distances are ranked by gallery index, i.e. the 
+    results equal evaluate() with a stable argsort of the same distances.
+
+    Args:
+        qf (torch.Tensor or FeatureStore): num_q x d query features
+        gf (torch.Tensor or FeatureStore): num_g x d gallery features, only sliced tile by tile
+        dist_fn (callable): (q_tile x d, g_tile x d) => q_tile x g_tile distances, default 1 - cosine
+        topk (int): also return the top-k gallery indices and distances of each query
+    Return:
+        cmc (numpy.ndarray), mAP (float)
+        topk_inds (numpy.ndarray, num_q x topk), topk_dists (numpy.ndarray, num_q x topk) if topk > 0
+    """
+    num_q, num_g = len(qf), len(gf)
+    if num_g < max_rank:
+        max_rank = num_g
+        print("Note: number of gallery samples is quite small, got {}".format(num_g))
+    q_pids, g_pids = np.asarray(q_pids), np.asarray(g_pids)
+    q_camids, g_camids = np.asarray(q_camids), np.asarray(g_camids)
+    goods, junks = _group_by_pid(q_pids, q_camids, g_pids, g_camids)
+
+    firsts, APs, topk_inds, topk_dists = [], [], [], []
+    for start, end in tqdm(list(_iter_chunks(num_q, q_tile)), desc="CMC"):
+        q = qf[start:end]
+        rows = torch.arange(end - start).view(-1, 1)
+        good = _pad(goods[start:end])
+        junk = _pad(junks[start:end])
+        good_dist = torch.full(good.shape, float('inf'))
+        num_before = torch.zeros(good.shape, dtype=torch.long)
+        cand_dist, cand_ind = None, None
+
+        def tile_dist(g_start, g_end):
+            if dist_fn is _cosine_dist and hasattr(gf, 'similarity'):
+                # on the stored values of a FeatureStore, the tile is not decoded
+                dist = 1 - gf.similarity(q, g_start, g_end)
+            else:
+                dist = dist_fn(q, gf[g_start:g_end]).float()
+            in_tile = (junk >= g_start) & (junk < g_end)
+            dist[rows.expand_as(junk)[in_tile], junk[in_tile] - g_start] = float('inf')
+            return dist, (good >= g_start) & (good < g_end)
+
+        # pass 1: distances of the correct matches and top-k candidates
+        for g_start, g_end in _iter_chunks(num_g, g_tile):
+            dist, in_tile = tile_dist(g_start, g_end)
+            good_dist[in_tile] = dist[rows.expand_as(good)[in_tile], good[in_tile] - g_start]
+            if topk > 0:
+                k = min(topk, g_end - g_start)
+                d, i = torch.topk(dist, k, dim=1, largest=False)
+                if cand_dist is not None:
+                    d, i = torch.cat([cand_dist, d], 1), torch.cat([cand_ind, i + g_start], 1)
+                    d, j = torch.topk(d, min(topk, d.size(1)), dim=1, largest=False)
+                    i = i.gather(1, j)
+                else:
+                    i = i + g_start
+                cand_dist, cand_ind = d, i
+
+        # pass 2: number of gallery samples ranked before each correct match
+        for g_start, g_end in _iter_chunks(num_g, g_tile):
+            dist, in_tile = tile_dist(g_start, g_end)
+            sorted_dist, perm = torch.sort(dist, dim=1, stable=True)
+            position = torch.empty_like(perm)
+            position.scatter_(1, perm, torch.arange(g_end - g_start).expand_as(perm))
+            less = torch.searchsorted(sorted_dist, good_dist, right=False)
+            less_equal = torch.searchsorted(sorted_dist, good_dist, right=True)
+            # ties before the match count, ties after it do not
+            count = torch.where(good >= g_end, less_equal, less)
+            count = torch.where(in_tile, position.gather(1, (good - g_start).clamp(0, g_end - g_start - 1)), count)
+            num_before += count
+
+        # same reduction as eval_market1501, the k-th correct match at rank r contributes k / (r + 1)
+        valid = good >= 0
+        rank = torch.where(valid, num_before, torch.full_like(num_before, num_g)).sort(dim=1)[0].numpy()
+        valid = valid.sum(1).numpy()
+        has_good = valid > 0
+        first = np.where(has_good, rank[:, 0], -1)
+        r, c = np.nonzero(np.arange(rank.shape[1])[np.newaxis, :] < valid[:, np.newaxis])
+        precision = (c + 1) / (rank[r, c] + 1.)
+        AP = np.full(end - start, np.nan)
+        AP[has_good] = np.bincount(r, weights=precision, minlength=end - start)[has_good] / valid[has_good]
+        firsts.append(first)
+        APs.append(AP)
+        if topk > 0:
+            topk_inds.append(cand_ind.numpy())
+            topk_dists.append(cand_dist.numpy())
+
+    first = np.concatenate(firsts)
+    all_cmc = _cmc_from_first(first, max_rank)
+    AP = np.concatenate(APs)
+    mAP = np.mean(AP[first >= 0])
+    if topk > 0:
+        return all_cmc, mAP, np.concatenate(topk_inds), np.concatenate(topk_dists)
     return all_cmc, mAP
 
-def eval_single_query(distmat, q_pids, g_pids, q_camids, g_camids):
+def eval_single_query(distmat, q_pids, g_pids, q_camids, g_camids, chunk_size=0):
     """Evaluation with market1501 metric
     Key: for each query identity, its gallery images from the same camera view are discarded.
+
+    cmc[i] is the number of correct matches ranked before the (i+1)-th wrong match, summed over 
+    queries and divided by the total number of correct matches. Queries are processed in 
+    vectorized chunks of chunk_size (0 for auto).
     """
     num_q, num_g = distmat.shape
-    indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
+    if chunk_size <= 0:
+        chunk_size = _chunk_size(num_g)
 
-    # compute cmc curve for each query
     num_valid_q = 0. # number of valid query
     num_success_q = np.zeros(50)
-    for q_idx in tqdm(range(num_q), desc="CMC"):
-        # get query pid and camid
-        q_pid = q_pids[q_idx]
-        q_camid = q_camids[q_idx]
-
-        # remove gallery samples that have the same pid and camid with query
-        order = indices[q_idx]
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-        keep = np.invert(remove)
-
-        num_valid_q += sum(matches[q_idx][keep])
-
-        num_match = 0
-        for idx, match in enumerate(matches[q_idx][keep]):
-            if match == 0:
-                num_match += 1
-                for i in range(50):
-                    if num_match == i+1:
-                        num_success_q[i] += sum(matches[q_idx][keep][:idx])
-                if num_match == 50:    
-                    break
+    for start, end in tqdm(list(_iter_chunks(num_q, chunk_size)), desc="CMC"):
+        order = np.argsort(distmat[start:end], axis=1)
+        matches = g_pids[order] == q_pids[start:end, np.newaxis]
+        keep = ~(matches & (g_camids[order] == q_camids[start:end, np.newaxis]))
+        good = matches & keep
+        wrong = keep & ~matches
+        num_valid_q += good.sum()
+
+        # the k-th wrong match at rank r (junk removed) has r - k + 1 correct matches before it
+        rank = np.cumsum(keep, axis=1, dtype=np.int32) - 1
+        num_wrong = np.cumsum(wrong, axis=1, dtype=np.int32)
+        rows, cols = np.nonzero(wrong & (num_wrong <= 50))
+        k = num_wrong[rows, cols]
+        num_success_q += np.bincount(k - 1, weights=rank[rows, cols] - k + 1, minlength=50)
 
     assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
 
@@ -172,7 +327,7 @@ def eval_single_query(distmat, q_pids, g_pids, q_camids, g_camids):
     return cmc   
 
 
-def eval_recall(distmat, q_pids, g_pids, q_camids, g_camids):
+def eval_recall(distmat, q_pids, g_pids, q_camids, g_camids, chunk_size=0):
     """Evaluation with market1501 metric
     Return:
         rs:
@@ -192,49 +347,44 @@ def eval_recall(distmat, q_pids, g_pids, q_camids, g_camids):
             Number of ground truth for the id of query
 
         filtered_gallery;
-            the gallery has same id of query of same cam id removed
+            num_valid_q x num_g int32 gallery indices sorted by distance, the ones with same id and 
+            same cam id of query are -1. It can be loaded with np.load(mmap_mode='r') once saved
         
+    Queries are processed in vectorized chunks of chunk_size (0 for auto).
     """
     num_q, num_g = distmat.shape
-    indices = np.argsort(distmat, axis=1)
-    matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
+    if chunk_size <= 0:
+        chunk_size = _chunk_size(num_g)
 
     num_rs = []
     confs = []
     num_gts = []
     filtered_gallery = []
-    for q_idx in tqdm(range(num_q), desc="Recall"):
-        indice = np.arange(g_pids.shape[0])
-        q_pid = q_pids[q_idx]
-        q_camid = q_camids[q_idx]
-
-        # remove gallery samples that have the same pid and camid with query
-        order = indices[q_idx]    
-        remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-        num_gt = (g_pids[order][~remove] == q_pid).sum()
-        indice = indice[order]
-        indice[remove] = -1
-
-        # compute cmc curve
-        orig_cmc = matches[q_idx][~remove] # binary vector, positions with value 1 are correct matches
-
-        if not np.any(orig_cmc):
-            # this condition is true when query identity does not appear in gallery
-            continue
+    for start, end in tqdm(list(_iter_chunks(num_q, chunk_size)), desc="Recall"):
+        order = np.argsort(distmat[start:end], axis=1)
+        matches = g_pids[order] == q_pids[start:end, np.newaxis]
+        remove = matches & (g_camids[order] == q_camids[start:end, np.newaxis])
+        good = matches & ~remove
+        num_gt = good.sum(axis=1)
+
+        # this condition is false when query identity does not appear in gallery
+        valid = num_gt > 0
+        order, remove, good = order[valid], remove[valid], good[valid]
+        rows = np.arange(len(order))
+        # the last correct match and its rank after removing the junk ones
+        last = num_g - 1 - good[:, ::-1].argmax(axis=1)
+        num_r = np.cumsum(~remove, axis=1)[rows, last]
+        conf = np.minimum(distmat[start:end][valid][rows, order[rows, last]], 0)
 
-        cmc = orig_cmc.cumsum()
-        num_r = (cmc == num_gt).argmax()+1
-        conf = np.min((distmat[q_idx][order][~remove][num_r-1], 0))
-        
         num_rs.append(num_r)
         confs.append(conf)
-        num_gts.append(num_gt)
-        filtered_gallery.append(indice)
+        num_gts.append(num_gt[valid])
+        filtered_gallery.append(np.where(remove, -1, order).astype(np.int32))
 
-    rs = np.array(num_rs)
-    confs = np.array(confs)
-    gts = np.array(num_gts)
-    fg = np.array(filtered_gallery)
+    rs = np.concatenate(num_rs)
+    confs = np.concatenate(confs)
+    gts = np.concatenate(num_gts)
+    fg = np.concatenate(filtered_gallery)
 
     return rs, confs, gts, fg
     # if save:                
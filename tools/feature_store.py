@@ -0,0 +1,254 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+import logging
+logger = logging.getLogger("logger")
+
+class FeatureStore():
+    '''
+    Preallocated, append-only storage of the embeddings of a query / gallery set with their
+    pid, camid and path, to be filled batch by batch during the extraction.
+
+    Features are stored as float32, float16 (2x smaller) or int8 with a float32 scale per
+    vector (~4x smaller), in memory or in memory-mapped .npy files if path is given.
+    Slicing returns float32 torch tensors, so a store can replace the feature tensor in
+    tile-wise computations such as evaluate_streaming, only the tile is decoded.
+
+    Args:
+        capacity (int): maximum number of vectors, e.g. len(loader.dataset)
+        dim (int): dimension of the features
+        dtype (str): 'float32', 'float16' or 'int8'
+        path (str): directory of the memory-mapped files, in memory if empty
+    '''
+    DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+    ARRAYS = ['data', 'scales', 'pids', 'camids']
+
+    def __init__(self, capacity, dim, dtype='float32', path=""):
+        assert dtype in self.DTYPES, f"Unknown feature dtype {dtype}, use one of {list(self.DTYPES.keys())}"
+        self.capacity = capacity
+        self.dim = dim
+        self.dtype = dtype
+        self.path = path
+        self.size = 0
+        self.paths = []
+        shapes = {
+            'data': ((capacity, dim), self.DTYPES[dtype]),
+            'scales': ((capacity if dtype == 'int8' else 0,), np.float32),
+            'pids': ((capacity,), np.int64),
+            'camids': ((capacity,), np.int64),
+        }
+        if path:
+            os.makedirs(path, exist_ok=True)
+        for name, (shape, np_dtype) in shapes.items():
+            if path:
+                array = np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode='w+', dtype=np_dtype, shape=shape)
+            else:
+                array = np.empty(shape, dtype=np_dtype)
+            setattr(self, f"_{name}", array)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, f"_{name}")[:self.size].nbytes for name in self.ARRAYS)
+
+    @property
+    def pids(self):
+        return self._pids[:self.size]
+
+    @property
+    def camids(self):
+        return self._camids[:self.size]
+
+    def append(self, features, pids, camids, paths=None):
+        '''
+        Args:
+            features (torch.Tensor, B x dim)
+            pids, camids (torch.Tensor or list, B)
+            paths (list): image paths, optional
+        '''
+        features = features.detach().float().cpu().numpy()
+        start, end = self.size, self.size + len(features)
+        assert end <= self.capacity, f"Feature store is full, capacity {self.capacity}"
+        if self.dtype == 'int8':
+            # symmetric quantization with one scale per vector
+            scales = np.maximum(np.abs(features).max(axis=1), 1e-12) / 127.
+            self._data[start:end] = np.round(features / scales[:, np.newaxis])
+            self._scales[start:end] = scales
+        else:
+            self._data[start:end] = features
+        self._pids[start:end] = np.asarray(pids)
+        self._camids[start:end] = np.asarray(camids)
+        if paths is not None:
+            self.paths.extend(paths)
+        self.size = end
+
+    def __getitem__(self, index):
+        '''
+        Returns:
+            features (torch.Tensor, N x dim): decoded float32 features of a slice
+        '''
+        assert isinstance(index, slice), "Only slicing is supported"
+        start, end, _ = index.indices(self.size)
+        features = torch.from_numpy(self._data[start:end].astype(np.float32))
+        if self.dtype == 'int8':
+            features *= torch.from_numpy(self._scales[start:end].astype(np.float32))[:, None]
+        return features
+
+    def features(self):
+        return self[:]
+
+    def similarity(self, queries, start=0, end=None):
+        '''
+        Inner products between float32 queries and the stored vectors [start, end), computed
+        on the stored values, the int8 scales are applied to the products instead of the codes.
+
+        Returns:
+            sim (torch.Tensor, Q x (end - start))
+        '''
+        end = self.size if end is None else min(end, self.size)
+        block = torch.from_numpy(self._data[start:end].astype(np.float32))
+        sim = torch.mm(queries.float(), block.t())
+        if self.dtype == 'int8':
+            sim *= torch.from_numpy(self._scales[start:end].astype(np.float32))[None]
+        return sim
+
+    def sq_norms(self, start=0, end=None):
+        '''
+        Returns:
+            sq_norms (torch.Tensor, end - start): squared L2 norms of the stored vectors [start, end)
+        '''
+        end = self.size if end is None else min(end, self.size)
+        block = self._data[start:end].astype(np.float32)
+        sq_norms = torch.from_numpy(np.einsum('ij,ij->i', block, block))
+        if self.dtype == 'int8':
+            sq_norms *= torch.from_numpy(self._scales[start:end].astype(np.float32)) ** 2
+        return sq_norms
+
+    def distance(self, queries, metric='cosine', start=0, end=None):
+        '''
+        Distances between float32 queries and the stored vectors [start, end), from similarity()
+
+        Args:
+            metric (str): 'cosine', 1 - inner product of normalized features as _cosine_dist,
+                          or 'euclidean'
+        Returns:
+            dist (torch.Tensor, Q x (end - start))
+        '''
+        sim = self.similarity(queries, start, end)
+        if metric == 'cosine':
+            return 1 - sim
+        elif metric == 'euclidean':
+            dist = queries.float().pow(2).sum(1, keepdim=True) + self.sq_norms(start, end)[None] - 2 * sim
+            return dist.clamp(min=1e-12).sqrt()
+        raise ValueError(f"Unknown metric {metric}")
+
+    def distance_matrix(self, queries, metric='cosine', tile=16384):
+        '''
+        Q x N distances to all the stored vectors computed tile by tile, only one tile of the
+        store is converted to float32 at a time
+
+        Returns:
+            distmat (numpy.ndarray, Q x N)
+        '''
+        distmat = np.empty((len(queries), self.size), dtype=np.float32)
+        for start in range(0, self.size, tile):
+            end = min(start + tile, self.size)
+            distmat[:, start:end] = self.distance(queries, metric, start, end).numpy()
+        return distmat
+
+    def encoded(self):
+        '''
+        Returns:
+            data (numpy.ndarray, N x dim): stored codes in the dtype of the store
+            scales (numpy.ndarray, N): scales of the int8 codes, empty for the other dtypes
+        '''
+        return self._data[:self.size], self._scales[:self.size]
+
+    def append_encoded(self, data, scales, pids, camids, paths=None):
+        '''
+        Append vectors already encoded in the dtype of the store, e.g. the codes of another store
+
+        Args:
+            data (numpy.ndarray, B x dim): codes in the dtype of the store
+            scales (numpy.ndarray, B): scales of the int8 codes, ignored otherwise
+        '''
+        start, end = self.size, self.size + len(data)
+        assert end <= self.capacity, f"Feature store is full, capacity {self.capacity}"
+        self._data[start:end] = data
+        if self.dtype == 'int8':
+            self._scales[start:end] = scales
+        self._pids[start:end] = np.asarray(pids)
+        self._camids[start:end] = np.asarray(camids)
+        if paths is not None:
+            self.paths.extend(paths)
+        self.size = end
+
+    def save_atomic(self, path):
+        '''
+        Save to a temporary directory renamed to path afterwards, so that an interrupted save
+        never leaves a partial store at path
+        '''
+        tmp = f"{path}.tmp{os.getpid()}"
+        self.save(tmp)
+        if os.path.exists(path):
+            shutil.rmtree(tmp)
+        else:
+            os.replace(tmp, path)
+
+    def save(self, path=""):
+        '''
+        Write the stored vectors and the metadata to the directory path, or to the memory-mapped
+        files of the store if path is not given
+        '''
+        path = path or self.path
+        assert path, "No path to save the feature store"
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            array = getattr(self, f"_{name}")
+            if path == self.path:
+                array.flush()
+            else:
+                np.save(os.path.join(path, f"{name}.npy"), array[:self.size])
+        np.save(os.path.join(path, "paths.npy"), np.asarray(self.paths, dtype=str))
+        with open(os.path.join(path, "meta.json"), 'w') as f:
+            json.dump({'size': self.size, 'dim': self.dim, 'dtype': self.dtype}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Load a saved store, the arrays are memory-mapped read-only if mmap, the store is full
+        '''
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        store = cls.__new__(cls)
+        store.dim, store.dtype, store.path = meta['dim'], meta['dtype'], ""
+        store.size = store.capacity = meta['size']
+        for name in cls.ARRAYS:
+            setattr(store, f"_{name}", np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if mmap else None))
+        store.paths = np.load(os.path.join(path, "paths.npy")).tolist()
+        return store
+
+def model_digest(model):
+    '''
+    Content hash of the weights of a model, the same checkpoint gives the same digest
+    regardless of its file name or where it is loaded from
+    '''
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+def cache_key(fields):
+    '''
+    Args:
+        fields (dict): json serializable fields identifying the features
+    Returns:
+        key (str): name of the cache entry
+    '''
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).encode()).hexdigest()[:16]
@@ -5,8 +5,10 @@ import torch
 
 from tools.utils import (
     _tranpose_and_gather_feat,
+    _gather_feat_at,
     _nms,
     _topk,
+    _sparse_topk,
 )
 
 EFFECTIVE = 0.2
@@ -89,23 +91,30 @@ def fsaf_bbox_target(cls_ids, bboxes, ids, max_objs, num_classes, out_sizes, **k
 
     return rets
 
-def fsaf_det_decode(heat, wh, reg=None, K=100):
+def fsaf_det_decode(heat, wh, reg=None, K=100, score_thresh=None):
+    '''
+    score_thresh (float): if given, only peaks above it are extracted (sparse path), 
+                          images with less than K peaks are padded with score 0
+    '''
     batch, cat, height, width = heat.size()
     
     # heat = torch.sigmoid(heat)
-    # perform nms on heatmaps
-    heat = _nms(heat)
-      
-    scores, inds, clses, ys, xs = _topk(heat, K=K)
+    if score_thresh is None:
+      # perform nms on heatmaps
+      heat = _nms(heat)
+      scores, inds, clses, ys, xs = _topk(heat, K=K)
+    else:
+      scores, inds, clses, ys, xs = _sparse_topk(heat, K=K, thresh=score_thresh)
+
     if reg is not None:
-      reg = _tranpose_and_gather_feat(reg, inds)
+      reg = _gather_feat_at(reg, inds)
       reg = reg.view(batch, K, 2)
       xs = xs.view(batch, K, 1) + reg[:, :, 0:1]
       ys = ys.view(batch, K, 1) + reg[:, :, 1:2]
     else:
       xs = xs.view(batch, K, 1) + 0.5
       ys = ys.view(batch, K, 1) + 0.5
-    wh = _tranpose_and_gather_feat(wh, inds)
+    wh = _gather_feat_at(wh, inds)
     wh = wh.view(batch, K, 4)
     
     clses  = clses.view(batch, K, 1).float()
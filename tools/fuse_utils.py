@@ -0,0 +1,164 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from tools.deploy_utils import check_parity
+import logging
+logger = logging.getLogger("logger")
+
+try:
+    from torch.nn.intrinsic import ConvReLU2d
+except:
+    from torch.ao.nn.intrinsic import ConvReLU2d
+try:
+    from torch.overrides import TorchFunctionMode
+    from torch.utils._pytree import tree_leaves
+    FUNCTION_MODE_IMPORTED = True
+except:
+    logger.info("Conv-BN fusion needs torch.overrides.TorchFunctionMode")
+    FUNCTION_MODE_IMPORTED = False
+
+def _get_parent(model, name):
+    names = name.split(".")
+    parent = model
+    for n in names[:-1]:
+        parent = getattr(parent, n)
+    return parent, names[-1]
+
+def _set_module(model, name, module):
+    parent, attr = _get_parent(model, name)
+    setattr(parent, attr, module)
+
+class _UseCounter(TorchFunctionMode if FUNCTION_MODE_IMPORTED else object):
+    '''
+    Count the uses of each tensor by the torch functions which return tensors, the ones called
+    outside of the modules included, e.g. torch.add or F.relu in the forward of a backbone
+    '''
+    def __init__(self, counts, tensors):
+        super(_UseCounter, self).__init__()
+        self.counts = counts
+        self.tensors = tensors
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        out = func(*args, **kwargs)
+        if any(isinstance(o, torch.Tensor) for o in tree_leaves(out)):
+            for arg in tree_leaves((args, kwargs)):
+                if isinstance(arg, torch.Tensor):
+                    self.tensors.append(arg)
+                    self.counts[id(arg)] = self.counts.get(id(arg), 0) + 1
+        return out
+
+def find_fusible_patterns(model, dummy_input):
+    '''
+    Find conv-bn(-relu) chains by running one forward pass and tracking which module
+    consumes which tensor, so the pass works for any backbone regardless of how the
+    layers are wrapped (ConvModule, nn.Sequential, ConvLayer, HighResolutionModule, ...).
+
+    A pattern is only reported when every module in the chain is called exactly once and
+    the intermediate tensors are consumed by the next module of the chain only. The uses are
+    counted over all the torch functions, so a conv output also used functionally, e.g.
+    relu(bn(y)) + y, is not folded.
+
+    Args:
+        model (nn.Module): model in eval mode
+        dummy_input (torch.Tensor): input used to trace the data flow
+
+    Returns:
+        patterns (list): list of [conv_name, bn_name, relu_name or None]
+    '''
+    if not FUNCTION_MODE_IMPORTED:
+        logger.info("Can not track the uses of the tensors, skip the fusion")
+        return []
+    producers = {}
+    consumers = {}
+    calls = {}
+    inputs = {}
+    # keep the traced tensors alive so that their ids are not reused during the forward
+    tensors = []
+
+    def hooker(name):
+        def hook(m, inp, out):
+            calls[name] = calls.get(name, 0) + 1
+            if len(inp) != 1 or not isinstance(inp[0], torch.Tensor) or not isinstance(out, torch.Tensor):
+                return
+            tensors.append(inp[0])
+            tensors.append(out)
+            inputs[name] = id(inp[0])
+            # inplace relu returns its input, keep the original producer
+            if id(out) != id(inp[0]):
+                producers[id(out)] = name
+        return hook
+
+    modules = dict(model.named_modules())
+    hooks = []
+    for name, m in modules.items():
+        if len(list(m.children())) == 0:
+            hooks.append(m.register_forward_hook(hooker(name)))
+    with torch.no_grad(), _UseCounter(consumers, tensors):
+        model(dummy_input)
+    for hook in hooks:
+        hook.remove()
+
+    def single_producer(name, types):
+        if calls.get(name, 0) != 1 or name not in inputs:
+            return None
+        src = inputs[name]
+        if consumers.get(src, 0) != 1 or src not in producers:
+            return None
+        prev = producers[src]
+        if calls.get(prev, 0) != 1 or not isinstance(modules[prev], types):
+            return None
+        return prev
+
+    patterns = {}
+    for name, m in modules.items():
+        if isinstance(m, nn.BatchNorm2d):
+            conv = single_producer(name, nn.Conv2d)
+            if conv is not None:
+                patterns[name] = [conv, name, None]
+    for name, m in modules.items():
+        if isinstance(m, nn.ReLU):
+            bn = single_producer(name, nn.BatchNorm2d)
+            if bn is not None and bn in patterns:
+                patterns[bn][2] = name
+    return list(patterns.values())
+
+def fuse_model(model, dummy_input, fuse_relu=True):
+    '''
+    Fold BatchNorm into the preceding convolution in-place and optionally merge the
+    following ReLU into a ConvReLU2d. The replaced modules become nn.Identity so that
+    the forward functions of the backbones stay untouched.
+
+    Args:
+        model (nn.Module): model to fuse, it is switched to eval mode
+        dummy_input (torch.Tensor): input used to find the patterns
+        fuse_relu (bool): merge conv-bn-relu into ConvReLU2d
+
+    Returns:
+        model (nn.Module): the fused model
+        num_fused (int): number of folded BatchNorm
+    '''
+    model.eval()
+    patterns = find_fusible_patterns(model, dummy_input)
+    modules = dict(model.named_modules())
+    for conv_name, bn_name, relu_name in patterns:
+        fused = fuse_conv_bn_eval(modules[conv_name], modules[bn_name])
+        if fuse_relu and relu_name is not None:
+            fused = ConvReLU2d(fused, nn.ReLU(inplace=False))
+            _set_module(model, relu_name, nn.Identity())
+        _set_module(model, conv_name, fused)
+        _set_module(model, bn_name, nn.Identity())
+    return model, len(patterns)
+
+def verify_fusion(reference, fused, inputs, atol=1e-3):
+    '''
+    Check that the fused model produces the same outputs as the original one.
+
+    Returns:
+        is_equal (bool): max difference of all outputs is within atol
+        max_diff (float)
+    '''
+    reference.eval()
+    fused.eval()
+    max_diff = check_parity(reference, fused, inputs)
+    return max_diff <= atol, max_diff
@@ -0,0 +1,329 @@
+import os
+import json
+import numpy as np
+import logging
+logger = logging.getLogger("logger")
+
+'''
+Gallery indexes for large-scale ReID search on the embeddings of the ReID graphs,
+e.g. 'neck' of trick_reid or 'embb' of harmattn_reid.
+
+All indexes rank by squared L2 distance, on normalized vectors for the cosine metric,
+and return the distances of the engines, i.e. 1 - cosine similarity for 'cosine' and
+the L2 distance for 'euclidean'.
+'''
+
+def _sqnorm(x):
+    return np.einsum('ij,ij->i', x, x)
+
+def _topk(d2, ids, k):
+    '''
+    Args:
+        d2 (numpy.ndarray, Q x N): squared distances
+        ids (numpy.ndarray, Q x N or N): ids of the columns
+    Returns:
+        d2 (numpy.ndarray, Q x min(k, N)): sorted k smallest distances
+        ids (numpy.ndarray, Q x min(k, N))
+    '''
+    if ids.ndim == 1:
+        ids = np.broadcast_to(ids, d2.shape)
+    if k < d2.shape[1]:
+        part = np.argpartition(d2, k - 1, axis=1)[:, :k]
+        d2, ids = np.take_along_axis(d2, part, 1), np.take_along_axis(ids, part, 1)
+    order = np.argsort(d2, axis=1, kind='stable')
+    return np.take_along_axis(d2, order, 1), np.take_along_axis(ids, order, 1)
+
+def _merge_topk(d2, ids, new_d2, new_ids, k):
+    return _topk(np.concatenate([d2, new_d2], 1), np.concatenate([ids, np.broadcast_to(new_ids, new_d2.shape)], 1), k)
+
+def _nearest(x, centroids, chunk_size=8192):
+    c_sqnorms = _sqnorm(centroids)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        d2 = c_sqnorms[np.newaxis] - 2 * x[start:start+chunk_size] @ centroids.T
+        assign[start:start+chunk_size] = d2.argmin(axis=1)
+    return assign
+
+def kmeans(x, k, niter=20, seed=0):
+    '''
+    Lloyd's k-means, empty clusters keep their previous centroids
+
+    Returns:
+        centroids (numpy.ndarray, k x d)
+    '''
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    assert len(x) >= k, f"Need at least {k} training vectors, got {len(x)}"
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(niter):
+        assign = _nearest(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        clusters, starts, counts = np.unique(assign[order], return_index=True, return_counts=True)
+        centroids[clusters] = np.add.reduceat(x[order], starts, axis=0) / counts[:, np.newaxis]
+    return centroids
+
+class FlatIndex():
+    '''
+    Exact search, the reference of the approximate indexes
+
+    Args:
+        d (int): dimension of the features
+        metric (str): 'cosine' or 'euclidean'
+    '''
+    TYPE = 'flat'
+    PARAMS = ['d', 'metric']
+    # per-vector arrays, the other arrays are in ARRAYS
+    VECTOR_ARRAYS = ['ids', 'data', 'sqnorms']
+    ARRAYS = []
+
+    def __init__(self, d, metric='cosine'):
+        assert metric in ['cosine', 'euclidean'], f"Unknown metric {metric}"
+        self.d = d
+        self.metric = metric
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.data = np.zeros((0, d), dtype=np.float32)
+        self.sqnorms = np.zeros(0, dtype=np.float32)
+
+    @property
+    def ntotal(self):
+        return len(self.ids)
+
+    def _prepare(self, x):
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if self.metric == 'cosine':
+            x = x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        return x
+
+    def _to_dist(self, d2):
+        if self.metric == 'cosine':
+            # |q - g|^2 = 2 - 2cos for unit vectors
+            return d2 / 2
+        return np.sqrt(np.maximum(d2, 1e-12))
+
+    def _encode(self, x):
+        return {'data': x, 'sqnorms': _sqnorm(x)}
+
+    def add(self, x, ids=None):
+        '''
+        Args:
+            x (numpy.ndarray or torch.Tensor, N x d): features
+            ids (numpy.ndarray, N): ids returned by search, e.g. indices in the gallery set,
+                                    consecutive numbers following the current ones if None
+        '''
+        x = self._prepare(np.asarray(x))
+        if ids is None:
+            start = self.ids.max() + 1 if self.ntotal > 0 else 0
+            ids = np.arange(start, start + len(x))
+        encoded = self._encode(x)
+        encoded['ids'] = np.asarray(ids, dtype=np.int64)
+        for name in self.VECTOR_ARRAYS:
+            setattr(self, name, np.concatenate([getattr(self, name), encoded[name]]))
+        self._update()
+
+    def remove(self, ids):
+        '''
+        Returns:
+            num_removed (int)
+        '''
+        keep = ~np.isin(self.ids, ids)
+        for name in self.VECTOR_ARRAYS:
+            setattr(self, name, getattr(self, name)[keep])
+        self._update()
+        return int((~keep).sum())
+
+    def _update(self):
+        pass
+
+    def _search(self, q, k, block_size=65536):
+        q_sqnorms = _sqnorm(q)[:, np.newaxis]
+        d2 = np.full((len(q), 0), np.inf, dtype=np.float32)
+        ids = np.full((len(q), 0), -1, dtype=np.int64)
+        for start in range(0, self.ntotal, block_size):
+            end = min(start + block_size, self.ntotal)
+            block = q_sqnorms + self.sqnorms[start:end] - 2 * q @ self.data[start:end].T
+            d2, ids = _merge_topk(d2, ids, block, self.ids[start:end], k)
+        return d2, ids
+
+    def search(self, queries, k=10, batch_size=1024):
+        '''
+        Args:
+            queries (numpy.ndarray or torch.Tensor, Q x d)
+            k (int): number of neighbours
+            batch_size (int): number of queries searched at once
+        Returns:
+            dists (numpy.ndarray, Q x k): sorted distances, inf if less than k are found
+            ids (numpy.ndarray, Q x k): ids of the neighbours, -1 if less than k are found
+        '''
+        queries = self._prepare(np.asarray(queries))
+        dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for start in range(0, len(queries), batch_size):
+            d2, i = self._search(queries[start:start+batch_size], k)
+            dists[start:start+len(d2), :d2.shape[1]] = self._to_dist(d2)
+            ids[start:start+len(d2), :d2.shape[1]] = i
+        return dists, ids
+
+    def save(self, path):
+        '''
+        Save the arrays as .npy files in the directory path so that they can be memory-mapped
+        '''
+        os.makedirs(path, exist_ok=True)
+        meta = {name: getattr(self, name) for name in self.PARAMS}
+        meta['type'] = self.TYPE
+        with open(os.path.join(path, "meta.json"), 'w') as f:
+            json.dump(meta, f)
+        for name in self.VECTOR_ARRAYS + self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        assert meta.pop('type') == cls.TYPE
+        index = cls(**meta)
+        for name in cls.VECTOR_ARRAYS + cls.ARRAYS:
+            setattr(index, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if mmap else None))
+        return index
+
+class IVFIndex(FlatIndex):
+    '''
+    Inverted file index, the vectors are partitioned by a k-means coarse quantizer and only the
+    nprobe lists nearest to a query are searched exactly. The vectors are stored sorted by list,
+    list l holds the vectors offsets[l]:offsets[l+1].
+
+    Args:
+        nlist (int): number of k-means clusters, about sqrt(N) to 4 * sqrt(N)
+        nprobe (int): number of lists searched for each query
+    '''
+    TYPE = 'ivf'
+    PARAMS = ['d', 'metric', 'nlist', 'nprobe']
+    VECTOR_ARRAYS = ['ids', 'lists', 'data', 'sqnorms']
+    ARRAYS = ['centroids', 'offsets']
+
+    def __init__(self, d, metric='cosine', nlist=1024, nprobe=16):
+        super(IVFIndex, self).__init__(d, metric)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.lists = np.zeros(0, dtype=np.int64)
+        self.centroids = None
+        self.offsets = np.zeros(nlist + 1, dtype=np.int64)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, x, niter=20, seed=0):
+        '''
+        Args:
+            x (numpy.ndarray, N x d): training features, e.g. a random subset of the gallery
+        '''
+        x = self._prepare(np.asarray(x))
+        self.centroids = kmeans(x, self.nlist, niter, seed)
+        return x
+
+    def _encode(self, x):
+        assert self.is_trained, "Train the index before adding vectors"
+        encoded = super(IVFIndex, self)._encode(x)
+        encoded['lists'] = _nearest(x, self.centroids)
+        return encoded
+
+    def _update(self):
+        # keep the vectors sorted by list
+        if np.any(self.lists[1:] < self.lists[:-1]):
+            order = np.argsort(self.lists, kind='stable')
+            for name in self.VECTOR_ARRAYS:
+                setattr(self, name, getattr(self, name)[order])
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.lists, minlength=self.nlist))])
+
+    def _query_tables(self, q):
+        # per-batch precomputation shared by all lists
+        return None
+
+    def _list_dist(self, q, tables, rows, l, start, end):
+        q = q[rows]
+        return _sqnorm(q)[:, np.newaxis] + self.sqnorms[start:end] - 2 * q @ self.data[start:end].T
+
+    def _search(self, q, k):
+        nprobe = min(self.nprobe, self.nlist)
+        coarse = _sqnorm(self.centroids)[np.newaxis] - 2 * q @ self.centroids.T
+        probes = np.argpartition(coarse, nprobe - 1, axis=1)[:, :nprobe]
+        tables = self._query_tables(q)
+        d2 = np.full((len(q), k), np.inf, dtype=np.float32)
+        ids = np.full((len(q), k), -1, dtype=np.int64)
+        # group the queries by list so that each list is scanned once per batch
+        rows = np.repeat(np.arange(len(q)), nprobe)
+        lists = probes.ravel()
+        order = np.argsort(lists, kind='stable')
+        probed, starts = np.unique(lists[order], return_index=True)
+        for l, rows_l in zip(probed, np.split(rows[order], starts[1:])):
+            start, end = self.offsets[l], self.offsets[l+1]
+            if end == start:
+                continue
+            block = self._list_dist(q, tables, rows_l, l, start, end)
+            d2[rows_l], ids[rows_l] = _merge_topk(d2[rows_l], ids[rows_l], block, self.ids[start:end], k)
+        return d2, ids
+
+class IVFPQIndex(IVFIndex):
+    '''
+    Inverted file index with product quantization of the residuals to the coarse centroids,
+    each vector is stored as m uint8 codes and its squared norm, i.e. m + 4 bytes instead of 4d.
+
+    Distances are computed asymmetrically (the query is not quantized) as
+    |q - c - r|^2 = |q|^2 + |c + r|^2 - 2q.c - 2 sum_j q_j.r_j, where the lookup tables of
+    q_j.r_j over the m x 256 sub-codewords do not depend on the list and are built once per batch.
+
+    Args:
+        m (int): number of sub-quantizers, d must be divisible by m
+    '''
+    TYPE = 'ivfpq'
+    PARAMS = ['d', 'metric', 'nlist', 'nprobe', 'm']
+    VECTOR_ARRAYS = ['ids', 'lists', 'codes', 'sqnorms']
+    ARRAYS = ['centroids', 'offsets', 'codebooks']
+
+    def __init__(self, d, metric='cosine', nlist=1024, nprobe=16, m=16):
+        super(IVFPQIndex, self).__init__(d, metric, nlist, nprobe)
+        assert d % m == 0, f"Dimension {d} is not divisible by {m} sub-quantizers"
+        self.m = m
+        self.codes = np.zeros((0, m), dtype=np.uint8)
+        self.codebooks = None
+
+    def _residuals(self, x, lists):
+        return (x - self.centroids[lists]).reshape(len(x), self.m, -1)
+
+    def train(self, x, niter=20, seed=0):
+        x = super(IVFPQIndex, self).train(x, niter, seed)
+        residuals = self._residuals(x, _nearest(x, self.centroids))
+        ksub = min(256, len(x))
+        self.codebooks = np.stack([kmeans(residuals[:, j], ksub, niter, seed) for j in range(self.m)])
+        return x
+
+    def _encode(self, x):
+        assert self.is_trained, "Train the index before adding vectors"
+        lists = _nearest(x, self.centroids)
+        residuals = self._residuals(x, lists)
+        codes = np.stack([_nearest(np.ascontiguousarray(residuals[:, j]), self.codebooks[j]) for j in range(self.m)], 1)
+        decoded = self.centroids[lists] + self.codebooks[np.arange(self.m), codes].reshape(len(x), -1)
+        return {'lists': lists, 'codes': codes.astype(np.uint8), 'sqnorms': _sqnorm(decoded)}
+
+    def _query_tables(self, q):
+        luts = np.einsum('qjd,jkd->jqk', q.reshape(len(q), self.m, -1), self.codebooks)
+        return _sqnorm(q), q @ self.centroids.T, luts
+
+    def _list_dist(self, q, tables, rows, l, start, end):
+        q_sqnorms, q_centroids, luts = tables
+        codes = self.codes[start:end]
+        inner = q_centroids[rows, l][:, np.newaxis]
+        for j in range(self.m):
+            inner = inner + np.take(luts[j][rows], codes[:, j], axis=1)
+        return q_sqnorms[rows][:, np.newaxis] + self.sqnorms[start:end] - 2 * inner
+
+INDEXES = {index.TYPE: index for index in [FlatIndex, IVFIndex, IVFPQIndex]}
+
+def load_index(path, mmap=True):
+    '''
+    Load an index saved by save(), the arrays are memory-mapped (read-only) if mmap,
+    add / remove then build new in-memory arrays.
+    '''
+    with open(os.path.join(path, "meta.json")) as f:
+        index_type = json.load(f)['type']
+    return INDEXES[index_type].load(path, mmap)
@@ -0,0 +1,330 @@
+import time
+import atexit
+import queue
+import threading
+import functools
+import numpy as np
+from collections import defaultdict, OrderedDict
+import torch
+import torch.distributed as dist
+import logging
+logger = logging.getLogger("logger")
+
+class RunningMeter():
+    '''
+    Sum and count of a metric kept on the device of its values, updating only keeps a
+    reference to the value, the values are summed on the device when the mean is needed
+    '''
+    def __init__(self):
+        self.values = []
+        self.sum = None
+        self.count = 0
+
+    def update(self, value):
+        self.values.append(value.detach() if isinstance(value, torch.Tensor) else torch.tensor(float(value)))
+
+    def add(self, meter):
+        meter._fold()
+        self._fold()
+        if meter.sum is not None:
+            self.sum = meter.sum.clone() if self.sum is None else self.sum + meter.sum
+            self.count += meter.count
+
+    def mean(self):
+        self._fold()
+        return self.sum / max(self.count, 1)
+
+    def _fold(self):
+        if self.values:
+            if all(v.shape == self.values[0].shape for v in self.values):
+                total = torch.stack(self.values).float().sum()
+            else:
+                total = torch.cat([v.reshape(-1) for v in self.values]).float().sum()
+            self.sum = total if self.sum is None else self.sum + total
+            self.count += len(self.values)
+            self.values = []
+
+class MetricLogger():
+    '''
+    Device-resident training metrics, synchronized with the host every sync_period iterations
+    in one transfer (and one all_reduce in distributed training) and written to the
+    visualizer at that time.
+
+    Args:
+        visualizer (AsyncWriter or None): receives the means of the window at each sync
+        sync_period (int): number of iterations between two host syncs
+    '''
+    def __init__(self, visualizer=None, sync_period=20):
+        self.visualizer = visualizer
+        self.sync_period = max(int(sync_period), 1)
+        self.window = OrderedDict()
+        self.epoch = OrderedDict()
+        # the last synced means of the windows
+        self.values = {}
+
+    def update(self, name, value):
+        if name not in self.window:
+            self.window[name] = RunningMeter()
+        self.window[name].update(value)
+
+    def step(self, step, force=False):
+        '''
+        Returns:
+            synced (bool): the window was synced to values and written
+        '''
+        if not self.window or (not force and step % self.sync_period != 0):
+            return False
+        means = self._reduce(self.window)
+        self.values.update(means)
+        if self.visualizer is not None:
+            for name, value in means.items():
+                self.visualizer.add_scalar(name, value, step)
+        for name, meter in self.window.items():
+            self.epoch.setdefault(name, RunningMeter()).add(meter)
+        self.window.clear()
+        return True
+
+    def epoch_mean(self, name, default=0.0):
+        '''
+        Mean of a metric since reset_epoch, including the window not synced yet
+        '''
+        if name not in self.epoch and name not in self.window:
+            return default
+        meter = RunningMeter()
+        for meters in [self.epoch, self.window]:
+            if name in meters:
+                meter.add(meters[name])
+        return self._reduce(OrderedDict([(name, meter)]))[name]
+
+    def reset_epoch(self):
+        self.epoch.clear()
+
+    def _reduce(self, meters):
+        # one transfer per device for all the meters
+        groups = defaultdict(list)
+        for name, meter in meters.items():
+            meter._fold()
+            groups[meter.sum.device].append(name)
+        means = {}
+        for device, names in groups.items():
+            values = torch.stack([meters[name].sum.reshape(()) for name in names])
+            values /= torch.tensor([max(meters[name].count, 1) for name in names], device=device)
+            if dist.is_available() and dist.is_initialized():
+                values = values.cuda() if dist.get_backend() == 'nccl' else values.cpu()
+                dist.all_reduce(values)
+                values /= dist.get_world_size()
+            means.update(zip(names, values.cpu().tolist()))
+        return means
+
+class AsyncWriter():
+    '''
+    tensorboardX SummaryWriter whose scalars and histograms are written by a background
+    thread, the training thread only puts them into a queue. Tensors are detached and moved
+    to the host by the thread.
+
+    Args:
+        writer (SummaryWriter)
+        max_queue (int): the training thread blocks when the writer is this many events behind
+    '''
+    def __init__(self, writer, max_queue=10000):
+        self.writer = writer
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def add_scalar(self, tag, value, step=None):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+        self.queue.put(('add_scalar', (tag, value, step), {}))
+
+    def add_histogram(self, tag, values, step=None, *args, **kwargs):
+        if isinstance(values, torch.Tensor):
+            values = values.detach().clone()
+        self.queue.put(('add_histogram', (tag, values, step) + args, kwargs))
+
+    def flush(self):
+        self.queue.join()
+        self.writer.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            self.writer.close()
+
+    def __getattr__(self, name):
+        # the other methods of SummaryWriter are called synchronously
+        return getattr(self.writer, name)
+
+    def _run(self):
+        while True:
+            event = self.queue.get()
+            try:
+                if event is None:
+                    return
+                method, args, kwargs = event
+                if method == 'add_scalar' and isinstance(args[1], torch.Tensor):
+                    args = (args[0], args[1].item(), args[2])
+                elif method == 'add_histogram' and isinstance(args[1], torch.Tensor):
+                    args = (args[0], args[1].cpu().numpy()) + args[2:]
+                getattr(self.writer, method)(*args, **kwargs)
+            except Exception:
+                logger.exception("Failed to write to tensorboard")
+            finally:
+                self.queue.task_done()
+
+class TimedLoader():
+    '''
+    DataLoader whose iteration reports to a PipelineMeter the time blocked in the loader
+    iterator and the start and the end of each iteration. The other attributes are the ones
+    of the loader.
+    '''
+    def __init__(self, loader, meter):
+        self.loader = loader
+        self.meter = meter
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        while True:
+            start = time.perf_counter()
+            self.meter.end_iteration(start)
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.meter.start_iteration(start, self.loader.batch_size or _batch_size(batch))
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+def _batch_size(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.size(0)
+    if isinstance(batch, dict):
+        batch = list(batch.values())
+    if isinstance(batch, (list, tuple)) and len(batch) > 0:
+        return _batch_size(batch[0])
+    return 0
+
+class PipelineMeter():
+    '''
+    Time of each phase of the training iterations on the host: the data wait (blocked in the
+    loader iterator), the forward (with the loss and the copy to the device), the backward and
+    the step (the optimizer steps and the rest until the next batch is requested).
+
+    Every period iterations the images per second, the data wait fraction and the p50 / p95 of
+    each phase are logged and written to the visualizer, with a warning once per epoch when the
+    data wait fraction is above warn_fraction.
+
+    Args:
+        visualizer (AsyncWriter or None)
+        period (int): iterations per report
+        warn_fraction (float): data wait fraction above which the run is reported input bound
+        hint (str): appended to the warning, e.g. the number of workers and the transforms
+        sync (bool): synchronize CUDA at the phase boundaries, so that the device time is
+                     attributed to its phase instead of the next blocking call
+    '''
+    PHASES = ['data', 'forward', 'backward', 'step']
+
+    def __init__(self, visualizer=None, period=100, warn_fraction=0.2, hint="", sync=False):
+        self.visualizer = visualizer
+        self.period = max(int(period), 1)
+        self.warn_fraction = warn_fraction
+        self.hint = hint
+        self.sync = sync and torch.cuda.is_available()
+        self.engine = None
+        self.warned = False
+        self.mark = None
+        self.last_end = None
+        self.num_iters = 0
+        self._reset_window()
+
+    def wrap(self, engine, method='_train_once', loader='tdata'):
+        '''
+        Time the iterations of an engine method over one of its loaders, the loader is replaced
+        by TimedLoader during the calls
+        '''
+        self.engine = engine
+        fn = getattr(engine, method)
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            original = getattr(engine, loader)
+            setattr(engine, loader, TimedLoader(original, self))
+            self.warned = False
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                setattr(engine, loader, original)
+                self.mark = None
+                # the last iterations of the call, the window does not span the evaluation
+                if self.times['step']:
+                    self.report(self.last_end)
+                self._reset_window()
+        setattr(engine, method, wrapper)
+
+    def start_iteration(self, start, batch_size):
+        now = self._now()
+        if self.window_start is None:
+            self.window_start = start
+        self.times['data'].append(now - start)
+        self.images += batch_size
+        self.mark = now
+
+    def phase(self, name):
+        '''
+        End of a phase of the current iteration, e.g. 'forward' when the backward starts
+        '''
+        if self.mark is None:
+            return
+        now = self._now()
+        self.times[name].append(now - self.mark)
+        self.mark = now
+
+    def end_iteration(self, now):
+        if self.mark is None:
+            return
+        self.times['step'].append(now - self.mark)
+        self.mark = None
+        self.last_end = now
+        self.num_iters += 1
+        if self.num_iters % self.period == 0:
+            self.report(now)
+
+    def report(self, now):
+        wall = now - self.window_start
+        if wall <= 0:
+            return
+        fraction = sum(self.times['data']) / wall
+        speed = self.images / wall
+        step = self.engine.iter if self.engine is not None else self.num_iters
+        msg = f"Pipeline {speed:.1f} img/s, data wait {fraction:.1%}"
+        for name in self.PHASES:
+            if self.times[name]:
+                p50, p95 = np.percentile(np.array(self.times[name]) * 1000, [50, 95])
+                msg += f", {name} p50/p95 {p50:.1f}/{p95:.1f} ms"
+                if self.visualizer is not None:
+                    self.visualizer.add_scalar(f'pipeline/{name}_p50_ms', p50, step)
+                    self.visualizer.add_scalar(f'pipeline/{name}_p95_ms', p95, step)
+        if self.visualizer is not None:
+            self.visualizer.add_scalar('pipeline/images_per_sec', speed, step)
+            self.visualizer.add_scalar('pipeline/data_wait_fraction', fraction, step)
+        logger.info(msg)
+        if fraction > self.warn_fraction and not self.warned:
+            self.warned = True
+            logger.warning(f"Training is input bound, {fraction:.1%} of the time is spent waiting for batches. {self.hint}")
+        self._reset_window()
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _reset_window(self):
+        self.times = {name: [] for name in self.PHASES}
+        self.images = 0
+        self.window_start = None
@@ -0,0 +1,106 @@
+import os
+import functools
+import torch
+import logging
+logger = logging.getLogger("logger")
+try:
+    from torch.profiler import profile, schedule, ProfilerActivity, tensorboard_trace_handler
+    PROFILER_IMPORTED = True
+except:
+    logger.info("Profiling needs torch.profiler")
+    PROFILER_IMPORTED = False
+
+class ProfiledLoader():
+    '''
+    DataLoader whose iteration steps a profiler after each batch, i.e. once the iteration that
+    used the batch is done, so that any engine loop over the loader is profiled per iteration.
+    The other attributes are the ones of the loader.
+    '''
+    def __init__(self, loader, profiler):
+        self.loader = loader
+        self.profiler = profiler
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield batch
+            self.profiler.step()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+class EngineProfiler():
+    '''
+    torch.profiler around the loops of an engine, configured by cfg.PROFILE. Each phase is
+    profiled once, the first time it runs at an epoch >= PROFILE.EPOCH, over the iteration
+    window given by WAIT, WARMUP and ACTIVE. The traces are written to OUTPUT_DIR/profile as
+    Chrome trace files, which the TensorBoard profiler plugin reads from the same directory,
+    and the top PROFILE.TOP_N operators are logged and saved next to them.
+
+    Args:
+        cfg: PROFILE and OUTPUT_DIR are used
+        rank (int): written in the names of the traces
+    '''
+    def __init__(self, cfg, rank=0):
+        self.cfg = cfg.PROFILE
+        self.path = os.path.join(cfg.OUTPUT_DIR, 'profile')
+        self.rank = rank
+        self.use_cuda = torch.cuda.is_available()
+        self.done = set()
+
+    def wrap(self, engine, method, phase, loaders):
+        '''
+        Profile a method of an engine, the loaders named in loaders are replaced by
+        ProfiledLoader during the calls that are profiled
+
+        Args:
+            method (str): e.g. '_train_once', '_evaluate', the instance attribute overrides it
+            phase (str): 'train' or 'eval'
+            loaders (list): attribute names of the loaders, e.g. ['vdata', 'qdata', 'gdata']
+        '''
+        fn = getattr(engine, method)
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self._should_profile(phase, engine.epoch):
+                return fn(*args, **kwargs)
+            self.done.add(phase)
+            with self._profiler(phase, engine.epoch) as prof:
+                originals = {name: getattr(engine, name) for name in loaders if getattr(engine, name) is not None}
+                for name, loader in originals.items():
+                    setattr(engine, name, ProfiledLoader(loader, prof))
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    for name, loader in originals.items():
+                        setattr(engine, name, loader)
+        setattr(engine, method, wrapper)
+
+    def _should_profile(self, phase, epoch):
+        return PROFILER_IMPORTED and phase in self.cfg.PHASES and phase not in self.done and epoch >= self.cfg.EPOCH
+
+    def _profiler(self, phase, epoch):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        activities = [ProfilerActivity.CPU]
+        if self.use_cuda:
+            activities.append(ProfilerActivity.CUDA)
+        name = f"{phase}_epoch{epoch:03}_rank{self.rank}"
+        logger.info(f"Profile {phase} of epoch {epoch}, iterations {self.cfg.WAIT + self.cfg.WARMUP + 1} to {self.cfg.WAIT + self.cfg.WARMUP + self.cfg.ACTIVE}")
+        return profile(
+            activities=activities,
+            schedule=schedule(wait=self.cfg.WAIT, warmup=self.cfg.WARMUP, active=self.cfg.ACTIVE, repeat=1),
+            on_trace_ready=functools.partial(self._on_trace_ready, name),
+            record_shapes=self.cfg.RECORD_SHAPES,
+            profile_memory=self.cfg.PROFILE_MEMORY,
+            with_stack=self.cfg.WITH_STACK,
+        )
+
+    def _on_trace_ready(self, name, prof):
+        tensorboard_trace_handler(self.path, worker_name=name)(prof)
+        sort_by = "self_cuda_time_total" if self.use_cuda else "self_cpu_time_total"
+        table = prof.key_averages(group_by_input_shape=self.cfg.RECORD_SHAPES).table(sort_by=sort_by, row_limit=self.cfg.TOP_N)
+        with open(os.path.join(self.path, f"{name}_top{self.cfg.TOP_N}.txt"), 'w') as f:
+            f.write(table)
+        logger.info(f"Top {self.cfg.TOP_N} operators of {name} by {sort_by}, traces in {self.path}\n{table}")
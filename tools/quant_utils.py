@@ -0,0 +1,120 @@
+import io
+import copy
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+from src.model.module.base_module import HSwish
+import logging
+logger = logging.getLogger("logger")
+
+try:
+    from torch.ao.quantization import get_default_qconfig_mapping, get_default_qat_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, prepare_qat_fx, convert_fx
+    FX_QUANT_IMPORTED = True
+except:
+    logger.info("Upgrade pytorch (>= 1.13) for FX graph mode quantization")
+    FX_QUANT_IMPORTED = False
+
+def swap_activations(model):
+    '''
+    Replace the custom HSwish, which would be traced into add / clamp / div / mul and
+    quantized op by op, by nn.Hardswish which has a quantized kernel.
+    Both compute x * relu6(x + 3) / 6, so the swap is exact in fp32.
+    '''
+    for name, m in model.named_children():
+        if isinstance(m, HSwish):
+            setattr(model, name, nn.Hardswish())
+        else:
+            swap_activations(m)
+    return model
+
+def is_slow_depthwise(m):
+    '''
+    The int8 depthwise kernels of fbgemm require the number of channels to be a multiple
+    of 8, otherwise a reference implementation which is ~30x slower than fp32 is used,
+    e.g. the 116 / 232 channels branches of ShuffleNetV2 x1.0.
+    '''
+    return isinstance(m, nn.Conv2d) and m.groups > 1 and m.groups == m.in_channels and m.in_channels % 8 != 0
+
+def build_qconfig_mapping(model, backend='fbgemm', float_modules=[], qat=False):
+    '''
+    The default mappings of fbgemm / x86 / qnnpack use per-channel int8 weights and
+    per-tensor uint8 activations.
+
+    Args:
+        model (nn.Module): model to be quantized
+        backend (str): fbgemm or x86 for servers, qnnpack for ARM
+        float_modules (list): class names of modules kept in fp32, e.g. ChannelGate whose
+                              sigmoid gate loses too much precision in 8 bits
+        qat (bool): build the fake quantization mapping for quantization aware training
+    '''
+    if qat:
+        qconfig_mapping = get_default_qat_qconfig_mapping(backend)
+    else:
+        qconfig_mapping = get_default_qconfig_mapping(backend)
+    num_float = 0
+    num_depthwise = 0
+    for name, m in model.named_modules():
+        if type(m).__name__ in float_modules:
+            qconfig_mapping.set_module_name(name, None)
+            num_float += 1
+        elif is_slow_depthwise(m):
+            qconfig_mapping.set_module_name(name, None)
+            num_depthwise += 1
+    if num_float > 0:
+        logger.info(f"Keep {num_float} modules of {float_modules} in fp32")
+    if num_depthwise > 0:
+        logger.info(f"Keep {num_depthwise} depthwise convolutions in fp32")
+    return qconfig_mapping
+
+def prepare_ptq(model, example_inputs, backend='fbgemm', float_modules=[]):
+    '''
+    Insert observers for post-training static quantization, the input model is not modified.
+    '''
+    assert FX_QUANT_IMPORTED, "FX graph mode quantization is not available"
+    torch.backends.quantized.engine = backend
+    model = swap_activations(copy.deepcopy(model)).eval()
+    qconfig_mapping = build_qconfig_mapping(model, backend, float_modules)
+    return prepare_fx(model, qconfig_mapping, (example_inputs,))
+
+def prepare_qat(model, example_inputs, backend='fbgemm', float_modules=[]):
+    '''
+    Insert fake quantization modules for quantization aware training, train the returned
+    model with the original solver and call convert() afterwards.
+    '''
+    assert FX_QUANT_IMPORTED, "FX graph mode quantization is not available"
+    torch.backends.quantized.engine = backend
+    model = swap_activations(copy.deepcopy(model)).train()
+    qconfig_mapping = build_qconfig_mapping(model, backend, float_modules, qat=True)
+    return prepare_qat_fx(model, qconfig_mapping, (example_inputs,))
+
+def calibrate(model, loaders, num_batches=32):
+    '''
+    Feed batches of the test loaders to the observers.
+
+    Args:
+        model (GraphModule): model returned by prepare_ptq
+        loaders (list): data loaders whose batches contain 'inp', e.g. [query, gallery] or [val]
+        num_batches (int): number of batches drawn from each loader
+    '''
+    model.eval()
+    with torch.no_grad():
+        for loader in loaders:
+            for i, batch in enumerate(tqdm(loader, desc="CALIBRATE", total=min(num_batches, len(loader)))):
+                if i >= num_batches:
+                    break
+                model(batch['inp'])
+    return model
+
+def convert(model):
+    model.eval()
+    return convert_fx(model)
+
+def model_size(model):
+    '''
+    Returns:
+        size (float): size of the serialized state dict in MB
+    '''
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
@@ -0,0 +1,74 @@
+import types
+import fnmatch
+import functools
+import torch
+import logging
+logger = logging.getLogger("logger")
+try:
+    from torch.utils.checkpoint import checkpoint
+    CHECKPOINT_IMPORTED = True
+except:
+    logger.info("Activation checkpointing needs torch.utils.checkpoint")
+    CHECKPOINT_IMPORTED = False
+
+def _match(name, module, selectors):
+    for selector in selectors:
+        if type(module).__name__ == selector:
+            return True
+        # qualified names match at any depth, e.g. "stages.*" matches "backbone.stages.0"
+        if fnmatch.fnmatchcase(name, selector) or fnmatch.fnmatchcase(name, '*.' + selector):
+            return True
+    return False
+
+def _copy_lists(x):
+    # forwards that write into their input list, e.g. HighResolutionModule, must get a new
+    # list at each call so that the recomputation sees the original inputs
+    if isinstance(x, list):
+        return [_copy_lists(v) for v in x]
+    if isinstance(x, tuple):
+        return tuple(_copy_lists(v) for v in x)
+    return x
+
+def _recompute_forward(forward):
+    @functools.wraps(forward)
+    def wrapper(self, *args, **kwargs):
+        if not (self.training and torch.is_grad_enabled()):
+            return forward(self, *args, **kwargs)
+        def run(*args):
+            return forward(self, *_copy_lists(args), **kwargs)
+        return checkpoint(run, *args, use_reentrant=False)
+    return wrapper
+
+def checkpoint_modules(model, selectors):
+    '''
+    Activation checkpointing of the selected modules of a model, their inner activations are
+    dropped after the forward and recomputed in the backward, only their inputs are kept.
+    Evaluation and no_grad forwards are unchanged.
+
+    A selected module inside another selected module is left as is, nested checkpoints would
+    recompute it twice. The batchnorm running statistics of a checkpointed module are updated
+    again by the recomputation.
+
+    Args:
+        model (nn.Module)
+        selectors (list): class names, e.g. "hg_module", "HighResolutionModule", or patterns
+                          of qualified module names, e.g. "hg_mods.*", "stages.*"
+    Returns:
+        names (list): qualified names of the checkpointed modules
+    '''
+    if not selectors:
+        return []
+    if not CHECKPOINT_IMPORTED:
+        logger.info("Activation checkpointing is not available, skip it")
+        return []
+    names = []
+    for name, m in model.named_modules():
+        if not name or not _match(name, m, selectors):
+            continue
+        if any(name.startswith(parent + '.') for parent in names):
+            continue
+        # bound to the instance, like Precision.keep_fp32
+        m.forward = types.MethodType(_recompute_forward(type(m).forward), m)
+        names.append(name)
+    logger.info(f"Activation checkpointing of {len(names)} modules matching {list(selectors)}")
+    return names
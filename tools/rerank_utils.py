@@ -0,0 +1,219 @@
+import numpy as np
+import torch
+import multiprocessing as mp
+from scipy import sparse
+from tqdm import tqdm
+import logging
+logger = logging.getLogger("logger")
+
+def re_ranking(qf, gf, k1=20, k2=6, lambda_value=0.3):
+    '''
+    Dense k-reciprocal re-ranking, the reference of sparse_re_ranking.
+    It holds several (q+g) x (q+g) matrices, which is only feasible up to ~20k images.
+
+    Reference:
+        Zhong et al. Re-ranking Person Re-identification with k-reciprocal Encoding. CVPR 2017
+        https://github.com/zhunzhong07/person-re-ranking
+
+    Args:
+        qf (torch.Tensor): num_q x d query features
+        gf (torch.Tensor): num_g x d gallery features
+    Returns:
+        distmat (numpy.ndarray): num_q x num_g re-ranked distances
+    '''
+    query_num = qf.size(0)
+    all_num = query_num + gf.size(0)
+    feat = torch.cat([qf, gf]).float()
+    distmat = torch.pow(feat, 2).sum(dim=1, keepdim=True).expand(all_num, all_num) + \
+              torch.pow(feat, 2).sum(dim=1, keepdim=True).expand(all_num, all_num).t()
+    distmat.addmm_(feat, feat.t(), beta=1, alpha=-2)
+    original_dist = distmat.numpy()
+    del feat, distmat
+    original_dist = np.transpose(original_dist / np.max(original_dist, axis=0))
+    V = np.zeros_like(original_dist).astype(np.float16)
+    initial_rank = np.argsort(original_dist).astype(np.int32)
+
+    for i in range(all_num):
+        # k-reciprocal neighbors
+        forward_k_neigh_index = initial_rank[i, :k1 + 1]
+        backward_k_neigh_index = initial_rank[forward_k_neigh_index, :k1 + 1]
+        fi = np.where(backward_k_neigh_index == i)[0]
+        k_reciprocal_index = forward_k_neigh_index[fi]
+        k_reciprocal_expansion_index = k_reciprocal_index
+        for j in range(len(k_reciprocal_index)):
+            candidate = k_reciprocal_index[j]
+            candidate_forward_k_neigh_index = initial_rank[candidate, :int(np.around(k1 / 2)) + 1]
+            candidate_backward_k_neigh_index = initial_rank[candidate_forward_k_neigh_index, :int(np.around(k1 / 2)) + 1]
+            fi_candidate = np.where(candidate_backward_k_neigh_index == candidate)[0]
+            candidate_k_reciprocal_index = candidate_forward_k_neigh_index[fi_candidate]
+            if len(np.intersect1d(candidate_k_reciprocal_index, k_reciprocal_index)) > 2 / 3 * len(candidate_k_reciprocal_index):
+                k_reciprocal_expansion_index = np.append(k_reciprocal_expansion_index, candidate_k_reciprocal_index)
+
+        k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
+        weight = np.exp(-original_dist[i, k_reciprocal_expansion_index])
+        V[i, k_reciprocal_expansion_index] = weight / np.sum(weight)
+    original_dist = original_dist[:query_num, ]
+    if k2 != 1:
+        V_qe = np.zeros_like(V, dtype=np.float16)
+        for i in range(all_num):
+            V_qe[i, :] = np.mean(V[initial_rank[i, :k2], :], axis=0)
+        V = V_qe
+        del V_qe
+    del initial_rank
+    invIndex = []
+    for i in range(all_num):
+        invIndex.append(np.where(V[:, i] != 0)[0])
+
+    jaccard_dist = np.zeros_like(original_dist, dtype=np.float16)
+    for i in range(query_num):
+        temp_min = np.zeros(shape=[1, all_num], dtype=np.float16)
+        indNonZero = np.where(V[i, :] != 0)[0]
+        indImages = [invIndex[ind] for ind in indNonZero]
+        for j in range(len(indNonZero)):
+            temp_min[0, indImages[j]] = temp_min[0, indImages[j]] + np.minimum(V[i, indNonZero[j]], V[indImages[j], indNonZero[j]])
+        jaccard_dist[i] = 1 - temp_min / (2 - temp_min)
+
+    final_dist = jaccard_dist * (1 - lambda_value) + original_dist * lambda_value
+    del original_dist, V, jaccard_dist
+    final_dist = final_dist[:query_num, query_num:]
+    return final_dist
+
+# arrays shared with the forked workers of sparse_re_ranking
+_SHARED = {}
+
+def _sq_dist(rows):
+    # squared euclidean distances of the given rows to all the features
+    feat, sqnorms = _SHARED['feat'], _SHARED['sqnorms']
+    return sqnorms[rows][:, np.newaxis] + sqnorms[np.newaxis] - 2 * feat[rows] @ feat.T
+
+def _neighbours(rows):
+    d2 = _sq_dist(rows)
+    k = _SHARED['k']
+    part = np.argpartition(d2, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(d2, part, 1), axis=1, kind='stable')
+    return np.take_along_axis(part, order, 1).astype(np.int32), d2.max(axis=1)
+
+def _k_reciprocal(rows, k):
+    '''
+    Returns:
+        forward (numpy.ndarray, len(rows) x (k+1)): the k+1 nearest neighbours of the rows
+        mask (numpy.ndarray, len(rows) x (k+1)): the rows are in the k+1 nearest neighbours of forward
+    '''
+    initial_rank = _SHARED['initial_rank']
+    forward = initial_rank[rows, :k + 1]
+    backward = initial_rank[forward, :k + 1]
+    return forward, (backward == rows[:, np.newaxis, np.newaxis]).any(axis=2)
+
+def _encode(rows):
+    '''
+    k-reciprocal feature of the rows, the weights of the expanded k-reciprocal neighbours
+    Returns:
+        rows, cols, vals (numpy.ndarray): entries of the sparse V
+    '''
+    k1 = _SHARED['k1']
+    n = len(rows)
+    R, R_mask = _k_reciprocal(rows, k1)
+    # k1/2-reciprocal neighbours of each candidate in R
+    H, H_mask = _k_reciprocal(R.ravel(), int(np.around(k1 / 2)))
+    H, H_mask = H.reshape(n, R.shape[1], -1), H_mask.reshape(n, R.shape[1], -1)
+    in_R = ((H[..., np.newaxis] == R[:, np.newaxis, np.newaxis]) & R_mask[:, np.newaxis, np.newaxis]).any(axis=3) & H_mask
+    accept = R_mask & (in_R.sum(axis=2) > 2 / 3 * H_mask.sum(axis=2))
+
+    # unique of R and the accepted candidate sets
+    num_all = _SHARED['feat'].shape[0]
+    cols = np.concatenate([R, H.reshape(n, -1)], 1).astype(np.int64)
+    valid = np.concatenate([R_mask, (H_mask & accept[..., np.newaxis]).reshape(n, -1)], 1)
+    cols = np.sort(np.where(valid, cols, num_all), axis=1)
+    valid = cols < num_all
+    valid[:, 1:] &= cols[:, 1:] != cols[:, :-1]
+
+    dist = np.take_along_axis(_sq_dist(rows), np.minimum(cols, num_all - 1), 1) / _SHARED['maxs'][rows][:, np.newaxis]
+    weight = np.where(valid, np.exp(-dist), 0)
+    weight /= np.maximum(weight.sum(axis=1, keepdims=True), 1e-12)
+    r, c = np.nonzero(valid)
+    return rows[r], cols[r, c], weight[r, c].astype(np.float32)
+
+def _intersection(rows):
+    '''
+    sum_f min(V[i, f], V[j, f]) of the query rows i and all the gallery images j
+    Returns:
+        inter (scipy.sparse.csr_matrix, len(rows) x num_g)
+    '''
+    V, V_csc, num_q = _SHARED['V'], _SHARED['V_csc'], _SHARED['num_q']
+    coo = V[rows].tocoo()
+    # expand each non-zero (i, f) of the rows to the non-zeros (j, f) of column f
+    starts, lengths = V_csc.indptr[coo.col], np.diff(V_csc.indptr)[coo.col]
+    offsets = np.cumsum(lengths) - lengths
+    pos = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    i = np.repeat(coo.row, lengths)
+    j = V_csc.indices[pos]
+    vals = np.minimum(np.repeat(coo.data, lengths), V_csc.data[pos])
+    gallery = j >= num_q
+    return sparse.coo_matrix((vals[gallery], (i[gallery], j[gallery] - num_q)), shape=(len(rows), V.shape[1] - num_q)).tocsr()
+
+def _map(fn, chunks, num_workers, desc):
+    if num_workers <= 1:
+        return [fn(chunk) for chunk in tqdm(chunks, desc=desc)]
+    # fork so that the workers read _SHARED without copying it
+    with mp.get_context('fork').Pool(num_workers) as pool:
+        return list(tqdm(pool.imap(fn, chunks), total=len(chunks), desc=desc))
+
+def sparse_re_ranking(qf, gf, k1=20, k2=6, lambda_value=0.3, block_size=256, num_workers=4):
+    '''
+    k-reciprocal re-ranking from sparse neighbour lists, memory scales with (q+g) x k1 except
+    for the returned q x g distances.
+
+    The distances are computed block by block to find the k1+1 nearest neighbours and the
+    row maximum of each image, the k-reciprocal features V and their query expansion are
+    scipy.sparse matrices and the Jaccard distances are sums of minimums over the shared
+    non-zeros. The blocks are processed by num_workers forked processes.
+
+    The results match re_ranking up to its float16 storage of V and the order of exactly
+    tied distances.
+
+    Args:
+        qf (torch.Tensor): num_q x d query features
+        gf (torch.Tensor or FeatureStore): num_g x d gallery features
+        block_size (int): number of rows processed at once, each takes block_size x (q+g) floats
+        num_workers (int): number of processes, 0 or 1 to run in the current process
+    Returns:
+        distmat (numpy.ndarray): num_q x num_g re-ranked distances
+    '''
+    num_q = len(qf)
+    feat = np.ascontiguousarray(torch.cat([qf[:], gf[:]]).float().numpy())
+    num_all = feat.shape[0]
+    chunks = [np.arange(start, min(start + block_size, num_all)) for start in range(0, num_all, block_size)]
+    _SHARED.update(feat=feat, sqnorms=np.einsum('ij,ij->i', feat, feat), k=min(k1 + 1, num_all), k1=k1, num_q=num_q)
+    try:
+        results = _map(_neighbours, chunks, num_workers, "Neighbours")
+        _SHARED['initial_rank'] = np.concatenate([r[0] for r in results])
+        _SHARED['maxs'] = np.concatenate([r[1] for r in results])
+        del results
+
+        results = _map(_encode, chunks, num_workers, "Encode")
+        rows, cols, vals = [np.concatenate(r) for r in zip(*results)]
+        del results
+        V = sparse.csr_matrix((vals, (rows, cols)), shape=(num_all, num_all))
+        if k2 != 1:
+            # local query expansion, the mean of the k2 nearest neighbours
+            neighbours = _SHARED['initial_rank'][:, :k2]
+            expansion = sparse.csr_matrix((np.full(neighbours.size, 1. / neighbours.shape[1], dtype=np.float32),
+                (np.repeat(np.arange(num_all), neighbours.shape[1]), neighbours.ravel())), shape=(num_all, num_all))
+            V = expansion @ V
+        V.eliminate_zeros()
+        _SHARED.update(V=V, V_csc=V.tocsc())
+
+        q_chunks = [chunk[chunk < num_q] for chunk in chunks if chunk[0] < num_q]
+        inters = _map(_intersection, q_chunks, num_workers, "Jaccard")
+
+        distmat = np.empty((num_q, num_all - num_q), dtype=np.float32)
+        for rows, inter in zip(q_chunks, inters):
+            original = _sq_dist(rows)[:, num_q:] / _SHARED['maxs'][rows][:, np.newaxis]
+            block = original * lambda_value + (1 - lambda_value)
+            # the Jaccard distance is 1 - inter / (2 - inter), 1 without shared non-zeros
+            inter = inter.tocoo()
+            block[inter.row, inter.col] -= (1 - lambda_value) * inter.data / (2 - inter.data)
+            distmat[rows] = block
+    finally:
+        _SHARED.clear()
+    return distmat
@@ -10,8 +10,10 @@ from tools.image import (
 
 from tools.utils import (
     _tranpose_and_gather_feat,
+    _gather_feat_at,
     _nms,
     _topk,
+    _sparse_topk,
     _topk_channel,
     transform_preds,
 )
@@ -96,16 +98,24 @@ def scopehead_bbox_target(cls_ids, bboxes, ids, max_objs, num_classes, out_sizes
 
     return rets
 
-def scopehead_det_decode(heat, wh, reg, K=100, num_bins=5, thresh=0.5):
+def scopehead_det_decode(heat, wh, reg, K=100, num_bins=5, thresh=0.5, score_thresh=None):
+    '''
+    thresh (float): threshold of the ordinal bins
+    score_thresh (float): if given, only peaks above it are extracted (sparse path), 
+                          images with less than K peaks are padded with score 0
+    '''
     batch, cat, height, width = heat.size()
     unit = wh.new_tensor([(width / 2) / num_bins, (height / 2) / num_bins, (width / 2) / num_bins, (height / 2) / num_bins])
     # heat = torch.sigmoid(heat)
-    # perform nms on heatmaps
-    heat = _nms(heat)
-    scores, inds, clses, ys, xs = _topk(heat, K=K)
-    reg = _tranpose_and_gather_feat(reg, inds)
+    if score_thresh is None:
+        # perform nms on heatmaps
+        heat = _nms(heat)
+        scores, inds, clses, ys, xs = _topk(heat, K=K)
+    else:
+        scores, inds, clses, ys, xs = _sparse_topk(heat, K=K, thresh=score_thresh)
+    reg = _gather_feat_at(reg, inds)
     reg = reg.view(batch, K, 4)
-    wh = _tranpose_and_gather_feat(wh, inds)
+    wh = _gather_feat_at(wh, inds)
     ordinal_wh = wh.view(batch, K, 4, num_bins)
     rank = (ordinal_wh >= thresh).sum(dim=-1)
     wh = (rank + reg) * unit 
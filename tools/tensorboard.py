@@ -9,12 +9,14 @@ import sys
 
 import logging as logger
 from tensorboardX import SummaryWriter
+from tools.metric_utils import AsyncWriter
 
 def Tensorboard(cfg, log_name='log'):
     path = os.path.join(cfg.OUTPUT_DIR, log_name)
     if not os.path.exists(path):
         os.mkdir(path)
     logger.info(path)
-    visualizer = SummaryWriter(path)
+    # the events are written by a background thread
+    visualizer = AsyncWriter(SummaryWriter(path))
 
     return visualizer
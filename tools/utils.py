@@ -89,6 +89,66 @@ def _topk(scores, K=40):
 
     return topk_score, topk_inds, topk_clses, topk_ys, topk_xs
 
+def _gather_feat_at(feat, ind):
+    '''
+    Same as _tranpose_and_gather_feat, but gathers the K entries directly from the
+    B x C x H x W map instead of making a permuted copy of the whole map.
+
+    Returns:
+        feat (torch.Tensor): B x K x C
+    '''
+    batch, dim = feat.size(0), feat.size(1)
+    ind = ind.long().unsqueeze(1).expand(batch, dim, ind.size(1))
+    return feat.reshape(batch, dim, -1).gather(2, ind).permute(0, 2, 1).contiguous()
+
+def _sparse_topk(heat, K=40, thresh=0.1, kernel=3):
+    '''
+    Threshold-gated replacement of _nms + _topk. Only the entries above thresh are
+    checked for being a local maximum (against the kernel x kernel neighbors, same as
+    the max pooling of _nms), then the top K peaks of each image are selected.
+    Images with less than K peaks are padded with score 0 and index 0.
+
+    Returns:
+        same as _topk, B x K tensors of scores, inds, clses, ys, xs
+    '''
+    batch, cat, height, width = heat.size()
+    b, c, y, x = (heat > thresh).nonzero(as_tuple=True)
+    score = heat[b, c, y, x]
+
+    pad = (kernel - 1) // 2
+    is_peak = torch.ones_like(score, dtype=torch.bool)
+    for dy in range(-pad, pad + 1):
+        for dx in range(-pad, pad + 1):
+            if dy == 0 and dx == 0:
+                continue
+            ny, nx = y + dy, x + dx
+            inside = (ny >= 0) & (ny < height) & (nx >= 0) & (nx < width)
+            neighbor = heat[b, c, ny.clamp(0, height - 1), nx.clamp(0, width - 1)]
+            is_peak &= ~inside | (neighbor <= score)
+    b, c, y, x, score = b[is_peak], c[is_peak], y[is_peak], x[is_peak], score[is_peak]
+
+    # sort by score, then stable sort by image, so the peaks of each image are in descending order
+    order = score.argsort(descending=True)
+    order = order[b[order].argsort(stable=True)]
+    b, c, y, x, score = b[order], c[order], y[order], x[order], score[order]
+    counts = torch.bincount(b, minlength=batch)
+    starts = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(b.numel(), device=heat.device) - starts[b]
+    keep = rank < K
+    b, c, y, x, score, rank = b[keep], c[keep], y[keep], x[keep], score[keep], rank[keep]
+
+    topk_score = heat.new_zeros(batch, K)
+    topk_inds = torch.zeros(batch, K, dtype=torch.long, device=heat.device)
+    topk_clses = torch.zeros(batch, K, dtype=torch.int, device=heat.device)
+    topk_ys = heat.new_zeros(batch, K)
+    topk_xs = heat.new_zeros(batch, K)
+    topk_score[b, rank] = score
+    topk_inds[b, rank] = y * width + x
+    topk_clses[b, rank] = c.int()
+    topk_ys[b, rank] = y.to(heat.dtype)
+    topk_xs[b, rank] = x.to(heat.dtype)
+    return topk_score, topk_inds, topk_clses, topk_ys, topk_xs
+
 def _topk_channel(scores, K=40):
     batch, cat, height, width = scores.size()
     
@@ -48,6 +48,8 @@ def main():
         logger.info("Unexpected Error Occurred")
         if cfg.SAVE:
             logger.info("Back up the Checkpoint")
+            if trainer.graph.checkpointer is not None:
+                trainer.graph.checkpointer.wait(raise_errors=False)
             trainer.graph.save(trainer.graph.save_path, trainer.graph.model, trainer.graph.sub_models, trainer.solvers, trainer.engine.epoch, trainer.engine.accu)
         logger.info(traceback.format_exc())
         sys.exit(1)
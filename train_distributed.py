@@ -33,7 +33,8 @@ def main():
     if args.cfg:
         show_configs()
 
-    dist.init_process_group(backend='nccl')
+    # gloo runs on CPU, e.g. to test the distributed evaluation locally
+    dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
     rank = dist.get_rank()
     assert rank == args.local_rank
 
@@ -53,8 +54,9 @@ def main():
 
     deploy_macro(cfg)
     logger.info(f"Rank [{rank}] Start!")
-    device = torch.device("cuda:{}".format(rank))
-    torch.cuda.set_device(device)
+    if torch.cuda.is_available():
+        device = torch.device("cuda:{}".format(rank))
+        torch.cuda.set_device(device)
     trainer = TrainerFactory.produce(cfg)
     
     if cfg.EVALUATE:
@@ -67,6 +69,8 @@ def main():
         logger.info("Unexpected Error Occurred")
         if cfg.SAVE:
             logger.info("Back up the Checkpoint")
+            if trainer.graph.checkpointer is not None:
+                trainer.graph.checkpointer.wait(raise_errors=False)
             trainer.graph.save(trainer.graph.save_path, trainer.graph.model, trainer.graph.sub_models, trainer.solvers, trainer.engine.epoch, trainer.engine.accu)
         logger.info(traceback.format_exc())
         sys.exit(1)